@@ -1,79 +1,173 @@
-import cv2
 import os
+import json
+import argparse
 import xml.etree.ElementTree as ET
-from pascal_voc import write_pascal_voc, append_object_to_pascal_voc
-from helpers import drawbbox
-
-target_image_width = 128
-target_image_height = 128
-
-annotation_path = 'annotations/testset-orange-2/annotations.xml'
-
-compressed_testing_folder_path = f'compressed_testing/testset-orange-2/frames_{target_image_height} x {target_image_width}'
-exported_annotations_folderpath = 'compressed_testing/testset-orange-2/annotations'
-os.makedirs(exported_annotations_folderpath, exist_ok=True)
-os.makedirs(compressed_testing_folder_path, exist_ok=True)
-
-tree = ET.parse(annotation_path)
-root = tree.getroot()
-
-
-for image in root.findall('image'):
-    on_first_frame = True
-    frame_num = image.attrib['id']
-    file_name = image.attrib['name']
-    for box in image.findall('box'):
-        label = box.attrib['label']
-        print(f"Processing frame: {frame_num}")
-
-        image_path = os.path.join(f'testing/images_of_orange (2)/{file_name}')
+from concurrent.futures import ProcessPoolExecutor
+from cvat_reader import load_index
+from crop_resize import CropJob, crop_resize_images
+from image_io import ImageWriter
+from profiling import get_profiler, start_run
+
+# Builds the evaluation sets. Every CVAT image export under annotations_root is one test set; its images are
+# cropped/resized to every target size into output_root/<set>/frames_<h> x <w> with one Pascal VOC file per image
+# in output_root/<set>/annotations_<h> x <w>. Sets are built in parallel on a process pool, and a consolidated
+# index of every written image with its boxes and labels goes to output_root/index.json.
+
+# every (width, height) in the list is produced from a single decode of each image
+target_sizes = [(96, 96), (128, 128)]
+
+annotations_root = 'annotations'
+# a set's images are looked up in images_root/<set name>, then next to its export
+images_root = 'testing'
+# image folders of sets that don't follow that layout
+image_folders = {'testset-orange-2': 'testing/images_of_orange (2)'}
+output_root = 'compressed_testing'
+# None keeps the source images' format, or png, jpeg, webp or npy, see image_io.py
+output_format = None
+output_quality = None
+
+
+def compress_test_set(annotation_path, images_folder_path, output_dir, target_sizes=target_sizes, fmt=output_format,
+                      quality=output_quality, index=None):
+    """Crop/resize the images of a CVAT image export to every target size, into output_dir/frames_<h> x <w>
+    and output_dir/annotations_<h> x <w>. With an index list, every written image is appended to it."""
+    compressed_testing_folder_paths = {(w, h): f'{output_dir}/frames_{h} x {w}' for w, h in target_sizes}
+    exported_annotations_folderpaths = {(w, h): f'{output_dir}/annotations_{h} x {w}' for w, h in target_sizes}
+
+    with get_profiler().stage('xml_read'):
+        cvat_index = load_index(annotation_path)
+
+    jobs = []
+    for frame_num, boxes in cvat_index.items():
+        file_name = cvat_index.images[frame_num][0]
+        image_path = os.path.join(images_folder_path, file_name)
         if not os.path.exists(image_path):
             continue
 
-        xtl, ytl, xbr, ybr = [float(box.attrib[attr]) for attr in ['xtl', 'ytl', 'xbr', 'ybr']]
-
-        original_image = cv2.imread(image_path)
-
-        (h, w) = original_image.shape[:2]
-
-        aspect_ratio = w / h # width / height, to maintain the aspect ratio of the original image
-
-        new_width = int(aspect_ratio * target_image_width) # aspect_ratio * target_imag
-
-        resized_image = cv2.resize(original_image, (new_width, target_image_height))
-
-        if new_width > target_image_width:
-            start_x = (new_width - target_image_width) // 2
-            cropped_image = resized_image[:, start_x:start_x + target_image_width]
-        else:
-            cropped_image = resized_image
-
-        cv2.imwrite(f'{compressed_testing_folder_path}/{file_name}', cropped_image)
-
-        resize_ratio = target_image_width / original_image.shape[0]
-
-        new_xtl = xtl * resize_ratio - start_x if new_width > target_image_width else xtl * resize_ratio
-        new_ytl = ytl * resize_ratio
-        new_xbr = xbr * resize_ratio - start_x if new_width > target_image_width else xbr * resize_ratio
-        new_ybr = ybr * resize_ratio
-
-
-        if new_xtl < 0: # if xtl is negative, set it to 0
-            new_xtl = 0
-        if new_ytl < 0: # if ytl is negative, set it to 0
-            new_ytl = 0
-        if new_xbr > target_image_width: # if xbr is greater than the target image width, set it to the target image width, because bbox reaches maximum width point, which is the target image width
-            new_xbr = target_image_width
-        if new_ybr > target_image_height: # if ybr is greater than the target image height, set it to the target image height, because bbox reaches maximum height point, which is the target image height
-            new_ybr = target_image_height
-
         new_file_name = file_name.rsplit('.jpg', 1)[0] + '.png'
-        xml_path = f'{exported_annotations_folderpath}/{new_file_name}.xml'
-
-        if not on_first_frame:
-            append_object_to_pascal_voc(xml_path, label, new_xtl, new_ytl, new_xbr, new_ybr)
-        else:
-            write_pascal_voc(xml_path, file_name, label, target_image_width, target_image_height, new_xtl, new_ytl, new_xbr, new_ybr)
-            on_first_frame = False
-
-        #drawbbox(compressed_testing_folder_path, file_name, new_xtl, new_ytl, new_xbr, new_ybr)
\ No newline at end of file
+        labels = [box[0] for box in boxes]
+        coords = [box[1:] for box in boxes]
+        jobs.append(CropJob(image_path, file_name, f'{new_file_name}.xml', file_name, labels, coords))
+
+    count = crop_resize_images(jobs, target_sizes, compressed_testing_folder_paths, exported_annotations_folderpaths,
+                               writer=ImageWriter(fmt, quality), index=index)
+    print(f"Compressed {count} test images to {', '.join(compressed_testing_folder_paths.values())}")
+    return count
+
+
+def first_image(xml_path):
+    """Name of the first image of a CVAT image export, None for a video export (tracks) or any other XML file"""
+    try:
+        # the first <image> or <track> decides, so only the header is read
+        for event, elem in ET.iterparse(xml_path, events=('start',)):
+            if elem.tag == 'image':
+                return elem.get('name')
+            if elem.tag == 'track':
+                return None
+    except ET.ParseError:
+        pass
+    return None
+
+
+def set_name(xml_path, root=annotations_root):
+    """annotations/annotations_test.xml is 'annotations_test', annotations/testset-orange-2/annotations.xml is
+    'testset-orange-2'"""
+    name = os.path.splitext(os.path.relpath(xml_path, root))[0]
+    if os.path.basename(name) == 'annotations' and os.path.dirname(name):
+        name = os.path.dirname(name)
+    return name.replace(os.sep, '/')
+
+
+def images_folder_for(xml_path, name, image_name):
+    """First of image_folders[name], images_root/<name>, <export dir>/images and the export dir that has image_name"""
+    export_dir = os.path.dirname(xml_path)
+    candidates = [image_folders.get(name), os.path.join(images_root, name), os.path.join(export_dir, 'images'), export_dir]
+    for folder in candidates:
+        if folder and os.path.exists(os.path.join(folder, image_name)):
+            return folder
+    return None
+
+
+def discover_test_sets(root=annotations_root):
+    """(name, annotation path, images folder) for every CVAT image export under root whose images were found"""
+    test_sets = []
+    for directory, _, files in os.walk(root):
+        for file_name in sorted(files):
+            xml_path = os.path.join(directory, file_name)
+            image_name = first_image(xml_path) if file_name.endswith('.xml') else None
+            if image_name is None:
+                continue
+            name = set_name(xml_path, root)
+            images_folder = images_folder_for(xml_path, name, image_name)
+            if images_folder is None:
+                print(f"No images found for {xml_path}, expected them in {os.path.join(images_root, name)}, skipping")
+                continue
+            test_sets.append((name, xml_path, images_folder))
+    return sorted(test_sets)
+
+
+def _build_set(args):
+    name, xml_path, images_folder, output_dir, targets, fmt, quality = args
+    index = []
+    count = compress_test_set(xml_path, images_folder, output_dir, targets, fmt, quality, index)
+    # runs in a worker process, its timings go back to the main process with the result
+    return name, count, index, get_profiler().snapshot(reset=True)
+
+
+def build_test_sets(test_sets, output_root=output_root, target_sizes=target_sizes, workers=None, fmt=output_format,
+                    quality=output_quality):
+    """Build every (name, annotation path, images folder) test set into output_root/<name>, one set per worker
+    process, and write output_root/index.json. Returns {name: images built}."""
+    tasks = [(name, xml_path, images_folder, os.path.join(output_root, name), target_sizes, fmt, quality)
+             for name, xml_path, images_folder in test_sets]
+    profiler = get_profiler()
+    results = []
+    if workers == 1 or len(tasks) == 1:
+        results = [_build_set(task) for task in tasks]
+        for result in results:
+            profiler.merge(result[3])
+    else:
+        with ProcessPoolExecutor(max_workers=workers or min(len(tasks), os.cpu_count() or 1)) as executor:
+            for result in executor.map(_build_set, tasks):
+                profiler.merge(result[3])
+                results.append(result)
+
+    sets = {name: {'annotations': xml_path, 'images': images_folder} for name, xml_path, images_folder in test_sets}
+    images = []
+    for name, count, index, _ in results:
+        sets[name]['count'] = count
+        images.extend(dict(entry, set=name) for entry in index)
+    os.makedirs(output_root, exist_ok=True)
+    with open(os.path.join(output_root, 'index.json'), 'w') as f:
+        json.dump({'targets': [list(target) for target in target_sizes], 'sets': sets, 'images': images}, f)
+    return {name: count for name, count, _, _ in results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the evaluation sets from every CVAT image export at every target size")
+    parser.add_argument("--set", nargs=2, action="append", metavar=("ANNOTATIONS", "IMAGES"),
+                        help="CVAT image export and its images folder (repeatable), instead of discovering the sets")
+    parser.add_argument("--annotations-root", default=annotations_root, help="Folder searched for CVAT image exports")
+    parser.add_argument("--output-root", default=output_root)
+    parser.add_argument("--target", type=int, nargs=2, action="append", metavar=("WIDTH", "HEIGHT"),
+                        help=f"Target size (repeatable), default {' and '.join(f'{w}x{h}' for w, h in target_sizes)}")
+    parser.add_argument("--workers", type=int, help="Sets built in parallel, default one per set up to the core count")
+    parser.add_argument("--format", choices=['png', 'jpeg', 'webp', 'npy'], default=output_format,
+                        help="Output image format, default the source images' format")
+    parser.add_argument("--quality", type=int, default=output_quality)
+    args = parser.parse_args()
+
+    if args.set:
+        test_sets = [(set_name(xml_path, args.annotations_root), xml_path, images) for xml_path, images in args.set]
+    else:
+        test_sets = discover_test_sets(args.annotations_root)
+    if not test_sets:
+        parser.error(f"no CVAT image exports with images found under {args.annotations_root}")
+    targets = [tuple(target) for target in args.target] if args.target else target_sizes
+
+    profiler = start_run('annotate_testing_frames')
+    counts = build_test_sets(test_sets, args.output_root, targets, args.workers, args.format, args.quality)
+    for name, count in counts.items():
+        print(f"- {name}: {count} images")
+    print(f"Index written to {os.path.join(args.output_root, 'index.json')}")
+    profiler.finish('reports/annotate_testing_frames.json')
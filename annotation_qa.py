@@ -0,0 +1,203 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import xml.etree.ElementTree as ET
+from calc_bbox_area import collect_boxes
+from cvat_reader import load_index, OUTSIDE
+
+# Quality checks for annotations, run on a Pascal VOC directory or a CVAT export. All boxes are loaded into one
+# columnar table of NumPy arrays and every check works on whole arrays at once:
+#   degenerate  box is empty, or narrower/shorter than min_side pixels once cropped and resized to the target
+#               the way compress_simple.py does it (shortest axis resized, longer one center cropped, boxes clipped)
+#   duplicate   two boxes of the same frame and label with IoU >= duplicate_iou (from different tracks)
+#   jump        a track's box overlaps its box in the previous frame by less than jump_iou
+# Boxes that CVAT marks outside are not drawn, so they are left out of every check.
+
+target_size = (128, 128)
+min_side = 2.0  # pixels in the target image
+duplicate_iou = 0.7
+jump_iou = 0.3
+# frames a track can skip and still be compared with its previous box
+max_track_gap = 1
+
+
+def box_iou(a, b):
+    """Elementwise IoU of two (N, 4) arrays of xtl, ytl, xbr, ybr boxes"""
+    inter_w = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def _cvat_original_size(xml_path):
+    """<original_size> from the meta block of a CVAT video export, or None"""
+    for event, elem in ET.iterparse(xml_path, events=('end',)):
+        if elem.tag == 'original_size':
+            return int(elem.find('width').text), int(elem.find('height').text)
+        if elem.tag == 'meta':
+            return None
+    return None
+
+
+def load_cvat(xml_path, image_size=None):
+    """Load a CVAT export into a table with one row per box, sorted by frame.
+    Video exports take their frame size from image_size or the export's <original_size>."""
+    index = load_index(xml_path)
+    counts = np.diff(np.frombuffer(index.offsets, dtype=np.uint32)).astype(np.int64)
+    frames = np.repeat(np.frombuffer(index.frames, dtype=np.int32), counts)
+    boxes = np.frombuffer(index.coords, dtype=np.float64).reshape(-1, 4)
+
+    if index.images:
+        sizes = np.array([index.images[frame][1:] for frame in index.frames], dtype=np.float64).reshape(-1, 2)
+        sizes = np.repeat(sizes, counts, axis=0)
+    else:
+        size = image_size or _cvat_original_size(xml_path)
+        if size is None:
+            raise ValueError(f"{xml_path} has no <original_size>, pass the frame size")
+        sizes = np.tile(np.array(size, dtype=np.float64), (len(boxes), 1))
+
+    return {
+        'labels': list(index.labels),
+        'label_id': np.frombuffer(index.label_ids, dtype=np.uint16).astype(np.int16),
+        'frame': frames,
+        'track_id': np.frombuffer(index.track_ids, dtype=np.int32),
+        'outside': (np.frombuffer(index.flags, dtype=np.uint8) & OUTSIDE) > 0,
+        'boxes': boxes,
+        'image_width': sizes[:, 0], 'image_height': sizes[:, 1],
+        'names': {frame: image[0] for frame, image in index.images.items()},
+    }
+
+
+def load_voc(directory, workers=None):
+    """Load every Pascal VOC file in directory into the same table, one file is one frame without tracks"""
+    xml_files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.xml'))
+    table = collect_boxes(xml_files, workers)
+    boxes = np.stack([table['xmin'], table['ymin'], table['xmax'], table['ymax']], axis=1).astype(np.float64)
+    return {
+        'labels': table['labels'],
+        'label_id': table['label_id'],
+        'frame': table['file_id'],
+        'track_id': np.full(len(boxes), -1, dtype=np.int32),
+        'outside': np.zeros(len(boxes), dtype=bool),
+        'boxes': boxes,
+        'image_width': table['image_width'].astype(np.float64), 'image_height': table['image_height'].astype(np.float64),
+        'names': {file_id: os.path.basename(path) for file_id, path in enumerate(xml_files)},
+    }
+
+
+def clamp_to_target(table, target=target_size):
+    """Transform every box the way crop_resize.py does for compress_simple.py, vectorized over all boxes"""
+    target_width, target_height = target
+    width, height = table['image_width'], table['image_height']
+    ratio = np.maximum(target_width / width, target_height / height)
+    new_width = np.maximum(target_width, np.floor(width * ratio))
+    new_height = np.maximum(target_height, np.floor(height * ratio))
+    start_x = (new_width - target_width) // 2
+    start_y = (new_height - target_height) // 2
+
+    boxes = table['boxes'] * ratio[:, np.newaxis] - np.stack([start_x, start_y, start_x, start_y], axis=1)
+    np.clip(boxes, 0, [target_width, target_height, target_width, target_height], out=boxes)
+    return boxes
+
+
+def find_degenerate(table, target=target_size, min_side=min_side):
+    """Rows of boxes that are empty in the source or thinner than min_side after clamping to the target"""
+    source = table['boxes']
+    clamped = clamp_to_target(table, target)
+    empty = (source[:, 2] <= source[:, 0]) | (source[:, 3] <= source[:, 1])
+    thin = np.minimum(clamped[:, 2] - clamped[:, 0], clamped[:, 3] - clamped[:, 1]) < min_side
+    rows = np.flatnonzero((empty | thin) & ~table['outside'])
+    return rows, np.minimum(clamped[rows, 2] - clamped[rows, 0], clamped[rows, 3] - clamped[rows, 1])
+
+
+def frame_pairs(frames):
+    """All (i, j) row pairs with i < j in the same frame, frames must be sorted.
+    Frames are grouped by their box count, so each group is one broadcast instead of a loop over frames."""
+    starts = np.flatnonzero(np.r_[True, frames[1:] != frames[:-1]])
+    counts = np.diff(np.r_[starts, len(frames)])
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for count in np.unique(counts):
+        if count < 2:
+            continue
+        i, j = np.triu_indices(count, 1)
+        group_starts = starts[counts == count][:, np.newaxis]
+        first.append((group_starts + i).ravel())
+        second.append((group_starts + j).ravel())
+    return np.concatenate(first), np.concatenate(second)
+
+
+def find_duplicates(table, threshold=duplicate_iou):
+    """(i, j, iou) for same-label boxes of one frame that overlap by at least threshold"""
+    i, j = frame_pairs(table['frame'])
+    same = (table['label_id'][i] == table['label_id'][j]) & ~table['outside'][i] & ~table['outside'][j]
+    i, j = i[same], j[same]
+    overlap = box_iou(table['boxes'][i], table['boxes'][j])
+    keep = overlap >= threshold
+    return i[keep], j[keep], overlap[keep]
+
+
+def find_jumps(table, threshold=jump_iou, max_gap=max_track_gap):
+    """(previous row, row, iou) where a track's box overlaps its box max_gap or fewer frames earlier by less than threshold"""
+    rows = np.flatnonzero((table['track_id'] >= 0) & ~table['outside'])
+    rows = rows[np.lexsort((table['frame'][rows], table['track_id'][rows]))]
+    previous, current = rows[:-1], rows[1:]
+    consecutive = ((table['track_id'][previous] == table['track_id'][current]) &
+                   (table['frame'][current] - table['frame'][previous] <= max_gap))
+    previous, current = previous[consecutive], current[consecutive]
+    overlap = box_iou(table['boxes'][previous], table['boxes'][current])
+    keep = overlap < threshold
+    return previous[keep], current[keep], overlap[keep]
+
+
+def check(table, target=target_size, min_side=min_side, duplicate_threshold=duplicate_iou, jump_threshold=jump_iou):
+    """Run every check, returns a list of (kind, row, other row or -1, value) issues"""
+    issues = []
+    rows, sides = find_degenerate(table, target, min_side)
+    issues.extend(('degenerate', row, -1, side) for row, side in zip(rows, sides))
+    first, second, overlap = find_duplicates(table, duplicate_threshold)
+    issues.extend(('duplicate', i, j, value) for i, j, value in zip(first, second, overlap))
+    previous, current, overlap = find_jumps(table, jump_threshold)
+    issues.extend(('jump', j, i, value) for i, j, value in zip(previous, current, overlap))
+    return issues
+
+
+def write_issues(path, table, issues):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'frame', 'label', 'track', 'xtl', 'ytl', 'xbr', 'ybr', 'other_track', 'value'])
+        for kind, row, other, value in issues:
+            frame = table['frame'][row]
+            writer.writerow([kind, table['names'].get(frame, frame), table['labels'][table['label_id'][row]], table['track_id'][row],
+                             *np.round(table['boxes'][row], 2), table['track_id'][other] if other >= 0 else '',
+                             round(float(value), 4)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check annotations for degenerate boxes, duplicates and track jumps")
+    parser.add_argument("path", help="CVAT XML export or folder of Pascal VOC files")
+    parser.add_argument("--target", type=int, nargs=2, default=target_size, metavar=("WIDTH", "HEIGHT"),
+                        help="Size the boxes are clamped to for the degenerate check")
+    parser.add_argument("--image-size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"),
+                        help="Frame size of a CVAT video export without <original_size>")
+    parser.add_argument("--min-side", type=float, default=min_side)
+    parser.add_argument("--duplicate-iou", type=float, default=duplicate_iou)
+    parser.add_argument("--jump-iou", type=float, default=jump_iou)
+    parser.add_argument("--report", help="Write every issue to this CSV file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = load_voc(args.path) if os.path.isdir(args.path) else load_cvat(args.path, args.image_size)
+    loaded = time.perf_counter()
+    issues = check(table, tuple(args.target), args.min_side, args.duplicate_iou, args.jump_iou)
+    checked = time.perf_counter()
+
+    print(f"Checked {len(table['boxes'])} boxes in {checked - loaded:.3f}s (loading took {loaded - start:.3f}s)")
+    for kind in ('degenerate', 'duplicate', 'jump'):
+        print(f"- {kind}: {sum(1 for issue in issues if issue[0] == kind)}")
+    if args.report:
+        write_issues(args.report, table, issues)
@@ -0,0 +1,99 @@
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from augmentation import read_xml, write_xml, augment_sample, stable_seed, init_worker, get_writer
+from image_io import is_image, read_image
+
+# Streaming alternative to augmentation.main: instead of writing a fixed number of augmented copies to disk,
+# AugmentedDataset generates them lazily from the compressed frames. Every sample is deterministic for its
+# (image, epoch, variant), so any number of variants can be drawn without touching the disk, and training
+# sees new augmentations every epoch. export() writes the old augmented/<name>/images layout when needed.
+
+
+def sample_seed(image_path, epoch, variant):
+    # epoch 0 uses the same seeds as augmentation.py, so epoch 0 equals the exported copies
+    if epoch == 0:
+        return stable_seed(image_path, variant)
+    return zlib.crc32(f'{os.path.basename(image_path)}:{epoch}:{variant}'.encode('utf-8')) & 0xffffffff
+
+
+def _load_sample(args):
+    image_path, xml_path, seed = args
+    return augment_sample(read_image(image_path), read_xml(xml_path), seed)
+
+
+class AugmentedDataset:
+    """Lazily augmented view of a folder of images and their Pascal VOC annotations"""
+
+    def __init__(self, image_dir, xml_dir, variants=3):
+        self.variants = variants
+        self.samples = []
+        for img_file in sorted(os.listdir(image_dir)):
+            if not is_image(img_file):
+                continue
+            xml_path = os.path.join(xml_dir, os.path.splitext(img_file)[0] + '.xml')
+            if os.path.exists(xml_path):
+                self.samples.append((os.path.join(image_dir, img_file), xml_path))
+
+    def __len__(self):
+        return len(self.samples) * self.variants
+
+    def _task(self, index, epoch):
+        # an empty dataset has no valid index, so the modulo below never divides by zero
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"sample index {index} out of range for {len(self)} samples")
+        index %= len(self)
+        # index runs over images first, so variant v of every image comes before variant v + 1
+        image_path, xml_path = self.samples[index % len(self.samples)]
+        variant = index // len(self.samples)
+        return image_path, xml_path, sample_seed(image_path, epoch, variant)
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get(index)
+
+    def get(self, index, epoch=0):
+        """Return (image, boxes, object_ids) for one sample, image is BGR like cv2.imread, boxes are pascal_voc and
+        object_ids are the positions of the boxes' objects in the source annotation (boxes can be dropped)"""
+        return _load_sample(self._task(index, epoch))
+
+    def iterate(self, epoch=0, order=None, workers=None, prefetch=64):
+        """Yield (index, image, boxes, object_ids) for every sample in order (default: all indices), augmenting on worker
+        processes. At most prefetch samples are in flight, so memory stays bounded however many variants there are."""
+        order = range(len(self)) if order is None else order
+        if workers == 0:
+            for index in order:
+                yield (index, *self.get(index, epoch))
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            pending = deque()
+            for index in order:
+                pending.append((index, executor.submit(_load_sample, self._task(index, epoch))))
+                if len(pending) >= prefetch:
+                    done_index, future = pending.popleft()
+                    yield (done_index, *future.result())
+            while pending:
+                done_index, future = pending.popleft()
+                yield (done_index, *future.result())
+
+    def export(self, save_dir, variants=None, workers=None):
+        """Write variants augmented copies per image in the augmentation.py layout (save_dir/images, save_dir/annotations)"""
+        os.makedirs(os.path.join(save_dir, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(save_dir, 'annotations'), exist_ok=True)
+        variants = self.variants if variants is None else variants
+
+        writer = get_writer()
+        count = 0
+        for index, image, boxes, object_ids in self.iterate(0, range(len(self.samples) * variants), workers):
+            image_path, xml_path = self.samples[index % len(self.samples)]
+            prefix = f"aug_{index // len(self.samples)}"
+            img_save_path = writer.write(os.path.join(save_dir, 'images', f"{prefix}_{os.path.basename(image_path)}"), image)
+            write_xml(boxes, xml_path, os.path.join(save_dir, 'annotations', f"{prefix}_{os.path.basename(xml_path)}"),
+                      os.path.basename(img_save_path), object_ids)
+            count += 1
+        return count
@@ -1,11 +1,28 @@
 import os
+import zlib
 import cv2
 import albumentations as A
 from albumentations.augmentations import transforms
 from lxml import etree
 from shutil import copyfile
 import random
+import argparse
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from box_geometry import apply_transform, box_centers, compare_boxes, fit_affine, reference_boxes, reference_points
+from build_cache import BuildManifest, manifest_path_for
+from calc_bbox_area import collect_boxes
+from dir_stream import bounded_map, chunked, prefetch, scan_images
+from image_io import ImageWriter, read_image
+from profiling import get_profiler, start_run
+
+# the transform is built once per process and reused for every image that process augments
+_transform = None
+# bump when build_transform changes, so incremental runs rebuild every augmented copy
+transform_version = 3
+# None keeps the source images' format, or png, jpeg, webp or npy, see image_io.py
+output_format = None
+output_quality = None
 
 
 def read_xml(file_path):
@@ -14,79 +31,323 @@ def read_xml(file_path):
     boxes = []
     for member in root.findall('object'):
         bndbox = member.find('bndbox')
-        boxes.append([
-            round(float(bndbox.find('xmin').text)),
-            round(float(bndbox.find('ymin').text)),
-            round(float(bndbox.find('xmax').text)),
-            round(float(bndbox.find('ymax').text))
-        ])
+        # full precision, rounding here moved every box by up to half a pixel before the transform
+        boxes.append([float(bndbox.find(name).text) for name in ('xmin', 'ymin', 'xmax', 'ymax')])
     return boxes
 
-def write_xml(boxes, original_file, new_file):
+def first_per_object(boxes, object_ids):
+    """{object id: box}, keeping the first box of every object if a transform returned copies of it"""
+    boxes_by_object = {}
+    for object_id, box in zip(object_ids, boxes):
+        boxes_by_object.setdefault(object_id, box)
+    return boxes_by_object
+
+def write_xml(boxes, original_file, new_file, image_name=None, object_ids=None):
+    """Write original_file with its boxes replaced by boxes. object_ids gives the position of every box's <object>
+    in original_file, objects without a box (dropped by the transform) are removed. Without object_ids the
+    boxes must match the objects one to one."""
     tree = etree.parse(original_file)
     root = tree.getroot()
-    for i, member in enumerate(root.findall('object')):
+    objects = root.findall('object')
+    if object_ids is None:
+        if len(boxes) != len(objects):
+            raise ValueError(f"{len(boxes)} boxes for {len(objects)} objects in {original_file}, pass object_ids")
+        object_ids = range(len(objects))
+    boxes_by_object = first_per_object(boxes, object_ids)
+    for i, member in enumerate(objects):
+        if i not in boxes_by_object:
+            root.remove(member)
+            continue
         bndbox = member.find('bndbox')
-        bndbox.find('xmin').text = str(boxes[i][0])
-        bndbox.find('ymin').text = str(boxes[i][1])
-        bndbox.find('xmax').text = str(boxes[i][2])
-        bndbox.find('ymax').text = str(boxes[i][3])
-        root.find('filename').text = os.path.basename(new_file).replace('.xml', '.png')
+        for name, value in zip(('xmin', 'ymin', 'xmax', 'ymax'), boxes_by_object[i]):
+            bndbox.find(name).text = str(float(value))
+    root.find('filename').text = image_name or os.path.basename(new_file).replace('.xml', '.png')
     tree.write(new_file)
 
-def augment_image(image_path, xml_path, save_dir, prefix, iteration):
-    image = cv2.imread(image_path)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    boxes = read_xml(xml_path)
-
-    unique_seed = hash((os.path.basename(image_path) + str(iteration))) & 0xffffffff
-
-    random.seed(unique_seed)
-    np.random.seed(unique_seed)    
-
-    # augmentation
-    transform = A.Compose([
+def build_transform():
+    return A.Compose([
         A.HorizontalFlip(p=0.5),
         A.VerticalFlip(p=0.5),
         A.RandomBrightnessContrast(brightness_limit=0.1, contrast_limit=0.1, p=0.5),
-        A.Rotate(limit=30, p=0.5),
+        A.Rotate(limit=30, border_mode=cv2.BORDER_CONSTANT, p=0.5),
         A.RandomResizedCrop(size=(128, 128), scale=(0.9, 1.0), ratio=(0.75, 1.3333333333333333),
                             interpolation=cv2.INTER_LINEAR, mask_interpolation=cv2.INTER_NEAREST, p=0.5),
-        A.PadIfNeeded(min_height=128, min_width=128, border_mode=cv2.BORDER_REFLECT)
+        A.PadIfNeeded(min_height=128, min_width=128, border_mode=cv2.BORDER_CONSTANT)
+
+
+    # object_ids travel with the boxes, so the boxes albumentations drops can be told apart from the kept ones
+    ], bbox_params=A.BboxParams(format='pascal_voc', label_fields=['object_ids']))
+
+def get_transform():
+    global _transform
+    if _transform is None:
+        _transform = build_transform()
+    return _transform
+
+def stable_seed(image_path, iteration):
+    # crc32 instead of hash(), which is salted per interpreter (PYTHONHASHSEED), so the seed
+    # is the same across runs and across worker processes
+    return zlib.crc32((os.path.basename(image_path) + str(iteration)).encode('utf-8')) & 0xffffffff
+
+def seed_transform(transform, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    # newer albumentations versions keep their own generator instead of the global ones
+    if hasattr(transform, 'set_random_seed'):
+        transform.set_random_seed(seed)
+
+def augment_sample(image, boxes, seed, transform=None):
+    """Augment a BGR image and its pascal_voc boxes in memory. Returns the augmented BGR image, the boxes still
+    in the image and their object ids, the positions in boxes (and in the annotation file) they came from."""
+    if transform is None:
+        transform = get_transform()
+    seed_transform(transform, seed)
+
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    transformed = transform(image=image, bboxes=boxes, object_ids=list(range(len(boxes))))
+    object_ids = [int(object_id) for object_id in transformed['object_ids']]
+    return cv2.cvtColor(transformed['image'], cv2.COLOR_RGB2BGR), transformed['bboxes'], object_ids
+
+def get_writer():
+    return ImageWriter(output_format, output_quality)
+
+def load_task(task):
+    """Read the source image and boxes of a task"""
+    image_path, xml_path, save_dir, prefix, iteration = task
+    profiler = get_profiler()
+    with profiler.stage('decode'):
+        image = read_image(image_path)
+    profiler.read_file(image_path)
+    with profiler.stage('xml_read'):
+        boxes = read_xml(xml_path)
+    return image, boxes
+
+def augment_loaded(task, image, boxes, transform=None, writer=None):
+    """Augment a task whose image and boxes were read with load_task, and write the results"""
+    image_path, xml_path, save_dir, prefix, iteration = task
+    writer = writer or get_writer()
+    profiler = get_profiler()
 
+    # augmentation
+    unique_seed = stable_seed(image_path, iteration)
+    with profiler.stage('augment'):
+        transformed_image, transformed_bboxes, object_ids = augment_sample(image, boxes, unique_seed, transform)
+
+    img_save_path, xml_save_path = task_outputs(task, writer)
+
+    with profiler.stage('encode'):
+        writer.write(img_save_path, transformed_image)
+    with profiler.stage('xml_write'):
+        write_xml(transformed_bboxes, xml_path, xml_save_path, os.path.basename(img_save_path), object_ids)
+
+def augment_image(image_path, xml_path, save_dir, prefix, iteration, transform=None, writer=None):
+    task = (image_path, xml_path, save_dir, prefix, iteration)
+    augment_loaded(task, *load_task(task), transform, writer)
+
+def init_worker():
+    # one process per core already, so keep OpenCV from spawning its own threads in every worker
+    cv2.setNumThreads(1)
+    get_transform()
 
-    ], bbox_params=A.BboxParams(format='pascal_voc', label_fields=[]))
+def _augment_chunk(items):
+    for task, _ in items:
+        augment_image(*task)
+    # runs in a worker process, its timings go back to the main process with the result
+    snapshot = get_profiler().snapshot(reset=True)
+    snapshot['frames'] = len(items)
+    return snapshot
 
-    transformed = transform(image=image, bboxes=boxes)
-    transformed_image = transformed['image']
-    transformed_bboxes = transformed['bboxes']
-    transformed_image = cv2.cvtColor(transformed_image, cv2.COLOR_RGB2BGR)
+def iter_tasks(image_dir, xml_dir, save_dir, copies):
+    """Yield the tasks for every image in image_dir as os.scandir finds them, copies per image"""
+    for image_path in scan_images(image_dir):
+        img_file = os.path.basename(image_path)
+        xml_path = os.path.join(xml_dir, os.path.splitext(img_file)[0] + '.xml')
+        for i in range(copies):
+            yield (image_path, xml_path, save_dir, f"aug_{i}", i)
 
-    img_save_path = os.path.join(save_dir, 'images', f"{prefix}_{os.path.basename(image_path)}")
-    xml_save_path = os.path.join(save_dir, 'annotations', f"{prefix}_{os.path.basename(xml_path)}")
+def build_tasks(image_dir, xml_dir, save_dir, copies):
+    # sorted so the task list, and therefore the chunking, doesn't depend on the filesystem order
+    return sorted(iter_tasks(image_dir, xml_dir, save_dir, copies), key=lambda task: (task[0], task[4]))
 
-    cv2.imwrite(img_save_path, transformed_image)
-    write_xml(transformed_bboxes, xml_path, xml_save_path)
+def task_outputs(task, writer=None):
+    image_path, xml_path, save_dir, prefix, iteration = task
+    writer = writer or get_writer()
+    return (writer.output_name(os.path.join(save_dir, 'images', f"{prefix}_{os.path.basename(image_path)}")),
+            os.path.join(save_dir, 'annotations', f"{prefix}_{os.path.basename(xml_path)}"))
 
-def main():
-    # TODO: Set the paths, image_dir and xml_dir are original images and annotations, save_dir is the directory to save augmented images and annotations
-    image_dir ='compressed/banana_white_desk.mp4/frames_128 x 128'
-    xml_dir = 'compressed/banana_white_desk.mp4/annotations_128 x 128'
-    save_dir = 'augmented/banana_white_desk'
+def task_key(manifest, task):
+    image_path, xml_path, save_dir, prefix, iteration = task
+    return manifest.make_key('augment', transform_version, manifest.input_digest(image_path),
+                             manifest.input_digest(xml_path), prefix, iteration, stable_seed(image_path, iteration),
+                             *get_writer().key_parts())
 
+def augment_batch(image_dir, xml_dir, save_dir, copies=3, workers=None, chunksize=64, manifest=None, max_pending=None):
+    """Augment every image in image_dir across a process pool.
+    The folder is streamed with os.scandir and tasks are submitted in chunks as they are found, with at most
+    max_pending chunks in flight (default two per worker), so memory doesn't grow with the folder size.
+    With workers=1 the images are read on a thread ahead of the augmentation instead.
+    Every task is seeded from its own file name and iteration, so the output is identical for any worker count.
+    With a BuildManifest, copies whose inputs and parameters are unchanged are skipped."""
     os.makedirs(os.path.join(save_dir, 'images'), exist_ok=True)
     os.makedirs(os.path.join(save_dir, 'annotations'), exist_ok=True)
 
-    images = os.listdir(image_dir)
-    for img_file in images:
-        image_path = os.path.join(image_dir, img_file)
-        xml_file = img_file.replace('.png', '.xml')
-        xml_path = os.path.join(xml_dir, xml_file)
+    def stale_tasks():
+        for task in iter_tasks(image_dir, xml_dir, save_dir, copies):
+            key = None
+            if manifest is not None:
+                key = task_key(manifest, task)
+                if manifest.is_fresh(key, *task_outputs(task)):
+                    continue
+            yield task, key
+
+    profiler = get_profiler()
+    profiler.reset_progress()
+    count = 0
+    if workers == 1:
+        for (task, key), (image, boxes) in prefetch(stale_tasks(), lambda item: load_task(item[0])):
+            augment_loaded(task, image, boxes)
+            if manifest is not None:
+                manifest.record(key, *task_outputs(task))
+            profiler.add_frames()
+            count += 1
+    else:
+        max_pending = max_pending or 2 * (workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            for items, snapshot in bounded_map(executor, _augment_chunk, chunked(stale_tasks(), chunksize), max_pending):
+                profiler.merge(snapshot)
+                if manifest is not None:
+                    for task, key in items:
+                        manifest.record(key, *task_outputs(task))
+                count += len(items)
+    return count
+
+def replay_geometry(task, width, height, boxes=(), transform=None):
+    """Recover the matrix a task's augmentation applied to its boxes, and the output image size, from the task's
+    seed alone. The random parameters depend on neither the pixels nor the boxes, so a blank image of the source
+    size with reference boxes replays them. The matrix is None if a reference box was dropped.
+    boxes (the task's source boxes) go through the replay as well, duplicated is True when the transform returned
+    any box more than once (reflected copies). The matrix comes from the first copy of each reference box."""
+    image_path, xml_path, save_dir, prefix, iteration = task
+    blank = np.zeros((int(height), int(width), 3), dtype=np.uint8)
+    replay_boxes = reference_boxes(width, height).tolist() + [list(box) for box in boxes]
+    image, replayed_boxes, object_ids = augment_sample(blank, replay_boxes, stable_seed(image_path, iteration), transform)
+    size = (image.shape[1], image.shape[0])
+    first_boxes = first_per_object(replayed_boxes, object_ids)
+    duplicated = len(first_boxes) < len(object_ids)
+    if not all(i in first_boxes for i in range(3)):
+        return None, size, duplicated
+    centers = box_centers(np.asarray([first_boxes[i] for i in range(3)], dtype=np.float64))
+    return fit_affine(reference_points(width, height), centers), size, duplicated
+
+def _replay_task(item):
+    return replay_geometry(*item)
+
+def verify_augmented(image_dir, xml_dir, save_dir, copies=3, tolerance=0.5, workers=None, chunksize=64):
+    """Check every augmented annotation in save_dir against its source annotation transformed with
+    box_geometry, all boxes of the set at once. Returns a list of (annotation, kind, value) issues:
+      replay  the transform's matrix couldn't be recovered, the file isn't checked
+      count   the number of boxes differs from the number expected to stay in the image, or the transform
+              returns copies of boxes (reflected borders), so they can't be matched to the geometry
+      label   a box's label differs from the expected object at its position
+      box     a box differs from the expected one by more than tolerance pixels"""
+    tasks = [task for task in build_tasks(image_dir, xml_dir, save_dir, copies)
+             if os.path.exists(task[1]) and os.path.exists(task_outputs(task)[1])]
+    source_files = sorted({task[1] for task in tasks})
+    source = collect_boxes(source_files, workers)
+    output = collect_boxes([task_outputs(task)[1] for task in tasks], workers)
 
-        # create three augmented images for each image, change the range to create more
-        for i in range(3):
-            augment_image(image_path, xml_path, save_dir, f"aug_{i}", i)
-            print(f"Augmented {i}: {img_file}")
+    # source rows of every task, the rows of one file are contiguous and in document order
+    file_index = {path: i for i, path in enumerate(source_files)}
+    task_files = np.array([file_index[task[1]] for task in tasks], dtype=np.int64)
+    file_counts = np.bincount(source['file_id'], minlength=len(source_files))
+    file_starts = np.concatenate([[0], np.cumsum(file_counts)[:-1]]).astype(np.int64)
+    task_counts = file_counts[task_files]
+    row_task = np.repeat(np.arange(len(tasks)), task_counts)
+    task_starts = np.concatenate([[0], np.cumsum(task_counts)[:-1]]).astype(np.int64)
+    rows = file_starts[task_files][row_task] + np.arange(len(row_task)) - task_starts[row_task]
+
+    # only tasks with boxes need their geometry, the image size comes from the annotation
+    matrices = np.tile(np.eye(3), (len(tasks), 1, 1))
+    sizes = np.zeros((len(tasks), 2))
+    replayed = np.ones(len(tasks), dtype=bool)
+    with_boxes = np.flatnonzero(task_counts > 0)
+    source_boxes = np.stack([source['xmin'], source['ymin'], source['xmax'], source['ymax']], axis=1)
+    items = []
+    for t in with_boxes:
+        start = file_starts[task_files[t]]
+        items.append((tasks[t], source['image_width'][start], source['image_height'][start],
+                      source_boxes[start:start + task_counts[t]].tolist()))
+    if workers == 1:
+        results = [_replay_task(item) for item in items]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            results = list(executor.map(_replay_task, items, chunksize=chunksize))
+    duplicated = np.zeros(len(tasks), dtype=bool)
+    for t, (matrix, size, task_duplicated) in zip(with_boxes, results):
+        sizes[t] = size
+        duplicated[t] = task_duplicated
+        if matrix is None:
+            replayed[t] = False
+        else:
+            matrices[t] = matrix
+
+    source_labels = np.array(source['labels'], dtype=str)[source['label_id']]
+    output_labels = np.array(output['labels'], dtype=str)[output['label_id']]
+    output_boxes = np.stack([output['xmin'], output['ymin'], output['xmax'], output['ymax']], axis=1)
+    expected = apply_transform(source_boxes[rows], matrices[row_task], sizes[row_task, 0], sizes[row_task, 1],
+                               source_labels[rows], row_task)
+
+    # the object ids of the expected boxes are their task numbers, the file ids of the output boxes too
+    expected_counts = np.bincount(expected['object_ids'], minlength=len(tasks))
+    output_counts = np.bincount(output['file_id'], minlength=len(tasks))
+    # a transform that returns boxes more than once can't match the geometry, whatever was written for them
+    matching = replayed & ~duplicated & (expected_counts == output_counts)
+    expected_rows = matching[expected['object_ids']]
+    output_rows = matching[output['file_id']]
+    row_tasks = output['file_id'][output_rows]
+    wrong_label = expected['labels'][expected_rows] != output_labels[output_rows]
+    error, wrong_box = compare_boxes(expected['boxes'][expected_rows], output_boxes[output_rows], tolerance)
+
+    names = [task_outputs(task)[1] for task in tasks]
+    issues = [(names[t], 'replay', '') for t in np.flatnonzero(~replayed)]
+    issues.extend((names[t], 'count', f"{output_counts[t]} boxes, expected {expected_counts[t]}"
+                                      + (", the transform returns duplicate boxes" if duplicated[t] else ""))
+                  for t in np.flatnonzero(replayed & ~matching))
+    issues.extend((names[t], 'label', label) for t, label in zip(row_tasks[wrong_label], output_labels[output_rows][wrong_label]))
+    issues.extend((names[t], 'box', round(float(value), 2)) for t, value in zip(row_tasks[wrong_box], error[wrong_box]))
+    return issues
+
+# TODO: Set the paths, image_dir and xml_dir are original images and annotations, save_dir is the directory to save augmented images and annotations
+image_dir = 'compressed/banana_white_desk.mp4/frames_128 x 128'
+xml_dir = 'compressed/banana_white_desk.mp4/annotations_128 x 128'
+save_dir = 'augmented/banana_white_desk'
+# augmented images for each image, change copies to create more
+copies = 3
+
+def main(workers=None, incremental=True):
+    profiler = start_run('augmentation')
+
+    # only augment copies whose source image, annotation or transform changed, see build_cache.py
+    manifest = BuildManifest(manifest_path_for(save_dir)) if incremental else None
+
+    count = augment_batch(image_dir, xml_dir, save_dir, copies=copies, workers=workers, manifest=manifest)
+    if manifest is not None:
+        manifest.finish()
+    print(f"Augmented {count} images into {save_dir}")
+    profiler.finish('reports/augmentation.json')
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Augment images and their Pascal VOC annotations")
+    parser.add_argument("--workers", type=int, help="Worker processes, default one per core")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the augmented annotations against their sources instead of augmenting")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Largest box difference in pixels for --verify")
+    args = parser.parse_args()
+
+    if args.verify:
+        issues = verify_augmented(image_dir, xml_dir, save_dir, copies, args.tolerance, args.workers)
+        for name, kind, value in issues:
+            print(f"{kind:<6} {name} {value}")
+        print(f"{len(issues)} issues in {save_dir}")
+    else:
+        main(args.workers)
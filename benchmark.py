@@ -0,0 +1,426 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+from contextlib import redirect_stdout
+import cv2
+import numpy as np
+from cvat_reader import load_index
+from crop_resize import CropJob, crop_resize_images
+from frame_extractor import extract_frames
+from augmentation import augment_image
+from cam_effect import apply_ov2640_effect
+from pascal_voc import write_pascal_voc, append_object_to_pascal_voc, PascalVocWriter
+from calc_bbox_area import collect_boxes, compute_statistics
+from profiling import start_run
+
+# Reproducible benchmarks for the pipeline stages. A synthetic full-HD video with moving fruit-coloured ellipses
+# is generated together with a track-style CVAT file (like annotations/annotations_train.xml), plus a folder
+# of still images with an image-style CVAT file (like annotations/annotations_test.xml). Everything is drawn
+# from a seeded generator and runs offline on the CPU, so two runs with the same settings time the same work.
+# Each stage is run --repeat times, the median is compared against a stored baseline in benchmarks/<name>.json.
+
+labels = ('orange', 'apple', 'banana')
+label_colors = {'orange': (0, 140, 255), 'apple': (40, 40, 200), 'banana': (60, 220, 240)}  # BGR
+video_size = (1920, 1080)
+test_image_size = (1280, 960)
+target_sizes = [(128, 128)]
+baseline_dir = 'benchmarks'
+work_dir = 'benchmarks/work'
+report_path = 'reports/benchmark.json'
+# a stage counts as regressed when its median time per item is this much slower than the baseline
+regression_tolerance = 0.15
+# keyframe interval of the CVAT tracks, the boxes in between are interpolated by CVAT on export
+keyframe_interval = 10
+
+
+def _background(rng, width, height):
+    # smooth gradient plus fixed noise, so frames compress like camera footage instead of flat colour
+    gradient = np.linspace(60, 180, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    noise = rng.normal(0, 8, (height, width, 3)).astype(np.float32)
+    return np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+
+def _random_objects(rng, count, width, height):
+    """Random start positions, velocities, sizes and labels for count objects.
+    Positions span the whole frame, so some objects fall outside the center crop of the full-HD video and the
+    crop stages drop their boxes, the same as with real footage."""
+    short_side = min(width, height)
+    sizes = rng.uniform(0.08, 0.25, (count, 2)) * short_side
+    positions = rng.uniform(0, 1, (count, 2)) * (np.array([width, height]) - sizes)
+    velocities = rng.uniform(-0.01, 0.01, (count, 2)) * short_side
+    object_labels = [labels[i] for i in rng.integers(0, len(labels), count)]
+    return positions, velocities, sizes, object_labels
+
+
+def _draw(image, boxes, object_labels):
+    for (xtl, ytl, xbr, ybr), label in zip(boxes, object_labels):
+        center = (int((xtl + xbr) / 2), int((ytl + ybr) / 2))
+        axes = (int((xbr - xtl) / 2), int((ybr - ytl) / 2))
+        cv2.ellipse(image, center, axes, 0, 0, 360, label_colors[label], -1)
+
+
+def _xml_header(mode, size):
+    label_xml = ''.join(f'''        <label>
+          <name>{label}</name>
+          <type>any</type>
+          <attributes>
+          </attributes>
+        </label>
+''' for label in labels)
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<annotations>
+  <version>1.1</version>
+  <meta>
+    <job>
+      <size>{size}</size>
+      <mode>{mode}</mode>
+      <labels>
+{label_xml}      </labels>
+    </job>
+  </meta>
+'''
+
+
+def make_video(path, xml_path, frames, objects, seed=0, size=video_size, fps=30):
+    """Write a synthetic video of frames frames with objects moving ellipses and its track-style CVAT file.
+    Returns the path of the video, which is an .avi if the mp4 encoder is not available."""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    background = _background(rng, width, height)
+    positions, velocities, sizes, object_labels = _random_objects(rng, objects, width, height)
+    limits = np.array([width, height]) - sizes
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    if not writer.isOpened():
+        # OpenCV builds without FFmpeg can still write Motion JPEG
+        path = os.path.splitext(path)[0] + '.avi'
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+
+    tracks = [[] for _ in range(objects)]
+    for frame_num in range(frames):
+        boxes = np.concatenate([positions, positions + sizes], axis=1)
+        frame = background.copy()
+        _draw(frame, boxes, object_labels)
+        writer.write(frame)
+        for track, box in zip(tracks, boxes):
+            track.append((frame_num, box))
+
+        # objects bounce off the borders
+        positions += velocities
+        bounced = (positions < 0) | (positions > limits)
+        velocities[bounced] *= -1
+        np.clip(positions, 0, limits, out=positions)
+    writer.release()
+
+    with open(xml_path, 'w') as f:
+        f.write(_xml_header('interpolation', frames))
+        for track_id, (track, label) in enumerate(zip(tracks, object_labels)):
+            f.write(f'  <track id="{track_id}" label="{label}" source="manual">\n')
+            for frame_num, (xtl, ytl, xbr, ybr) in track:
+                keyframe = int(frame_num % keyframe_interval == 0)
+                f.write(f'    <box frame="{frame_num}" keyframe="{keyframe}" outside="0" occluded="0" '
+                        f'xtl="{xtl:.2f}" ytl="{ytl:.2f}" xbr="{xbr:.2f}" ybr="{ybr:.2f}" z_order="0">\n    </box>\n')
+            # CVAT closes every track with an outside box after its last frame
+            frame_num, (xtl, ytl, xbr, ybr) = track[-1]
+            if frame_num + 1 < frames:
+                f.write(f'    <box frame="{frame_num + 1}" keyframe="1" outside="1" occluded="0" '
+                        f'xtl="{xtl:.2f}" ytl="{ytl:.2f}" xbr="{xbr:.2f}" ybr="{ybr:.2f}" z_order="0">\n    </box>\n')
+            f.write('  </track>\n')
+        f.write('</annotations>\n')
+    return path
+
+
+def make_images(image_dir, xml_path, count, objects, seed=0, size=test_image_size):
+    """Write count synthetic JPEG images with objects ellipses each and their image-style CVAT file"""
+    os.makedirs(image_dir, exist_ok=True)
+    width, height = size
+    rng = np.random.default_rng(seed)
+    background = _background(rng, width, height)
+
+    with open(xml_path, 'w') as f:
+        f.write(_xml_header('annotation', count))
+        for image_id in range(count):
+            positions, _, sizes, object_labels = _random_objects(rng, objects, width, height)
+            boxes = np.concatenate([positions, positions + sizes], axis=1)
+            image = background.copy()
+            _draw(image, boxes, object_labels)
+            name = f'synthetic_{image_id:05d}.jpg'
+            cv2.imwrite(os.path.join(image_dir, name), image)
+
+            f.write(f'  <image id="{image_id}" name="{name}" width="{width}" height="{height}">\n')
+            for (xtl, ytl, xbr, ybr), label in zip(boxes, object_labels):
+                f.write(f'    <box label="{label}" source="manual" occluded="0" '
+                        f'xtl="{xtl:.2f}" ytl="{ytl:.2f}" xbr="{xbr:.2f}" ybr="{ybr:.2f}" z_order="0">\n    </box>\n')
+            f.write('  </image>\n')
+        f.write('</annotations>\n')
+
+
+def prepare_data(directory, settings):
+    """Generate the synthetic inputs into directory, reusing them if they were made with the same settings"""
+    settings_path = os.path.join(directory, 'settings.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            data = json.load(f)
+        if data['settings'] == settings:
+            return data
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    print(f"Generating synthetic data into {directory}")
+    video_path = make_video(os.path.join(directory, 'synthetic.mp4'), os.path.join(directory, 'synthetic_track.xml'),
+                            settings['frames'], settings['objects'], settings['seed'])
+    make_images(os.path.join(directory, 'images'), os.path.join(directory, 'synthetic_images.xml'),
+                settings['images'], settings['objects'], settings['seed'] + 1)
+
+    data = {'settings': settings, 'video_path': video_path,
+            'track_xml': os.path.join(directory, 'synthetic_track.xml'),
+            'image_dir': os.path.join(directory, 'images'),
+            'image_xml': os.path.join(directory, 'synthetic_images.xml')}
+    with open(settings_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+def _fresh_dir(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
+def time_stage(name, run, setup=None, repeat=3):
+    """Run setup() and then time run() repeat times. run returns the number of items it processed.
+    The sub-stages recorded by profiling.py during the fastest run are kept as a breakdown."""
+    runs = []
+    best_stages = None
+    items = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        # no progress lines, they would end up in the timings
+        profiler = start_run(name, interval=float('inf'))
+        start = time.perf_counter()
+        items = run()
+        elapsed = time.perf_counter() - start
+        if not runs or elapsed < min(runs):
+            best_stages = profiler.report()['stages']
+        runs.append(elapsed)
+
+    median = statistics.median(runs)
+    return {'items': items, 'runs': [round(seconds, 6) for seconds in runs], 'median_seconds': round(median, 6),
+            'ms_per_item': round(median / items * 1000, 4) if items else 0.0,
+            'items_per_second': round(items / median, 3) if median else 0.0, 'stages': best_stages}
+
+
+def run_benchmarks(data, directory, repeat=3, stages=None):
+    """Time every pipeline stage on the synthetic data, each stage reads the output of the one before"""
+    frames_dir = os.path.join(directory, 'out', 'frames')
+    crop_image_dirs = {target: os.path.join(directory, 'out', f'frames_{target[0]} x {target[1]}') for target in target_sizes}
+    crop_xml_dirs = {target: os.path.join(directory, 'out', f'annotations_{target[0]} x {target[1]}') for target in target_sizes}
+    test_image_dirs = {target: os.path.join(directory, 'out', f'test_frames_{target[0]} x {target[1]}') for target in target_sizes}
+    test_xml_dirs = {target: os.path.join(directory, 'out', f'test_annotations_{target[0]} x {target[1]}') for target in target_sizes}
+    augmented_dir = os.path.join(directory, 'out', 'augmented')
+    voc_dir = os.path.join(directory, 'out', 'voc')
+    first_target = target_sizes[0]
+
+    track_index = load_index(data['track_xml'], use_cache=False)
+    image_index = load_index(data['image_xml'], use_cache=False)
+
+    def extract():
+        frame_numbers = track_index.frame_numbers(labels=labels)
+        extract_frames(data['video_path'], frame_numbers, frames_dir)
+        return len(set(frame_numbers))
+
+    def crop_video():
+        jobs = []
+        for frame_num, boxes in track_index.items(labels=labels, include_outside=False):
+            image_path = os.path.join(frames_dir, f'frame_{frame_num}.png')
+            if os.path.exists(image_path):
+                jobs.append(CropJob(image_path, f'frame_{frame_num}.png', f'frame_{frame_num}.xml',
+                                    f'frame_{frame_num}.png', [box[0] for box in boxes], [box[1:] for box in boxes]))
+        return crop_resize_images(jobs, target_sizes, crop_image_dirs, crop_xml_dirs)
+
+    def crop_images():
+        jobs = []
+        for frame_num, boxes in image_index.items():
+            file_name = image_index.images[frame_num][0]
+            png_name = os.path.splitext(file_name)[0] + '.png'
+            jobs.append(CropJob(os.path.join(data['image_dir'], file_name), png_name, png_name.replace('.png', '.xml'),
+                                png_name, [box[0] for box in boxes], [box[1:] for box in boxes]))
+        return crop_resize_images(jobs, target_sizes, test_image_dirs, test_xml_dirs)
+
+    def cropped_files():
+        image_dir, xml_dir = crop_image_dirs[first_target], crop_xml_dirs[first_target]
+        return [(os.path.join(image_dir, f), os.path.join(xml_dir, f.replace('.png', '.xml')))
+                for f in sorted(os.listdir(image_dir))]
+
+    def setup_augment():
+        _fresh_dir(os.path.join(augmented_dir, 'images'))
+        _fresh_dir(os.path.join(augmented_dir, 'annotations'))
+
+    def augment():
+        files = cropped_files()
+        for image_path, xml_path in files:
+            augment_image(image_path, xml_path, augmented_dir, 'aug_0', 0)
+        return len(files)
+
+    def cam_effect():
+        files = cropped_files()
+        for image_path, _ in files:
+            apply_ov2640_effect(image_path)
+        return len(files)
+
+    voc_tables = []
+
+    def voc_objects():
+        # the objects of the cropped annotations, parsed once before the first timed writer run
+        if not voc_tables:
+            voc_tables.append(collect_boxes([xml_path for _, xml_path in cropped_files()], workers=1))
+        return voc_tables[0]
+
+    def setup_voc():
+        voc_objects()
+        _fresh_dir(voc_dir)
+
+    def append_voc():
+        table = voc_objects()
+        started = set()
+        # the function prints a line per object, keep that out of the console but inside the timing
+        with redirect_stdout(io.StringIO()):
+            for i, file_id in enumerate(table['file_id']):
+                path = os.path.join(voc_dir, f'{file_id}.xml')
+                box = (table['xmin'][i], table['ymin'][i], table['xmax'][i], table['ymax'][i])
+                label = table['labels'][table['label_id'][i]]
+                if file_id not in started:
+                    write_pascal_voc(path, f'{file_id}.png', label, *first_target, *box)
+                    started.add(file_id)
+                else:
+                    append_object_to_pascal_voc(path, label, *box)
+        return len(table['file_id'])
+
+    def voc_writer():
+        table = voc_objects()
+        writer = PascalVocWriter(voc_dir)
+        for i, file_id in enumerate(table['file_id']):
+            writer.add_object(f'{file_id}.xml', f'{file_id}.png', *first_target, table['labels'][table['label_id'][i]],
+                              table['xmin'][i], table['ymin'][i], table['xmax'][i], table['ymax'][i])
+        writer.flush()
+        return len(table['file_id'])
+
+    def bbox_statistics():
+        xml_dir = crop_xml_dirs[first_target]
+        xml_files = sorted(os.path.join(xml_dir, f) for f in os.listdir(xml_dir) if f.endswith('.xml'))
+        compute_statistics(collect_boxes(xml_files))
+        return len(xml_files)
+
+    # name, run, setup, in pipeline order
+    plan = [
+        ('extract_frames', extract, lambda: _fresh_dir(frames_dir)),
+        ('crop_resize_video', crop_video, lambda: [_fresh_dir(d) for d in list(crop_image_dirs.values()) + list(crop_xml_dirs.values())]),
+        ('crop_resize_images', crop_images, lambda: [_fresh_dir(d) for d in list(test_image_dirs.values()) + list(test_xml_dirs.values())]),
+        ('augment_image', augment, setup_augment),
+        ('apply_ov2640_effect', cam_effect, None),
+        ('append_object_to_pascal_voc', append_voc, setup_voc),
+        ('pascal_voc_writer', voc_writer, setup_voc),
+        ('calc_bbox_area', bbox_statistics, None),
+    ]
+
+    results = {}
+    for name, run, setup in plan:
+        # later stages need the outputs of earlier ones, so skipped stages still run once, untimed
+        if stages and name not in stages:
+            if setup is not None:
+                setup()
+            with redirect_stdout(io.StringIO()):
+                run()
+            continue
+        results[name] = time_stage(name, run, setup, repeat)
+        print(f"{name:<28} {results[name]['median_seconds']:9.3f}s  {results[name]['ms_per_item']:9.3f} ms/item  "
+              f"({results[name]['items']} items)")
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'opencv': cv2.__version__, 'numpy': np.__version__,
+            'opencv_threads': cv2.getNumThreads()}
+
+
+def compare(results, baseline, tolerance=regression_tolerance):
+    """Compare ms per item against the baseline, returns the names of the stages that got slower than tolerance"""
+    regressions = []
+    print(f"\n{'stage':<28} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None or not previous['ms_per_item']:
+            print(f"{name:<28} {'-':>12} {result['ms_per_item']:>9.3f} ms {'new':>8}")
+            continue
+        change = result['ms_per_item'] / previous['ms_per_item'] - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<28} {previous['ms_per_item']:>9.3f} ms {result['ms_per_item']:>9.3f} ms {change * 100:>+7.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic videos and CVAT annotations")
+    parser.add_argument("--frames", type=int, default=120, help="Number of frames of the synthetic full-HD video")
+    parser.add_argument("--objects", type=int, default=3, help="Number of objects per frame / image")
+    parser.add_argument("--images", type=int, default=60, help="Number of images in the image-style test set")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage, the median is reported")
+    parser.add_argument("--stages", nargs="+", help="Only time these stages")
+    parser.add_argument("--threads", type=int, default=None, help="cv2.setNumThreads, e.g. 1 for steadier numbers")
+    parser.add_argument("--workdir", default=work_dir)
+    parser.add_argument("--save-baseline", metavar="NAME", help=f"Store the results as {baseline_dir}/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help=f"Compare against {baseline_dir}/NAME.json, exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=regression_tolerance)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    settings = {'frames': args.frames, 'objects': args.objects, 'images': args.images, 'seed': args.seed,
+                'video_size': list(video_size), 'test_image_size': list(test_image_size)}
+    baseline = None
+    if args.compare:
+        with open(os.path.join(baseline_dir, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        # timings of different workloads can't be compared
+        if baseline['settings'] != settings:
+            parser.error(f"baseline {args.compare} was recorded with {baseline['settings']}, run with the same settings")
+
+    data = prepare_data(args.workdir, settings)
+    results = run_benchmarks(data, args.workdir, args.repeat, args.stages)
+    report = {'settings': settings, 'environment': environment(), 'repeat': args.repeat,
+              'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(baseline_dir, exist_ok=True)
+        with open(os.path.join(baseline_dir, f'{args.save_baseline}.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline {args.save_baseline}")
+
+    if baseline is not None:
+        if baseline['environment'] != report['environment']:
+            print("Warning: the baseline was recorded on a different machine or library version")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed by more than {args.tolerance * 100:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
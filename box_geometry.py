@@ -0,0 +1,182 @@
+import numpy as np
+
+# Batched bounding box geometry. Every transform is a 3x3 affine matrix acting on (x, y, 1) column vectors,
+# either one matrix shared by all boxes or an (N, 3, 3) stack with one matrix per box, so boxes of many images
+# with different transforms go through in one call. Boxes are (N, 4) float arrays of xtl, ytl, xbr, ybr in
+# pixels, with the Pascal VOC / albumentations convention that a box spanning the whole image is
+# (0, 0, width, height). Flips therefore map x to width - x.
+#
+# Matrix builders take scalars or arrays (one value per box) and broadcast like NumPy does. compose() chains
+# them, the first matrix is applied first:
+#   compose(hflip_matrix(w), rotate_matrix(angle, w, h), crop_matrix(x0, y0, x1, y1, 128, 128))
+
+
+def _affine(a, b, tx, c, d, ty):
+    """Matrices [[a, b, tx], [c, d, ty], [0, 0, 1]], one per element of the broadcast arguments"""
+    values = np.broadcast_arrays(*(np.asarray(value, dtype=np.float64) for value in (a, b, tx, c, d, ty)))
+    matrix = np.zeros(values[0].shape + (3, 3), dtype=np.float64)
+    matrix[..., 0, 0], matrix[..., 0, 1], matrix[..., 0, 2] = values[0], values[1], values[2]
+    matrix[..., 1, 0], matrix[..., 1, 1], matrix[..., 1, 2] = values[3], values[4], values[5]
+    matrix[..., 2, 2] = 1.0
+    return matrix
+
+
+def translate_matrix(dx, dy):
+    return _affine(1, 0, dx, 0, 1, dy)
+
+
+def scale_matrix(sx, sy):
+    return _affine(sx, 0, 0, 0, sy, 0)
+
+
+def hflip_matrix(width):
+    return _affine(-1, 0, width, 0, 1, 0)
+
+
+def vflip_matrix(height):
+    return _affine(1, 0, 0, 0, -1, height)
+
+
+def rotate_matrix(angle, width, height):
+    """Rotation by angle degrees counter-clockwise around the image center, like cv2.getRotationMatrix2D"""
+    radians = np.deg2rad(angle)
+    cos, sin = np.cos(radians), np.sin(radians)
+    cx, cy = np.asarray(width, dtype=np.float64) / 2, np.asarray(height, dtype=np.float64) / 2
+    return _affine(cos, sin, (1 - cos) * cx - sin * cy, -sin, cos, sin * cx + (1 - cos) * cy)
+
+
+def crop_matrix(x_min, y_min, x_max, y_max, width=None, height=None):
+    """Crop the region x_min, y_min, x_max, y_max and resize it to width x height (default: the crop size)"""
+    x_min, y_min = np.asarray(x_min, dtype=np.float64), np.asarray(y_min, dtype=np.float64)
+    sx = 1.0 if width is None else width / (np.asarray(x_max, dtype=np.float64) - x_min)
+    sy = 1.0 if height is None else height / (np.asarray(y_max, dtype=np.float64) - y_min)
+    return _affine(sx, 0, -x_min * sx, 0, sy, -y_min * sy)
+
+
+def pad_matrix(left, top):
+    return translate_matrix(left, top)
+
+
+def fit_matrix(width, height, target_width, target_height):
+    """Resize the shortest axis to the target and center crop the longer one, as crop_resize.fit_shortest_axis does"""
+    width, height = np.asarray(width, dtype=np.float64), np.asarray(height, dtype=np.float64)
+    ratio = np.maximum(target_width / width, target_height / height)
+    start_x = (np.maximum(target_width, np.floor(width * ratio)) - target_width) // 2
+    start_y = (np.maximum(target_height, np.floor(height * ratio)) - target_height) // 2
+    return _affine(ratio, 0, -start_x, 0, ratio, -start_y)
+
+
+def letterbox_matrix(width, height, target_width, target_height):
+    """Resize the longest axis to the target and pad the shorter one equally on both sides"""
+    width, height = np.asarray(width, dtype=np.float64), np.asarray(height, dtype=np.float64)
+    ratio = np.minimum(target_width / width, target_height / height)
+    left = (target_width - np.floor(width * ratio)) // 2
+    top = (target_height - np.floor(height * ratio)) // 2
+    return _affine(ratio, 0, left, 0, ratio, top)
+
+
+def compose(*matrices):
+    """Chain matrices, the first one is applied first. Stacks of per-box matrices broadcast against single ones."""
+    result = np.eye(3)
+    for matrix in matrices:
+        result = np.matmul(matrix, result)
+    return result
+
+
+def transform_points(points, matrix):
+    """Apply matrix to (..., 2) points, matrix is (3, 3) or one matrix per leading index of points"""
+    points = np.asarray(points, dtype=np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    linear = matrix[..., :2, :2]
+    offset = matrix[..., :2, 2]
+    if matrix.ndim == 3:
+        # one matrix per row of points, broadcast over the points of that row
+        linear = linear.reshape(linear.shape[:1] + (1,) * (points.ndim - 2) + (2, 2))
+        offset = offset.reshape(offset.shape[:1] + (1,) * (points.ndim - 2) + (2,))
+    return np.einsum('...ij,...j->...i', linear, points) + offset
+
+
+def box_corners(boxes):
+    """(N, 4, 2) corners of (N, 4) boxes"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    xtl, ytl, xbr, ybr = boxes.T
+    return np.stack([np.stack([xtl, ytl], axis=1), np.stack([xbr, ytl], axis=1),
+                     np.stack([xtl, ybr], axis=1), np.stack([xbr, ybr], axis=1)], axis=1)
+
+
+def transform_boxes(boxes, matrix):
+    """Transform (N, 4) boxes, each becomes the axis aligned box around its transformed corners.
+    Rotated boxes grow this way, which is what albumentations does by default ('largest_box')."""
+    corners = transform_points(box_corners(boxes), matrix)
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+def box_areas(boxes):
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def clip_boxes(boxes, width, height):
+    """Clip (N, 4) boxes to images of width x height, which may be one value per box"""
+    width = np.broadcast_to(np.asarray(width, dtype=np.float64), boxes.shape[:1])
+    height = np.broadcast_to(np.asarray(height, dtype=np.float64), boxes.shape[:1])
+    limits = np.stack([width, height, width, height], axis=1)
+    return np.clip(boxes, 0, limits)
+
+
+def apply_transform(boxes, matrix, width, height, labels=None, object_ids=None, min_visibility=0.0):
+    """Transform boxes into an image of width x height, clip them and drop those that end up outside it.
+    Boxes are kept when the part inside the image is more than min_visibility of the transformed box, like
+    albumentations' BboxParams. labels and object_ids (default: the row numbers) are filtered along with the
+    boxes, so the result says which boxes were dropped. Returns a dict of boxes, labels, object_ids and kept,
+    the boolean mask of the input rows that were kept."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    object_ids = np.arange(len(boxes)) if object_ids is None else np.asarray(object_ids)
+    transformed = transform_boxes(boxes, matrix)
+    clipped = clip_boxes(transformed, width, height)
+
+    area = box_areas(transformed)
+    visible = np.divide(box_areas(clipped), area, out=np.zeros_like(area), where=area > 0)
+    kept = visible > min_visibility
+    return {
+        'boxes': clipped[kept],
+        'labels': None if labels is None else np.asarray(labels)[kept],
+        'object_ids': object_ids[kept],
+        'kept': kept,
+    }
+
+
+def fit_affine(source_points, target_points):
+    """Matrices mapping three (..., 3, 2) source points onto the target points, batched over the leading axes"""
+    source_points = np.asarray(source_points, dtype=np.float64)
+    source = np.concatenate([source_points, np.ones(source_points.shape[:-1] + (1,))], axis=-1)
+    solution = np.linalg.solve(source, np.asarray(target_points, dtype=np.float64))
+    matrix = np.zeros(source.shape[:-2] + (3, 3), dtype=np.float64)
+    matrix[..., :2, :] = np.swapaxes(solution, -1, -2)
+    matrix[..., 2, 2] = 1.0
+    return matrix
+
+
+def reference_points(width, height):
+    """Three points around the image center, far enough from the border to survive flips, small rotations and crops"""
+    cx, cy = width / 2, height / 2
+    dx, dy = width / 8, height / 8
+    return np.array([[cx - dx, cy - dy], [cx + dx, cy - dy], [cx - dx, cy + dy]], dtype=np.float64)
+
+
+def reference_boxes(width, height, size=2.0):
+    """Small boxes centered on reference_points(). A transformed box keeps its center on the transformed point,
+    so passing these through a box pipeline recovers the matrix it applied with fit_affine and box_centers."""
+    points = reference_points(width, height)
+    return np.concatenate([points - size / 2, points + size / 2], axis=1)
+
+
+def box_centers(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return (boxes[:, :2] + boxes[:, 2:]) / 2
+
+
+def compare_boxes(expected, actual, tolerance=0.5):
+    """Largest coordinate difference of every row of two (N, 4) arrays, and the mask of rows above tolerance"""
+    difference = np.abs(np.asarray(expected, dtype=np.float64) - np.asarray(actual, dtype=np.float64)).reshape(-1, 4)
+    error = difference.max(axis=1) if len(difference) else np.zeros(0)
+    return error, error > tolerance
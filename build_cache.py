@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+
+# Incremental builds for the preprocessing stages. Each stage keeps a manifest of the outputs it produced,
+# keyed by a hash of everything the output depends on: the content of its input files, the annotation
+# boxes and the stage parameters. Outputs whose key is unchanged are skipped, and outputs from a previous
+# run that were not produced or confirmed by this one are deleted as stale.
+# Outputs that a later step removes on purpose (frames pruned by remove_frames.py) are moved to a pruned list
+# with mark_pruned(). They count as fresh while they stay missing, so the stage doesn't rebuild them every run.
+
+manifest_version = 1
+
+
+def manifest_path_for(output_dir):
+    # the manifest sits next to the output directory, not inside it, so it never shows up in directory listings
+    output_dir = os.path.normpath(output_dir)
+    return os.path.join(os.path.dirname(output_dir), f'.manifest-{os.path.basename(output_dir)}.json')
+
+
+def _to_json(value):
+    # numpy arrays and scalars, without importing numpy here
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class BuildManifest:
+    """Tracks output -> input key for one stage output directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}  # output path -> key, from the previous run
+        self.inputs = {}  # input path -> [size, mtime_ns, digest], so unchanged inputs aren't re-hashed
+        self.current = {}  # outputs produced or confirmed fresh in this run
+        self.current_inputs = {}
+        self.pruned = {}  # output -> key, outputs removed on purpose after they were built
+        self.current_pruned = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('version') == manifest_version:
+                self.outputs = state['outputs']
+                self.inputs = state['inputs']
+                self.pruned = state.get('pruned', {})
+
+    def input_digest(self, path, content=True):
+        """Hash of an input file. With content=False only size and mtime are used, for inputs like videos
+        that are too large to hash on every change."""
+        stat = os.stat(path)
+        cached = self.inputs.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            self.current_inputs[path] = cached
+            return cached[2]
+
+        if content:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            digest = digest.hexdigest()
+        else:
+            digest = f'{stat.st_size}:{stat.st_mtime_ns}'
+        self.inputs[path] = self.current_inputs[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    @staticmethod
+    def make_key(*parts):
+        encoded = json.dumps(parts, sort_keys=True, default=_to_json).encode('utf-8')
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def _state(self, output, key):
+        if self.outputs.get(output) == key and os.path.exists(output):
+            return 'built'
+        if self.pruned.get(output) == key and not os.path.exists(output):
+            return 'pruned'
+        return None
+
+    def is_fresh(self, key, *outputs):
+        """True if every output exists and was built from the same key, or was pruned after being built from it,
+        in which case they are kept"""
+        states = [self._state(output, key) for output in outputs]
+        if None in states:
+            return False
+        for output, state in zip(outputs, states):
+            if state == 'built':
+                self.current[output] = key
+            else:
+                self.current_pruned[output] = key
+        return True
+
+    def record(self, key, *outputs):
+        for output in outputs:
+            self.current[output] = key
+
+    def collect_garbage(self):
+        """Delete outputs of the previous run that this run neither rebuilt nor confirmed"""
+        removed = 0
+        for output in self.outputs:
+            if output not in self.current and os.path.exists(output):
+                os.remove(output)
+                removed += 1
+        return removed
+
+    def mark_pruned(self, *outputs):
+        """Record outputs of the last run that were removed on purpose and save the manifest right away.
+        Outputs the manifest doesn't know are ignored. Returns the number of outputs marked."""
+        known = {os.path.normpath(output): output for output in self.outputs}
+        marked = 0
+        for output in outputs:
+            output = known.get(os.path.normpath(output))
+            if output is not None:
+                self.pruned[output] = self.outputs.pop(output)
+                marked += 1
+        self._write(self.outputs, self.inputs, self.pruned)
+        return marked
+
+    def save(self):
+        self._write(self.current, self.current_inputs, self.current_pruned)
+
+    def _write(self, outputs, inputs, pruned):
+        state = {'version': manifest_version, 'outputs': outputs, 'inputs': inputs, 'pruned': pruned}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        """Garbage collect stale outputs and save the manifest, call once the stage completed successfully"""
+        removed = self.collect_garbage()
+        self.save()
+        if removed:
+            print(f"Removed {removed} stale outputs")
+        return removed
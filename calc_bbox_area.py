@@ -1,6 +1,14 @@
 import xml.etree.ElementTree as ET
 import os
+import csv
 import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# COCO's definition of a small object, boxes under 32x32 pixels
+small_object_area = 32 * 32
+area_bins = np.linspace(0, 100, 21)  # percentage of the image area
+aspect_bins = np.array([0, 0.25, 0.5, 0.75, 1.0, 1.33, 2.0, 4.0, 100.0])  # box width / height
 
 
 def parse_xml_annotation_from_file(file_path):
@@ -89,14 +97,141 @@ def process_annotation_file(file_path):
         return None
 
 
+def _parse_files(file_paths):
+    """Parse a chunk of VOC files into flat per-box lists, run in a worker process"""
+    file_ids, names, coords, sizes = [], [], [], []
+    for file_id, file_path in file_paths:
+        try:
+            root = ET.parse(file_path).getroot()
+            size = root.find('size')
+            width, height = float(size.find('width').text), float(size.find('height').text)
+            # parsed in full before anything is appended, so a bad object can't leave the columns different lengths
+            objects = []
+            for obj in root.findall('object'):
+                bndbox = obj.find('bndbox')
+                box = [float(bndbox.find(tag).text) for tag in ('xmin', 'ymin', 'xmax', 'ymax')]
+                objects.append((obj.find('name').text, box))
+        except Exception as e:
+            print(f"Error processing {file_path}: {str(e)}")
+            continue
+        for name, box in objects:
+            names.append(name)
+            coords.append(box)
+            file_ids.append(file_id)
+            sizes.append((width, height))
+    return file_ids, names, coords, sizes
+
+
+def collect_boxes(xml_files, workers=None, chunksize=256):
+    """Parse all VOC files across a process pool into a columnar table with one row per box"""
+    numbered_files = list(enumerate(xml_files))
+    chunks = [numbered_files[i:i + chunksize] for i in range(0, len(numbered_files), chunksize)]
+    file_ids, names, coords, sizes = [], [], [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_ids, chunk_names, chunk_coords, chunk_sizes in executor.map(_parse_files, chunks):
+            file_ids.extend(chunk_ids)
+            names.extend(chunk_names)
+            coords.extend(chunk_coords)
+            sizes.extend(chunk_sizes)
+
+    labels, label_ids = np.unique(np.array(names, dtype=str), return_inverse=True)
+    coords = np.array(coords, dtype=np.float32).reshape(-1, 4)
+    sizes = np.array(sizes, dtype=np.float32).reshape(-1, 2)
+    return {
+        'files': list(xml_files),
+        'labels': list(labels),
+        'file_id': np.array(file_ids, dtype=np.int32),
+        'label_id': label_ids.astype(np.int16),
+        'xmin': coords[:, 0], 'ymin': coords[:, 1], 'xmax': coords[:, 2], 'ymax': coords[:, 3],
+        'image_width': sizes[:, 0], 'image_height': sizes[:, 1],
+    }
+
+
+def compute_statistics(table, small_area=small_object_area):
+    """Vectorized per-class box statistics over the table returned by collect_boxes"""
+    box_width = table['xmax'] - table['xmin']
+    box_height = table['ymax'] - table['ymin']
+    area = box_width * box_height
+    area_percentage = area / (table['image_width'] * table['image_height']) * 100
+    aspect_ratio = np.divide(box_width, box_height, out=np.zeros_like(box_width), where=box_height > 0)
+    label_id = table['label_id']
+    num_labels = len(table['labels'])
+
+    counts = np.bincount(label_id, minlength=num_labels)
+    safe_counts = np.maximum(counts, 1)
+    # one row per class, one column per bin
+    area_hist = np.histogram2d(label_id, area_percentage, bins=[np.arange(num_labels + 1), area_bins])[0]
+    aspect_hist = np.histogram2d(label_id, aspect_ratio, bins=[np.arange(num_labels + 1), aspect_bins])[0]
+    # unique (label, file) pairs, to count in how many files each class appears
+    label_file_pairs = np.unique(np.stack([label_id.astype(np.int32), table['file_id']], axis=1), axis=0)
+    files_per_label = np.bincount(label_file_pairs[:, 0], minlength=num_labels)
+
+    return {
+        'labels': table['labels'],
+        'boxes': counts,
+        'files': files_per_label,
+        'mean_area_pixels': np.bincount(label_id, weights=area, minlength=num_labels) / safe_counts,
+        'mean_area_percentage': np.bincount(label_id, weights=area_percentage, minlength=num_labels) / safe_counts,
+        'mean_aspect_ratio': np.bincount(label_id, weights=aspect_ratio, minlength=num_labels) / safe_counts,
+        'small_ratio': np.bincount(label_id, weights=area < small_area, minlength=num_labels) / safe_counts,
+        'area_hist': area_hist.astype(np.int64),
+        'aspect_hist': aspect_hist.astype(np.int64),
+    }
+
+
+def _write_histogram(path, labels, hist, bins):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label', 'bin_start', 'bin_end', 'count'])
+        for label, row in zip(labels, hist):
+            for start, end, count in zip(bins[:-1], bins[1:], row):
+                writer.writerow([label, start, end, count])
+
+
+def write_statistics(stats, table, output_prefix):
+    """Write the per-class summary and histograms as CSV, and the per-box table as a columnar .npz"""
+    summary_columns = ['boxes', 'files', 'mean_area_pixels', 'mean_area_percentage', 'mean_aspect_ratio', 'small_ratio']
+    with open(f'{output_prefix}_summary.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label'] + summary_columns)
+        for i, label in enumerate(stats['labels']):
+            writer.writerow([label] + [stats[column][i] for column in summary_columns])
+
+    _write_histogram(f'{output_prefix}_area_hist.csv', stats['labels'], stats['area_hist'], area_bins)
+    _write_histogram(f'{output_prefix}_aspect_hist.csv', stats['labels'], stats['aspect_hist'], aspect_bins)
+
+    np.savez(f'{output_prefix}_boxes.npz', files=np.array(table['files']), labels=np.array(table['labels']),
+             **{key: value for key, value in table.items() if key not in ('files', 'labels')})
+
+
+def batch_statistics(directory, output_prefix, workers=None):
+    xml_files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.xml'))
+    table = collect_boxes(xml_files, workers)
+    stats = compute_statistics(table)
+    write_statistics(stats, table, output_prefix)
+
+    print(f"Collected {len(table['label_id'])} boxes from {len(xml_files)} XML files")
+    for label, boxes, small_ratio in zip(stats['labels'], stats['boxes'], stats['small_ratio']):
+        print(f"- {label}: {boxes} boxes, {small_ratio * 100:.2f}% small")
+    return stats
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate bounding box area percentages from XML annotation files")
-    parser.add_argument("file_path", help="Path to XML annotation file")
+    parser.add_argument("file_path", nargs="?", help="Path to XML annotation file")
     parser.add_argument("--batch", help="Directory containing multiple XML files to process", default=None)
+    parser.add_argument("--stats", help="With --batch, write per-class statistics to <STATS>_*.csv instead of printing every file", default=None)
+    parser.add_argument("--workers", type=int, help="Number of worker processes for --stats", default=None)
 
     args = parser.parse_args()
 
-    if args.batch:
+    if args.batch and args.stats:
+        if not os.path.isdir(args.batch):
+            print(f"Error: {args.batch} is not a directory")
+            exit(1)
+        batch_statistics(args.batch, args.stats, args.workers)
+
+    elif args.batch:
         if not os.path.isdir(args.batch):
             print(f"Error: {args.batch} is not a directory")
             exit(1)
@@ -111,5 +246,8 @@ if __name__ == "__main__":
         for xml_file in xml_files:
             process_annotation_file(xml_file)
 
+    elif args.file_path:
+        process_annotation_file(args.file_path)
+
     else:
-        process_annotation_file(args.file_path)
\ No newline at end of file
+        parser.error("either file_path or --batch is required")
\ No newline at end of file
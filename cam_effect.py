@@ -1,67 +1,274 @@
 import os
+import zlib
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage import gaussian_filter
+from build_cache import BuildManifest, manifest_path_for
+from dir_stream import prefetch, scan_images
+from image_io import ImageWriter, read_image
+from profiling import get_profiler, start_run
 
-def apply_ov2640_effect(image_path, output_path=None):
-    image = cv2.imread(image_path)
+# Effect constants, see OV2640Engine for what each step simulates
+saturation_scale = 0.85
+channel_gains = np.array([1.1, 1.0, 0.9], dtype=np.float32)  # B, G, R: boost blue, reduce red
+contrast_scale = 0.8
+shadow_lift = 30
+barrel_distortion = 0.05
+noise_std = 3
+jpeg_quality = 80
+# format of the files written, None keeps the source images' format, or png, jpeg, webp or npy, see image_io.py.
+# Independent of jpeg_quality above, which is part of the simulated camera.
+output_format = None
+output_quality = None
+
+# undistortion maps depend only on the resolution, so they are computed once per (height, width)
+_undistort_maps = {}
+
+
+def get_undistort_maps(height, width):
+    key = (height, width)
+    if key not in _undistort_maps:
+        dist_coeff = np.zeros((4, 1), np.float64)
+        dist_coeff[0, 0] = barrel_distortion  # Barrel distortion
+
+        camera_matrix = np.eye(3, dtype=np.float32)
+        camera_matrix[0, 2] = width / 2
+        camera_matrix[1, 2] = height / 2
+        camera_matrix[0, 0] = camera_matrix[1, 1] = width
+        # same maps cv2.undistort builds internally on every call, fixed point for a faster remap
+        _undistort_maps[key] = cv2.initUndistortRectifyMap(camera_matrix, dist_coeff, None, camera_matrix,
+                                                           (width, height), cv2.CV_16SC2)
+    return _undistort_maps[key]
+
+
+class OV2640Engine:
+    """Applies the OV2640 effect to an (N, H, W, 3) uint8 BGR stack, reusing preallocated buffers between batches"""
+
+    def __init__(self, batch_size, height, width, seed=None):
+        self.shape = (batch_size, height, width, 3)
+        self.map1, self.map2 = get_undistort_maps(height, width)
+        self.rng = np.random.default_rng(seed)
+
+        self.color = np.empty(self.shape, dtype=np.float32)
+        self.value = np.empty(self.shape[:3] + (1,), dtype=np.float32)
+        self.warped = np.empty(self.shape, dtype=np.float32)
+        self.noise = np.empty(self.shape, dtype=np.float32)
+        self.output = np.empty(self.shape, dtype=np.uint8)
+        # callers can decode images straight into this buffer and pass input[:n] to process()
+        self.input = np.empty(self.shape, dtype=np.uint8)
+        self.encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+
+    def adjust_color(self, stack, n):
+        color = self.color[:n]
+        value = self.value[:n]
+        np.copyto(color, stack, casting='unsafe')
+
+        # Reduced saturation - budget CMOS sensors typically have less vivid color reproduction
+        # Color tint - the OV2640 often shows a slight blue tint due to its color processing and white balance limitations, especially under certain lighting conditions
+        # Reducing the HSV saturation by a factor k while keeping V = max(B, G, R) moves every channel
+        # towards V: c' = k * c + (1 - k) * V, so the HSV round-trip, tint and contrast fold into one float pass.
+        np.max(color, axis=3, keepdims=True, out=value)
+        value *= 1 - saturation_scale
+        color *= saturation_scale
+        color += value
+        color *= channel_gains
+        np.clip(color, 0, 255, out=color)
+
+        # This compresses the contrast and lifts shadows, simulating how the OV2640 struggles with high-contrast scenes,
+        # often producing images where shadows appear more grey than black.
+        color *= contrast_scale
+        color += shadow_lift
+        return color
+
+    def process(self, stack, seeds=None):
+        """Process the first len(stack) slots. With seeds, the noise of every image comes from its own
+        seeded generator, so the result doesn't depend on which other images share the batch."""
+        n = len(stack)
+        if n > self.shape[0] or stack.shape[1:] != self.shape[1:]:
+            raise ValueError(f"Batch of shape {stack.shape} does not fit engine buffers of shape {self.shape}")
+
+        color = self.adjust_color(stack, n)
+
+        # The inexpensive lenses typically paired with OV2640 sensors in modules like the ESP32CAM exhibit barrel distortion,
+        # where straight lines bow outward from the center. The distortion coefficient of 0.05 adds a subtle barrel effect to simulate this optical characteristic
+        warped = self.warped[:n]
+        for i in range(n):
+            cv2.remap(color[i], self.map1, self.map2, cv2.INTER_LINEAR, dst=warped[i])
+
+        # The standard deviation of 3 adds Gaussian noise to simulate the electronic noise characteristics of
+        # this lower-cost CMOS sensor, which has a lower signal-to-noise ratio compared to premium sensors.
+        # astype(int) in the original truncated the noise towards zero, keep that behaviour
+        noise = self.noise[:n]
+        if seeds is None:
+            self.rng.standard_normal(dtype=np.float32, out=noise)
+        else:
+            for i, seed in enumerate(seeds):
+                np.random.default_rng(seed).standard_normal(dtype=np.float32, out=noise[i])
+        noise *= noise_std
+        np.trunc(noise, out=noise)
+        warped += noise
+        np.clip(warped, 0, 255, out=warped)
+
+        output = self.output[:n]
+        np.copyto(output, warped, casting='unsafe')
+        for i in range(n):
+            # The limited resolving power of inexpensive lenses used with OV2640
+            # The in-camera processing that often applies noise reduction which reduces detail
+            cv2.GaussianBlur(output[i], (3, 3), 0.5, dst=output[i])
+
+            # JPEG compression
+            _, buffer = cv2.imencode(".jpg", output[i], self.encode_param)
+            output[i] = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        return output
+
+
+# single image calls reuse one engine per resolution instead of allocating new buffers every time
+_engines = {}
+
+
+def get_engine(height, width):
+    key = (height, width)
+    if key not in _engines:
+        _engines[key] = OV2640Engine(1, height, width)
+    return _engines[key]
+
+
+def apply_ov2640_effect(image_path, output_path=None, writer=None):
+    image = read_image(image_path)
     if image is None:
         raise ValueError(f"Could not load image from {image_path}")
 
-    # Reduced saturation - budget CMOS sensors typically have less vivid color reproduction
-    # Color tint - the OV2640 often shows a slight blue tint due to its color processing and white balance limitations, especially under certain lighting conditions
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    hsv[:, :, 1] = hsv[:, :, 1] * 0.85  # Reduce saturation
-    result = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-    b, g, r = cv2.split(result)
-    b = np.clip(b * 1.1, 0, 255).astype(np.uint8)  # Boost blue channel
-    r = np.clip(r * 0.9, 0, 255).astype(np.uint8)  # Reduce red channel
-    result = cv2.merge([b, g, r])
-
-    # This code compresses the contrast and lifts shadows, simulating how the OV2640 struggles with high-contrast scenes, 
-    # often producing images where shadows appear more grey than black.
-    result = result.astype(np.float32)
-    result = np.clip(result * 0.8 + 30, 0, 255).astype(np.uint8)
-
-    # The inexpensive lenses typically paired with OV2640 sensors in modules like the ESP32CAM exhibit barrel distortion,
-    # where straight lines bow outward from the center. The distortion coefficient of 0.05 adds a subtle barrel effect to simulate this optical characteristic
-    height, width = result.shape[:2]
-    dist_coeff = np.zeros((4, 1), np.float64)
-    dist_coeff[0, 0] = 0.05  # Barrel distortion
-    
-    camera_matrix = np.eye(3, dtype=np.float32)
-    camera_matrix[0, 2] = width / 2
-    camera_matrix[1, 2] = height / 2
-    camera_matrix[0, 0] = camera_matrix[1, 1] = width
-    result = cv2.undistort(result, camera_matrix, dist_coeff)
-
-    # The standard deviation of 3 adds Gaussian noise to simulate the electronic noise characteristics of 
-    # this lower-cost CMOS sensor, which has a lower signal-to-noise ratio compared to premium sensors.
-    noise = np.random.normal(0, 3, result.shape).astype(int)
-    result = np.clip(result + noise, 0, 255).astype(np.uint8)
-
-    # The limited resolving power of inexpensive lenses used with OV2640
-    #The in-camera processing that often applies noise reduction which reduces detail
-    result = cv2.GaussianBlur(result, (3, 3), 0.5)
-
-    # JPEG compression
-    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-    _, buffer = cv2.imencode(".jpg", result, encode_param)
-    result = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
-    
+    height, width = image.shape[:2]
+    result = get_engine(height, width).process(image[np.newaxis])[0].copy()
+
     if output_path:
-        cv2.imwrite(output_path, result)
+        output_path = (writer or ImageWriter(output_format, output_quality)).write(output_path, result)
         print(f"Processed image saved to {output_path}")
-    
+
     return result
 
+
+def effect_parameters():
+    return [saturation_scale, channel_gains, contrast_scale, shadow_lift, barrel_distortion, noise_std, jpeg_quality]
+
+
+# process_folder streams the folder: images are decoded on read_workers threads, at most read_queue_size
+# decoded images wait for the effect, and a batch's engine buffers are capped at max_batch_megabytes,
+# so larger images get smaller batches instead of multiplying memory
+read_workers = 2
+read_queue_size = 16
+write_workers = 4
+max_batch_megabytes = 256
+# engines (buffers) kept for resolutions other than the current one
+cached_engines = 2
+# bump when the mapping from seed to noise changes, so seeded incremental runs rebuild
+seed_version = 2
+
+
+def batch_size_for(height, width, batch_size):
+    # uint8 input and output, float32 color, warped and noise, and the float32 value channel
+    image_bytes = height * width * (3 * 2 + 3 * 4 * 3 + 4)
+    return max(1, min(batch_size, max_batch_megabytes * 1024 * 1024 // image_bytes))
+
+
+def image_seed(name, seed):
+    # crc32 rather than hash(), which is salted per interpreter
+    return zlib.crc32(f'{name}:{seed}'.encode('utf-8')) & 0xffffffff
+
+
+def process_folder(input_folder, output_folder, batch_size=64, seed=None, manifest=None, writer=None):
+    """Apply the effect to every image in input_folder, streamed with os.scandir and decoded on threads ahead of
+    the effect, batch_size images of the same resolution at a time (fewer for large images).
+    Memory stays flat however many images the folder has. With seed, every image's noise comes from the seed
+    and its name, so the output doesn't depend on the order the folder is read in.
+    With a BuildManifest, images whose source and effect parameters are unchanged are skipped."""
+    os.makedirs(output_folder, exist_ok=True)
+    writer = writer or ImageWriter(output_format, output_quality)
+    parameters = effect_parameters()
+    profiler = get_profiler()
+    profiler.reset_progress()
+
+    def output_path_for(name):
+        return writer.output_name(os.path.join(output_folder, name))
+
+    def load(input_path):
+        # runs on a prefetch thread, the image is None when the output is up to date
+        key = None
+        if manifest is not None:
+            key = manifest.make_key('ov2640', manifest.input_digest(input_path), parameters, seed, seed_version,
+                                    *writer.key_parts())
+            if manifest.is_fresh(key, output_path_for(os.path.basename(input_path))):
+                return key, None, True
+        with profiler.stage('decode'):
+            image = read_image(input_path)
+        if image is not None:
+            profiler.read_file(input_path)
+        return key, image, False
+
+    def write(item):
+        output_path, result = item
+        with profiler.stage('encode'):
+            return writer.write(output_path, result)
+
+    engines = {}
+    engine = None
+    batch = []  # (name, key) per filled engine.input slot
+    count = 0
+
+    with ThreadPoolExecutor(max_workers=write_workers) as encoder:
+        def flush():
+            seeds = None if seed is None else [image_seed(name, seed) for name, _ in batch]
+            with profiler.stage('cam_effect', items=len(batch)):
+                results = engine.process(engine.input[:len(batch)], seeds=seeds)
+            # results are the engine's output buffer, which the next batch reuses, so every write finishes here
+            items = [(output_path_for(name), result) for (name, _), result in zip(batch, results)]
+            for (name, key), output_path in zip(batch, encoder.map(write, items)):
+                if manifest is not None:
+                    manifest.record(key, output_path)
+            profiler.add_frames(len(batch))
+            batch.clear()
+
+        for input_path, (key, image, fresh) in prefetch(scan_images(input_folder), load, read_workers, read_queue_size):
+            if fresh:
+                continue
+            name = os.path.basename(input_path)
+            if image is None:
+                print(f"Could not load image from {name}, skipping")
+                continue
+
+            height, width = image.shape[:2]
+            if engine is None or engine.shape[1:3] != (height, width):
+                if batch:
+                    flush()
+                engine = engines.pop((height, width), None)
+                if engine is None:
+                    engine = OV2640Engine(batch_size_for(height, width, batch_size), height, width, seed)
+                engines[(height, width)] = engine
+                while len(engines) > cached_engines:
+                    engines.pop(next(iter(engines)))
+
+            engine.input[len(batch)] = image
+            batch.append((name, key))
+            count += 1
+            if len(batch) == engine.shape[0]:
+                flush()
+        if batch:
+            flush()
+
+    print(f"Processed {count} images into {output_folder}")
+    return count
+
+
 input_folder = "augmented/fruits.mp4/images"
 output_folder = "compressed_augmented_and_processed/fruits/frames_128 x 128"
+# only process images whose source or effect parameters changed since the last run, see build_cache.py
+incremental = True
 
-os.makedirs(output_folder, exist_ok=True)
-
-for filename in os.listdir(input_folder):
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        input_file_path = os.path.join(input_folder, filename)
-        output_file_path = os.path.join(output_folder, filename)
-        apply_ov2640_effect(input_file_path, output_file_path)
+if __name__ == '__main__':
+    profiler = start_run('cam_effect')
+    manifest = BuildManifest(manifest_path_for(output_folder)) if incremental else None
+    process_folder(input_folder, output_folder, manifest=manifest)
+    if manifest is not None:
+        manifest.finish()
+    profiler.finish('reports/cam_effect.json')
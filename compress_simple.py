@@ -1,87 +1,73 @@
-import cv2
 import os
-import xml.etree.ElementTree as ET
-from pascal_voc import write_pascal_voc, append_object_to_pascal_voc
-from helpers import drawbbox
+from build_cache import BuildManifest, manifest_path_for
+from cvat_reader import load_index
+from crop_resize import CropJob, crop_resize_images
+from image_io import ImageWriter, find_image
+from profiling import get_profiler, start_run
+from remove_frames import pruned_list_path_for, read_pruned_list
 
 
-target_image_width = 128
-target_image_height = 128
+# every (width, height) in the list is produced from a single decode of each frame, e.g. [(96, 96), (128, 128)]
+target_sizes = [(128, 128)]
 video_name = 'banana_white_desk.mp4'
 annotation_path = 'banana_white_desk.xml'
-
-compressed_folder_path = f'compressed/{video_name}/frames_{target_image_width} x {target_image_height}'
-compressed_annotations_folderpath = f'compressed/{video_name}/annotations_{target_image_width} x {target_image_height}'
-os.makedirs(compressed_folder_path, exist_ok=True)
-os.makedirs(compressed_annotations_folderpath, exist_ok=True)
-
-print(f"Processing annotations_CVAT from: {annotation_path}")
-
-tree = ET.parse(annotation_path)
-root = tree.getroot()
-
-for track in root.findall('.//track'):
-    prev_frame = None
-
-    for box in track.findall('box'):
-        frame_num = box.attrib['frame']
-        label = box.attrib['label']
-        print(f"Processing frame: {frame_num}")
-
-        image_path = os.path.join(f'frames/{video_name}/frame_{frame_num}.png')
-        if not os.path.exists(image_path):
+# only rebuild frames whose source image, boxes or target size changed since the last run, see build_cache.py
+incremental = True
+# png, jpeg, webp or npy for the compressed frames, see image_io.py
+output_format = 'png'
+output_quality = None
+# skip the frames listed by a remove_frames.py --list-only run on the frames folder
+use_pruned_list = False
+
+
+def output_dirs(video_name, target_sizes=target_sizes, output_root='compressed'):
+    """Frame and annotation folder per (width, height) target, e.g. compressed/<video>/frames_128 x 128"""
+    image_dirs = {(w, h): f'{output_root}/{video_name}/frames_{w} x {h}' for w, h in target_sizes}
+    annotation_dirs = {(w, h): f'{output_root}/{video_name}/annotations_{w} x {h}' for w, h in target_sizes}
+    return image_dirs, annotation_dirs
+
+
+def compress_video(video_name, annotation_path, target_sizes=target_sizes, frames_root='frames', output_root='compressed',
+                   labels=None, incremental=incremental, fmt=output_format, quality=output_quality,
+                   use_pruned_list=use_pruned_list):
+    """Crop/resize the extracted frames of one video in frames_root/<video_name> to every target size.
+    With use_pruned_list, frames listed by a remove_frames.py --list-only run are skipped."""
+    frames_dir = os.path.join(frames_root, video_name)
+    pruned = read_pruned_list(frames_dir) if use_pruned_list else set()
+    skipped = 0
+    image_dirs, annotation_dirs = output_dirs(video_name, target_sizes, output_root)
+    with get_profiler().stage('xml_read'):
+        index = load_index(annotation_path)
+
+    # all boxes of a frame, even across tracks, are grouped into one job so each frame is read and written once
+    jobs = []
+    for frame_num, boxes in index.items(labels):
+        # the frames may have been extracted in any image_io format
+        image_path = find_image(frames_dir, f'frame_{frame_num}')
+        if image_path is None:
+            continue
+        if os.path.basename(image_path) in pruned:
+            skipped += 1
             continue
 
-        original_image = cv2.imread(image_path)
-        xtl, ytl, xbr, ybr = [float(box.attrib[attr]) for attr in ['xtl', 'ytl', 'xbr', 'ybr']]
-
-        if frame_num == '204':
-            print("debug")
-
-        (h, w) = original_image.shape[:2]
-        aspect_ratio = h / w # height / width, to maintain the aspect ratio of the original image
-
-        new_height = int(aspect_ratio * target_image_height) # aspect_ratio * target_imag
-
-        resized_image = cv2.resize(original_image, (target_image_width, new_height))
-
-
-        if new_height > target_image_height:
-            start_y = (new_height - target_image_height) // 2
-            cropped_image = resized_image[start_y:start_y + target_image_height, :]
-        else:
-            cropped_image = resized_image
-
-
-        cv2.imwrite(f'{compressed_folder_path}/frame_{frame_num}.png', cropped_image)
-        print(f"Image saved to: {compressed_folder_path}/frame_{frame_num}.png")
-
-        resize_ratio = target_image_width / original_image.shape[1]
-
-        new_xtl = xtl * resize_ratio
-        new_ytl = (ytl * resize_ratio) - start_y if new_height > target_image_height else ytl * resize_ratio
-        new_xbr = xbr * resize_ratio
-        new_ybr = (ybr * resize_ratio) - start_y if new_height > target_image_height else ybr * resize_ratio
-
-        if new_xtl < 0: # if xtl is negative, set it to 0
-            new_xtl = 0
-        if new_ytl < 0: # if ytl is negative, set it to 0
-            new_ytl = 0
-        if new_xbr > target_image_width: # if xbr is greater than the target image width, set it to the target image width, because bbox reaches maximum width point, which is the target image width
-            new_xbr = target_image_width
-        if new_ybr > target_image_height: # if ybr is greater than the target image height, set it to the target image height, because bbox reaches maximum height point, which is the target image height
-            new_ybr = target_image_height
-
-        xml_path = f'{compressed_annotations_folderpath}/frame_{frame_num}.xml'
-        if prev_frame == frame_num:
-            append_object_to_pascal_voc(xml_path, label, new_xtl, new_ytl, new_xbr, new_ybr)
-        else:
-            write_pascal_voc(f'{compressed_annotations_folderpath}/frame_{frame_num}.xml',
-             f'frame_{frame_num}.png', label,
-             target_image_width, target_image_height, new_xtl, new_ytl, new_xbr, new_ybr)
-
-        prev_frame = frame_num
-
-        # for debugging, draw the bounding box on the image
-        #drawbbox(compressed_folder_path, frame_num, new_xtl, new_ytl, new_xbr, new_ybr)
-
+        box_labels = [box[0] for box in boxes]
+        coords = [box[1:] for box in boxes]
+        jobs.append(CropJob(image_path, f'frame_{frame_num}.png', f'frame_{frame_num}.xml', f'frame_{frame_num}.png',
+                            box_labels, coords))
+
+    manifest = BuildManifest(manifest_path_for(f'{output_root}/{video_name}')) if incremental else None
+    count = crop_resize_images(jobs, target_sizes, image_dirs, annotation_dirs, manifest=manifest,
+                               writer=ImageWriter(fmt, quality))
+    if manifest is not None:
+        manifest.finish()
+    print(f"Compressed {count} frames to {', '.join(image_dirs.values())}")
+    if skipped:
+        print(f"Skipped {skipped} frames listed in {pruned_list_path_for(frames_dir)}")
+    return count
+
+
+if __name__ == '__main__':
+    print(f"Processing annotations_CVAT from: {annotation_path}")
+    profiler = start_run('compress_simple')
+    compress_video(video_name, annotation_path)
+    profiler.finish('reports/compress_simple.json')
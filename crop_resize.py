@@ -0,0 +1,177 @@
+import cv2
+import os
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from image_io import ImageWriter, read_image as read_any_image
+from pascal_voc import PascalVocWriter
+from profiling import get_profiler
+
+# Shared fit-shortest-axis engine used by compress_simple.py, annotate_testing_frames.py and stream_pipeline.py.
+# The shortest axis is resized to the target and the longer one is center cropped, for any orientation and
+# target size. Boxes are transformed and clipped as (N, 4) arrays, and images are decoded, resized and
+# encoded on a thread pool, since OpenCV releases the GIL while doing so.
+
+# image_path: source image, image_name: output image file name, xml_name: output annotation file name,
+# voc_filename: <filename> written in the annotation, labels: list of N labels, boxes: (N, 4) xtl, ytl, xbr, ybr
+CropJob = namedtuple('CropJob', ['image_path', 'image_name', 'xml_name', 'voc_filename', 'labels', 'boxes'])
+
+default_workers = 8
+# decoded full-HD frames are ~6 MB each, keep only the most recent ones around
+decoded_image_cache_size = 16
+# bump when the boxes written for the same input change, so incremental runs rewrite their annotations
+annotation_version = 2
+
+
+def crop_geometry(width, height, target_width, target_height):
+    """Return the resize ratio, resized size and crop offsets that map a width x height image onto the target"""
+    resize_ratio = max(target_width / width, target_height / height)
+
+    # max() guards against float rounding leaving the short axis one pixel short of the target
+    new_width = max(target_width, int(width * resize_ratio))
+    new_height = max(target_height, int(height * resize_ratio))
+
+    start_x = (new_width - target_width) // 2
+    start_y = (new_height - target_height) // 2
+    return resize_ratio, new_width, new_height, start_x, start_y
+
+
+def fit_shortest_axis(image, target_width, target_height):
+    """Resize so the shortest axis matches the target and center crop the longer one.
+    Returns the cropped image, the resize ratio and the crop offsets."""
+    (h, w) = image.shape[:2]
+    resize_ratio, new_width, new_height, start_x, start_y = crop_geometry(w, h, target_width, target_height)
+    resized_image = cv2.resize(image, (new_width, new_height))
+    cropped_image = resized_image[start_y:start_y + target_height, start_x:start_x + target_width]
+    return cropped_image, resize_ratio, start_x, start_y
+
+
+def transform_boxes(boxes, resize_ratio, start_x, start_y, target_width, target_height):
+    """Scale, shift and clip an (N, 4) array of xtl, ytl, xbr, ybr boxes into the cropped image"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    offsets = np.array([start_x, start_y, start_x, start_y], dtype=np.float64)
+    limits = np.array([target_width, target_height, target_width, target_height], dtype=np.float64)
+    transformed = boxes * resize_ratio - offsets
+    # boxes reaching past the crop are cut at the image border
+    np.clip(transformed, 0, limits, out=transformed)
+    return transformed
+
+
+def crop_boxes(labels, boxes, resize_ratio, start_x, start_y, target_width, target_height):
+    """transform_boxes without the boxes that end up entirely outside the crop, which the clip leaves with zero
+    width or height. Returns the labels and (N, 4) boxes that are kept."""
+    boxes = transform_boxes(boxes, resize_ratio, start_x, start_y, target_width, target_height)
+    visible = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    return [label for label, keep in zip(labels, visible) if keep], boxes[visible]
+
+
+def resize_to_targets(image, targets):
+    """Crop/resize one decoded image to every (width, height) in targets"""
+    return {target: fit_shortest_axis(image, *target) for target in targets}
+
+
+@lru_cache(maxsize=decoded_image_cache_size)
+def read_image(image_path):
+    # images are only ever read from here, resize/crop always produce new arrays
+    return read_any_image(image_path)
+
+
+def merge_jobs(jobs):
+    """Merge jobs that write the same output image, so their boxes share one decode and one encode"""
+    merged = {}
+    for job in jobs:
+        key = (job.image_path, job.image_name, job.xml_name)
+        if key in merged:
+            previous = merged[key]
+            boxes = np.concatenate([np.asarray(previous.boxes, dtype=np.float64).reshape(-1, 4),
+                                    np.asarray(job.boxes, dtype=np.float64).reshape(-1, 4)])
+            merged[key] = previous._replace(labels=list(previous.labels) + list(job.labels), boxes=boxes)
+        else:
+            merged[key] = job
+    return list(merged.values())
+
+
+def _process_job(job, targets, image_dirs, writer):
+    profiler = get_profiler()
+    with profiler.stage('decode'):
+        image = read_image(job.image_path)
+    if image is None:
+        return None
+    profiler.read_file(job.image_path)
+
+    results = {}
+    for target in targets:
+        with profiler.stage('resize'):
+            cropped_image, resize_ratio, start_x, start_y = fit_shortest_axis(image, *target)
+            results[target] = crop_boxes(job.labels, job.boxes, resize_ratio, start_x, start_y, *target)
+        with profiler.stage('encode'):
+            writer.write(os.path.join(image_dirs[target], job.image_name), cropped_image)
+    return results
+
+
+def _job_outputs(job, target, image_dirs, annotation_dirs, writer):
+    return (writer.output_name(os.path.join(image_dirs[target], job.image_name)),
+            os.path.join(annotation_dirs[target], job.xml_name))
+
+
+def _job_key(manifest, job, target, writer):
+    return manifest.make_key('crop_resize', annotation_version, manifest.input_digest(job.image_path), job.voc_filename,
+                             list(job.labels), np.asarray(job.boxes, dtype=np.float64), target, *writer.key_parts())
+
+
+def crop_resize_images(jobs, targets, image_dirs, annotation_dirs, workers=default_workers, manifest=None, writer=None,
+                       index=None):
+    """Run every CropJob for all targets, decoding each source image once.
+    image_dirs and annotation_dirs map each (width, height) target to its output directory.
+    With a BuildManifest, targets whose outputs are up to date are skipped.
+    writer is an image_io.ImageWriter, by default the format follows each job's image_name.
+    With an index list, an {image, annotation, target, labels, boxes} dict is appended for every annotation written."""
+    jobs = merge_jobs(jobs)
+    writer = writer or ImageWriter()
+    for target in targets:
+        os.makedirs(image_dirs[target], exist_ok=True)
+    voc_writers = {target: PascalVocWriter(annotation_dirs[target]) for target in targets}
+
+    # (job, targets that need to be built, manifest key per target)
+    pending = []
+    for job in jobs:
+        if manifest is None or not os.path.exists(job.image_path):
+            pending.append((job, targets, {}))
+            continue
+        keys = {target: _job_key(manifest, job, target, writer) for target in targets}
+        stale_targets = [target for target in targets
+                         if not manifest.is_fresh(keys[target], *_job_outputs(job, target, image_dirs, annotation_dirs, writer))]
+        if stale_targets:
+            pending.append((job, stale_targets, keys))
+
+    profiler = get_profiler()
+    profiler.reset_progress()
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = executor.map(lambda item: _process_job(item[0], item[1], image_dirs, writer), pending)
+        for (job, job_targets, keys), results in zip(pending, futures):
+            if results is None:
+                print(f"Could not load image from {job.image_path}, skipping")
+                continue
+            # the annotation names the written image when it named the output image before
+            voc_filename = writer.output_name(job.voc_filename) if job.voc_filename == job.image_name else job.voc_filename
+            for target, (labels, boxes) in results.items():
+                annotation = voc_writers[target].annotation(job.xml_name, voc_filename, *target)
+                for label, (xtl, ytl, xbr, ybr) in zip(labels, boxes):
+                    annotation.add_object(label, xtl, ytl, xbr, ybr)
+                if manifest is not None:
+                    manifest.record(keys[target], *_job_outputs(job, target, image_dirs, annotation_dirs, writer))
+                if index is not None:
+                    image_path, xml_path = _job_outputs(job, target, image_dirs, annotation_dirs, writer)
+                    index.append({'image': image_path, 'annotation': xml_path, 'target': list(target),
+                                  'labels': labels, 'boxes': np.round(boxes, 2).tolist()})
+            count += 1
+            profiler.add_frames(total=len(pending))
+
+    with profiler.stage('xml_write', items=sum(len(voc_writer.annotations) for voc_writer in voc_writers.values())):
+        for voc_writer in voc_writers.values():
+            voc_writer.flush()
+    # the cache only lives for one run, the files may change on disk before the next one
+    read_image.cache_clear()
+    return count
@@ -0,0 +1,224 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+from array import array
+
+# Streaming reader for CVAT exports, shared by the preprocessing scripts.
+# Video exports store boxes under <track>, image exports under <image>; both end up in the same
+# frame -> boxes index. The index keeps one row per box in flat typed arrays sorted by frame,
+# with an offsets table per frame, and can be cached next to the XML in a binary sidecar file.
+# Boxes go into the typed arrays as they are parsed, in file order, and are put in frame order at the end,
+# so parsing never holds more than a few bytes per box.
+
+index_version = 1
+sidecar_suffix = '.index'
+
+# bit flags stored per box
+OUTSIDE = 1
+OCCLUDED = 2
+KEYFRAME = 4
+
+
+class CvatIndex:
+    """Frame -> boxes index over a CVAT export, every box is one row in the flat arrays"""
+
+    def __init__(self, labels, frames, offsets, label_ids, track_ids, flags, coords, images):
+        self.labels = labels  # label id -> label name
+        self.frames = frames  # sorted unique frame numbers (image ids for image exports)
+        self.offsets = offsets  # boxes of frames[i] are rows offsets[i]:offsets[i + 1]
+        self.label_ids = label_ids
+        self.track_ids = track_ids  # -1 for image exports
+        self.flags = flags
+        self.coords = coords  # xtl, ytl, xbr, ybr per row
+        self.images = images  # frame -> (name, width, height), only for image exports
+        self._positions = {frame: i for i, frame in enumerate(frames)}
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def __contains__(self, frame):
+        return frame in self._positions
+
+    def _rows(self, frame):
+        i = self._positions.get(frame)
+        if i is None:
+            return range(0)
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    def _keep(self, row, label_set, include_outside):
+        if label_set is not None and self.labels[self.label_ids[row]] not in label_set:
+            return False
+        return include_outside or not self.flags[row] & OUTSIDE
+
+    def boxes(self, frame, labels=None, include_outside=True):
+        """Return [(label, xtl, ytl, xbr, ybr), ...] for one frame"""
+        label_set = set(labels) if labels is not None else None
+        result = []
+        for row in self._rows(frame):
+            if self._keep(row, label_set, include_outside):
+                c = row * 4
+                result.append((self.labels[self.label_ids[row]],
+                               self.coords[c], self.coords[c + 1], self.coords[c + 2], self.coords[c + 3]))
+        return result
+
+    def box_rows(self, frame):
+        """Return [(label, track_id, flags, xtl, ytl, xbr, ybr), ...] for one frame, including every attribute we keep"""
+        result = []
+        for row in self._rows(frame):
+            c = row * 4
+            result.append((self.labels[self.label_ids[row]], self.track_ids[row], self.flags[row],
+                           self.coords[c], self.coords[c + 1], self.coords[c + 2], self.coords[c + 3]))
+        return result
+
+    def items(self, labels=None, include_outside=True):
+        """Yield (frame, boxes) in frame order, skipping frames that have no box left after filtering"""
+        for frame in self.frames:
+            boxes = self.boxes(frame, labels, include_outside)
+            if boxes:
+                yield frame, boxes
+
+    def frame_numbers(self, labels=None, include_outside=True):
+        """Sorted frame numbers that have at least one box with one of the given labels"""
+        return [frame for frame, _ in self.items(labels, include_outside)]
+
+
+def _flags(box):
+    flags = 0
+    if box.get('outside') == '1':
+        flags |= OUTSIDE
+    if box.get('occluded') == '1':
+        flags |= OCCLUDED
+    if box.get('keyframe') == '1':
+        flags |= KEYFRAME
+    return flags
+
+
+def _reordered(values, order, width=1):
+    """Copy of a typed array with its rows of width items in the given order"""
+    rows = np.frombuffer(values, dtype=values.typecode).reshape(-1, width)[order]
+    result = array(values.typecode)
+    result.frombytes(rows.tobytes())
+    return result
+
+
+def parse_cvat(xml_path):
+    """Build a CvatIndex with iterparse, clearing every element once it's read so memory stays flat"""
+    labels = []
+    label_lookup = {}
+    images = {}
+    # one row per box in file order, sorted by frame once the whole file is read
+    row_frames, label_ids, track_ids, flags, coords = array('i'), array('H'), array('i'), array('B'), array('d')
+
+    def label_id(name):
+        if name not in label_lookup:
+            label_lookup[name] = len(labels)
+            labels.append(name)
+        return label_lookup[name]
+
+    root = None
+    track = None
+    image = None
+    for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif elem.tag == 'track':
+                track = (int(elem.get('id', -1)), elem.get('label', ''))
+            elif elem.tag == 'image':
+                image = int(elem.get('id'))
+                images[image] = (elem.get('name'), int(elem.get('width', 0)), int(elem.get('height', 0)))
+            continue
+
+        if elem.tag == 'box':
+            if track is not None:
+                frame, track_id = int(elem.get('frame')), track[0]
+                label = elem.get('label', track[1])
+            elif image is not None:
+                frame, track_id, label = image, -1, elem.get('label')
+            else:
+                continue
+            row_frames.append(frame)
+            label_ids.append(label_id(label))
+            track_ids.append(track_id)
+            flags.append(_flags(elem))
+            for attr in ('xtl', 'ytl', 'xbr', 'ybr'):
+                coords.append(float(elem.get(attr)))
+            elem.clear()
+        elif elem.tag in ('track', 'image', 'meta'):
+            track = None if elem.tag == 'track' else track
+            image = None if elem.tag == 'image' else image
+            # finished children are dropped from the root as well, not just emptied
+            root.clear()
+
+    # a stable sort keeps the track order of boxes within a frame, same as walking the tree
+    row_frames = np.frombuffer(row_frames, dtype=np.int32)
+    order = np.argsort(row_frames, kind='stable')
+    unique_frames, counts = np.unique(row_frames, return_counts=True)
+    frames = array('i', unique_frames.tolist())
+    offsets = array('I', [0] + np.cumsum(counts).tolist())
+
+    return CvatIndex(labels, frames, offsets, _reordered(label_ids, order), _reordered(track_ids, order),
+                     _reordered(flags, order), _reordered(coords, order, 4), images)
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _save_sidecar(index, sidecar_path, mtime_ns, size, digest):
+    state = {
+        'version': index_version, 'mtime_ns': mtime_ns, 'size': size, 'hash': digest,
+        'labels': index.labels, 'images': index.images,
+        'arrays': {name: getattr(index, name) for name in
+                   ('frames', 'offsets', 'label_ids', 'track_ids', 'flags', 'coords')},
+    }
+    tmp_path = sidecar_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, sidecar_path)
+
+
+def _load_sidecar(sidecar_path):
+    try:
+        with open(sidecar_path, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if state.get('version') != index_version:
+        return None
+    return state
+
+
+def load_index(xml_path, use_cache=True):
+    """Return the CvatIndex for xml_path, reusing the sidecar cache if the XML is unchanged.
+    The cache is valid when the XML's mtime and size match, or failing that, when its content hash does."""
+    if not use_cache:
+        return parse_cvat(xml_path)
+
+    stat = os.stat(xml_path)
+    sidecar_path = xml_path + sidecar_suffix
+    state = _load_sidecar(sidecar_path)
+    digest = None
+    if state is not None and state['size'] == stat.st_size:
+        valid = state['mtime_ns'] == stat.st_mtime_ns
+        if not valid:
+            # touched or copied, but possibly the same content
+            digest = file_hash(xml_path)
+            valid = state['hash'] == digest
+        if valid:
+            arrays = state['arrays']
+            return CvatIndex(state['labels'], arrays['frames'], arrays['offsets'], arrays['label_ids'],
+                             arrays['track_ids'], arrays['flags'], arrays['coords'], state['images'])
+
+    index = parse_cvat(xml_path)
+    try:
+        _save_sidecar(index, sidecar_path, stat.st_mtime_ns, stat.st_size, digest or file_hash(xml_path))
+    except OSError as e:
+        print(f"Could not write annotation index cache {sidecar_path}: {e}")
+    return index
@@ -0,0 +1,101 @@
+import os
+import queue
+import threading
+from collections import deque
+from image_io import is_image
+
+# Streaming building blocks for the scripts that process every image of a folder (cam_effect.py, augmentation.py).
+# Folders are read with os.scandir as they are walked instead of being listed and sorted up front, files are
+# read ahead of the consumer on threads, and everything in flight sits in bounded queues. Memory therefore
+# depends on the queue sizes, not on how many files the folder has.
+
+default_read_workers = 2
+default_queue_size = 32
+
+_done = object()
+
+
+def scan_images(directory):
+    """Yield the path of every image file in directory, in the order os.scandir returns them"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if is_image(entry.name) and entry.is_file():
+                yield entry.path
+
+
+def prefetch(items, load, workers=default_read_workers, queue_size=default_queue_size):
+    """Yield (item, load(item)) for every item, with load running on worker threads ahead of the consumer.
+    items is consumed lazily and at most queue_size loaded results wait to be consumed, so only that many are
+    in memory at once. Results come in the order they finish loading. Exceptions from load or items are
+    raised in the consumer."""
+    items = iter(items)
+    items_lock = threading.Lock()
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(value):
+        # gives up once the consumer has stopped, so a worker never blocks on a queue nobody reads
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def work():
+        while not stop.is_set():
+            try:
+                with items_lock:
+                    item = next(items, _done)
+                if item is _done:
+                    break
+                put((item, load(item), None))
+            except Exception as e:
+                put((None, None, e))
+                break
+        put(_done)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        finished = 0
+        while finished < len(threads):
+            value = results.get()
+            if value is _done:
+                finished += 1
+                continue
+            item, result, error = value
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def bounded_map(executor, fn, items, max_pending):
+    """Like executor.map, but submits items lazily and keeps at most max_pending of them in flight.
+    Yields (item, result) in the order of items."""
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= max_pending:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+    while pending:
+        done_item, future = pending.popleft()
+        yield done_item, future.result()
+
+
+def chunked(items, size):
+    """Lists of up to size consecutive items, without materializing items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
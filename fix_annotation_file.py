@@ -1,32 +1,160 @@
+import math
+import heapq
+import argparse
 import xml.etree.ElementTree as ET
-from collections import defaultdict
+from xml.sax.saxutils import quoteattr
+from cvat_reader import load_index, OUTSIDE, OCCLUDED, KEYFRAME
 
-tree = ET.parse('annotations/banana_white_desk.xml')
-root = tree.getroot()
+# Merges every track of one or more CVAT video exports into a single 'merged' track, removing duplicate boxes.
+# Two boxes of the same frame and label are duplicates only if their IoU is at least iou_threshold, so two
+# separate bananas in one frame are both kept. Boxes are read from the cvat_reader index (frame-sorted arrays,
+# no DOM) and handled one frame at a time, and the merged track is written out frame by frame.
+#
+# Within a frame, boxes are hashed by (label, size level, grid cell), where the size level is log2 of the
+# box's longer side and the cell size is 2 ** level. A box is only compared with boxes in the few buckets it
+# could overlap enough with, so finding its duplicates takes constant time however many boxes the frame has.
 
-frames_dict = defaultdict(list)
+input_path = 'annotations/banana_white_desk.xml'
+output_path = 'banana_white_desk.xml'
+iou_threshold = 0.5
 
-for track in root.findall('track'):
-    label = track.get('label', '')
-    for box in track.findall('box'):
-        frame = box.get('frame')
-        duplicate = False
-        for existing_box in frames_dict[frame]:
-            if existing_box.get('label', label) == label:
-                duplicate = True
+
+def iou(a, b):
+    """IoU of two (xtl, ytl, xbr, ybr) boxes"""
+    inter_w = min(a[2], b[2]) - max(a[0], b[0])
+    inter_h = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _level(box):
+    return int(math.floor(math.log2(max(box[2] - box[0], box[3] - box[1], 1.0))))
+
+
+class DuplicateFinder:
+    """Spatial hash of the kept boxes of one frame"""
+
+    def __init__(self, threshold=iou_threshold):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"IoU threshold must be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        # IoU >= t needs the longer sides within a factor t of each other, so only levels this far apart can match
+        self.spread = int(math.ceil(math.log2(1 / threshold))) + 1
+        self.buckets = {}
+
+    def _key(self, label, level, box):
+        cell = 2.0 ** level
+        return label, level, int(((box[0] + box[2]) / 2) // cell), int(((box[1] + box[3]) / 2) // cell)
+
+    def find(self, label, box):
+        """Return a kept box of the same label with IoU >= threshold, or None"""
+        level = _level(box)
+        size = 2.0 ** (level + 1)
+        cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+        for other_level in range(level - self.spread, level + self.spread + 1):
+            cell = 2.0 ** other_level
+            # overlapping boxes have centers closer than the longer side of the larger box
+            reach = int(math.ceil(max(size, 2.0 * cell) / cell))
+            qx, qy = int(cx // cell), int(cy // cell)
+            for x in range(qx - reach, qx + reach + 1):
+                for y in range(qy - reach, qy + reach + 1):
+                    for other in self.buckets.get((label, other_level, x, y), ()):
+                        if iou(box, other) >= self.threshold:
+                            return other
+        return None
+
+    def add(self, label, box):
+        self.buckets.setdefault(self._key(label, _level(box), box), []).append(box)
+
+
+def _read_header(xml_path):
+    """Return the <version> and <meta> elements of a CVAT export, reading no further than that"""
+    header = []
+    for event, elem in ET.iterparse(xml_path, events=('end',)):
+        if elem.tag in ('version', 'meta'):
+            header.append(elem)
+            if elem.tag == 'meta':
                 break
-        if not duplicate:
-            box.set('label', label)
-            frames_dict[frame].append(box)
+    return header
+
+
+def _frame_boxes(index, frame, labels):
+    rows = []
+    for label, track_id, flags, xtl, ytl, xbr, ybr in index.box_rows(frame):
+        if labels is None or label in labels:
+            rows.append((label, flags, (xtl, ytl, xbr, ybr)))
+    return rows
+
+
+def merged_frames(indexes, threshold=iou_threshold, labels=None, stats=None):
+    """Yield (frame, [(label, flags, box), ...]) in frame order with duplicates removed.
+    Boxes inside the frame win over outside ones and keyframes over interpolated boxes, otherwise the first
+    track (and the first input file) wins."""
+    frames = heapq.merge(*[iter(index.frames) for index in indexes])
+    previous = None
+    for frame in frames:
+        # the same frame comes once per input that has it
+        if frame == previous:
+            continue
+        previous = frame
+
+        rows = []
+        for index in indexes:
+            if frame in index:
+                rows.extend(_frame_boxes(index, frame, labels))
+        rows.sort(key=lambda row: (bool(row[1] & OUTSIDE), not row[1] & KEYFRAME))
+
+        finder = DuplicateFinder(threshold)
+        kept = []
+        for label, flags, box in rows:
+            if finder.find(label, box) is not None:
+                continue
+            finder.add(label, box)
+            kept.append((label, flags, box))
+        if stats is not None:
+            stats['boxes'] += len(rows)
+            stats['duplicates'] += len(rows) - len(kept)
+        yield frame, kept
+
+
+def _box_line(frame, label, flags, box):
+    xtl, ytl, xbr, ybr = box
+    return (f'    <box frame="{frame}" keyframe="{int(bool(flags & KEYFRAME))}" outside="{int(bool(flags & OUTSIDE))}" '
+            f'occluded="{int(bool(flags & OCCLUDED))}" xtl="{xtl:.2f}" ytl="{ytl:.2f}" xbr="{xbr:.2f}" ybr="{ybr:.2f}" '
+            f'z_order="0" label={quoteattr(label)}>\n    </box>\n')
+
+
+def merge_annotations(input_paths, output_path, threshold=iou_threshold, labels=None):
+    """Merge the tracks of every input CVAT export into one track written to output_path, returns the stats"""
+    indexes = [load_index(path) for path in input_paths]
+    labels = set(labels) if labels else None
+    stats = {'boxes': 0, 'duplicates': 0, 'frames': 0}
 
-for track in root.findall('track'):
-    root.remove(track)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n<annotations>")
+        for elem in _read_header(input_paths[0]):
+            f.write(ET.tostring(elem, encoding='unicode'))
+        # every box carries its own label, the track label is only a placeholder
+        f.write('<track id="0" label="merged" source="manual">\n')
+        for frame, boxes in merged_frames(indexes, threshold, labels, stats):
+            stats['frames'] += 1
+            f.write(''.join(_box_line(frame, label, flags, box) for label, flags, box in boxes))
+        f.write('  </track>\n</annotations>\n')
+    return stats
 
-new_track = ET.Element('track', attrib={'id': '0', 'label': 'merged'})
-for frame in sorted(frames_dict.keys(), key=lambda x: int(x)):
-    for box in frames_dict[frame]:
-        new_track.append(box)
 
-root.append(new_track)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the tracks of CVAT video exports into one track without duplicate boxes")
+    parser.add_argument("inputs", nargs="*", default=[input_path], help="CVAT XML files, their tracks are merged together")
+    parser.add_argument("-o", "--output", default=output_path, help="Merged CVAT XML file")
+    parser.add_argument("--iou", type=float, default=iou_threshold,
+                        help="Boxes of the same frame and label with at least this IoU are duplicates")
+    parser.add_argument("--labels", nargs="+", help="Only keep boxes with these labels")
+    args = parser.parse_args()
 
-tree.write('banana_white_desk.xml', encoding='utf-8', xml_declaration=True)
\ No newline at end of file
+    stats = merge_annotations(args.inputs, args.output, args.iou, args.labels)
+    print(f"Merged {stats['boxes']} boxes over {stats['frames']} frames into {args.output}, "
+          f"removed {stats['duplicates']} duplicates")
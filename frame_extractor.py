@@ -1,21 +1,56 @@
 import cv2
-import xml.etree.ElementTree as ET
 import os
+import json
+import argparse
+import threading
+import time
+import numpy as np
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from build_cache import BuildManifest, manifest_path_for
+from cvat_reader import load_index
+from image_io import ImageWriter
+from profiling import get_profiler, start_run
 
 video_name = 'fruits.mp4'
 xml_path = 'annotations/annotations_train.xml'
 video_path = 'videos/fruits.mp4'
 
-def parse_xml(xml_file):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    frame_numbers = []
+# Gaps between wanted frames are skipped with grab() or with a seek. grab() still decodes every frame, it only
+# saves retrieve()'s copy and color conversion. A seek restarts the decoder at the keyframe before the target and
+# decodes forward to it, so it only pays off for gaps longer than what it decodes. seek_threshold is that break-even
+# gap in frames; None measures it on each video, as the time of a seek over the time of a grab().
+seek_threshold = None
+seek_samples = 3
+grab_samples = 30
+# seeks that land past the target are retried this many times from earlier frames
+seek_retries = 4
+# Number of imwrite workers and the max number of decoded frames waiting to be written,
+# so a slow disk can't make us hold the whole video in memory.
+write_workers = 4
+max_pending_writes = 16
+# only extract frames that are missing or whose inputs changed since the last run, see build_cache.py
+incremental = True
+report_path = 'reports/frame_extractor.json'
+labels = ('orange', 'apple', 'banana')
 
-    for track in root.findall('track'):
-        if track.attrib['label'] == 'orange' or track.attrib['label'] == 'apple' or track.attrib['label'] == 'banana':
-            for box in track.findall('./box'):
-                frame_numbers.append(int(box.attrib['frame']))
-    return frame_numbers
+# Multi-video extraction, see extract_videos. Each video is split into segments spanning about segment_frames
+# frames, cut at keyframes, and every segment is decoded by its own worker process.
+segment_frames = 900
+# png, jpeg, webp or npy (see image_io.py), or raw for one uint8 memmap of shape (N, H, W, 3) per video
+# plus frames.json, like packed_dataset.py. output_quality None uses the image_io default of the format.
+output_format = 'png'
+output_quality = None
+video_extensions = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def parse_xml(xml_file, labels=labels):
+    return load_index(xml_file).frame_numbers(labels=labels)
+
+
+def build_frame_index(frame_numbers):
+    # several tracks annotate the same frame, we only want to decode and save it once
+    return sorted(set(frame_numbers))
 
 
 def create_frames_directory(base_path, video_name):
@@ -25,27 +60,337 @@ def create_frames_directory(base_path, video_name):
     return frames_dir
 
 
-def extract_frames(video_path, frame_numbers, output_dir):
-    cap = cv2.VideoCapture(video_path)
-    current_frame = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
+def measure_seek_threshold(cap, samples=seek_samples):
+    """Break-even gap in frames between grab() and a seek on this video, from timing grab_samples grabs and
+    samples seeks spread over the video. Leaves cap at the first frame."""
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    start = time.perf_counter()
+    grabbed = 0
+    while grabbed < grab_samples and cap.grab():
+        grabbed += 1
+    grab_seconds = (time.perf_counter() - start) / max(grabbed, 1)
+    if frame_count <= 2 * grab_samples or grab_seconds == 0:
+        # too short for seeking to matter
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return float('inf')
+
+    start = time.perf_counter()
+    for i in range(samples):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count * (i + 1) // (samples + 1))
+    seek_seconds = (time.perf_counter() - start) / samples
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return seek_seconds / grab_seconds
+
+
+def _seek(cap, target_frame):
+    """Seek to target_frame and return the frame the capture is at. Some videos land on a later frame than
+    asked, then the seek is retried from further back, so the result is past target_frame only if every retry
+    failed."""
+    back_off = 0
+    for _ in range(seek_retries + 1):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, max(0, target_frame - back_off))
+        current_frame = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if current_frame <= target_frame:
             break
-        if current_frame in frame_numbers:
-            frame_path = os.path.join(output_dir, f'frame_{current_frame}.png')
-            print(f"Saving frame: {frame_path}")
-            cv2.imwrite(frame_path, frame)
+        back_off = max(1, back_off) * 2
+    return current_frame
+
 
+def iter_frames(cap, frame_index, seek_threshold=seek_threshold):
+    """Yield (frame_number, frame) for every frame in the sorted frame_index, decoding only those frames"""
+    profiler = get_profiler()
+    if seek_threshold is None:
+        with profiler.stage('seek'):
+            seek_threshold = measure_seek_threshold(cap)
+    current_frame = 0
+    for target_frame in frame_index:
+        with profiler.stage('seek'):
+            gap = target_frame - current_frame
+            # a negative gap is left behind by a seek that couldn't get back before its target
+            if gap > seek_threshold or gap < 0:
+                current_frame = _seek(cap, target_frame)
+                if current_frame > target_frame:
+                    # reading now would label a later frame as the target
+                    print(f"Seeking to frame {target_frame} lands on frame {current_frame}, skipping it")
+                    continue
+            while current_frame < target_frame:
+                if not cap.grab():
+                    return
+                current_frame += 1
+
+        with profiler.stage('decode'):
+            ret, frame = cap.read()
+        if not ret:
+            return
         current_frame += 1
+        yield target_frame, frame
+
+
+def frame_path_for(output_dir, frame_num, writer):
+    return writer.output_name(os.path.join(output_dir, f'frame_{frame_num}.png'))
+
+
+def extract_frames(video_path, frame_numbers, output_dir, workers=write_workers, max_pending=max_pending_writes,
+                   manifest=None, writer=None):
+    frame_index = build_frame_index(frame_numbers)
+    writer = writer or ImageWriter(output_format, output_quality)
+
+    keys = {}
+    if manifest is not None:
+        # a frame only depends on the video, which is too large to hash, so size and mtime stand in for it
+        video_digest = manifest.input_digest(video_path, content=False)
+        keys = {frame_num: manifest.make_key('extract', video_digest, frame_num, *writer.key_parts())
+                for frame_num in frame_index}
+        frame_index = [frame_num for frame_num in frame_index
+                       if not manifest.is_fresh(keys[frame_num], frame_path_for(output_dir, frame_num, writer))]
+
+    cap = cv2.VideoCapture(video_path)
+    profiler = get_profiler()
+    profiler.reset_progress()
+
+    # the semaphore bounds how many decoded frames can be queued for the writer threads
+    pending = threading.Semaphore(max_pending)
+
+    def write_frame(frame_path, frame):
+        try:
+            with profiler.stage('encode'):
+                writer.write(frame_path, frame)
+            profiler.add_frames(total=len(frame_index))
+        finally:
+            pending.release()
+
+    # cv2.imencode releases the GIL, so encoding runs in parallel with decoding the next frame
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for frame_num, frame in iter_frames(cap, frame_index):
+            frame_path = frame_path_for(output_dir, frame_num, writer)
+            pending.acquire()
+            futures.append((frame_num, frame_path, executor.submit(write_frame, frame_path, frame)))
+        for frame_num, frame_path, future in futures:
+            future.result()
+            if manifest is not None:
+                manifest.record(keys[frame_num], frame_path)
 
     cap.release()
+    return len(futures)
+
+
+def extract_video(video_name, video_path, xml_path, frames_root='frames', labels=labels, incremental=incremental):
+    """Extract the annotated frames of one video into frames_root/<video_name>, returns the number of frames written"""
+    with get_profiler().stage('xml_read'):
+        frame_numbers = parse_xml(xml_path, labels)
+    frames_dir = create_frames_directory(frames_root, video_name)
+    manifest = BuildManifest(manifest_path_for(frames_dir)) if incremental else None
+    count = extract_frames(video_path, frame_numbers, frames_dir, manifest=manifest)
+    if manifest is not None:
+        manifest.finish()
+    return count
+
+
+def keyframe_positions(video_path):
+    """Frame numbers of the video's keyframes, found by demuxing without decoding.
+    Empty if this OpenCV build can't report keyframes, segments are then cut anywhere."""
+    has_key_frame = getattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME', None)
+    if has_key_frame is None:
+        return []
+    try:
+        # CAP_PROP_FORMAT -1 makes grab() return the compressed packets
+        cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    except cv2.error:
+        return []
+    keyframes = []
+    frame_num = 0
+    while cap.grab():
+        if cap.get(has_key_frame):
+            keyframes.append(frame_num)
+        frame_num += 1
+    cap.release()
+    return keyframes
+
+
+def plan_segments(frame_index, keyframes, segment_frames=segment_frames):
+    """Split the sorted frame_index into segments that span about segment_frames video frames.
+    A segment only ends where a keyframe lies between its last frame and the next one, so no group of
+    pictures is decoded by two workers."""
+    segments = []
+    for frame in frame_index:
+        if segments:
+            current = segments[-1]
+            same_gop = keyframes and bisect_right(keyframes, frame) == bisect_right(keyframes, current[-1])
+            if frame - current[0] < segment_frames or same_gop:
+                current.append(frame)
+                continue
+        segments.append([frame])
+    return segments
+
+
+def _init_decode_worker():
+    # one decode per process, so OpenCV's own thread pool would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def _extract_segment(task):
+    """Decode one segment in a worker process, writing image files or rows of the raw memmap"""
+    video_path, frames, output_dir, fmt, quality, raw, threshold = task
+    writer = ImageWriter(fmt, quality) if raw is None else None
+    profiler = get_profiler()
+    images = None
+    if raw is not None:
+        raw_path, shape, first_slot = raw
+        images = np.memmap(raw_path, dtype=np.uint8, mode='r+', shape=shape)
+
+    cap = cv2.VideoCapture(video_path)
+    written = []
+    for frame_num, frame in iter_frames(cap, frames, threshold):
+        if images is not None:
+            if frame.shape != shape[1:]:
+                raise ValueError(f"Frame {frame_num} of {video_path} is {frame.shape}, expected {shape[1:]}")
+            images[first_slot + len(written)] = frame
+        else:
+            with profiler.stage('encode'):
+                writer.write(frame_path_for(output_dir, frame_num, writer), frame)
+        written.append(frame_num)
+    cap.release()
+    if images is not None:
+        images.flush()
+
+    # timings go back to the main process with the result
+    snapshot = profiler.snapshot(reset=True)
+    snapshot['frames'] = len(written)
+    return written, snapshot
+
+
+def _measure_video(video_path):
+    with get_profiler().stage('seek'):
+        cap = cv2.VideoCapture(video_path)
+        threshold = measure_seek_threshold(cap)
+        cap.release()
+    return threshold
+
+
+def _frame_shape(video_path):
+    cap = cv2.VideoCapture(video_path)
+    ret, frame = cap.read()
+    cap.release()
+    if not ret:
+        raise ValueError(f"Could not read {video_path}")
+    return frame.shape
+
+
+def discover_videos(video_dir, annotation_dir):
+    """(video, annotation) pairs for every video in video_dir with a <name>.xml or <stem>.xml in annotation_dir"""
+    pairs = []
+    for file_name in sorted(os.listdir(video_dir)):
+        if not file_name.lower().endswith(video_extensions):
+            continue
+        candidates = [os.path.join(annotation_dir, file_name + '.xml'),
+                      os.path.join(annotation_dir, os.path.splitext(file_name)[0] + '.xml')]
+        xml_file = next((path for path in candidates if os.path.exists(path)), None)
+        if xml_file is None:
+            print(f"No annotations for {file_name}, skipping")
+            continue
+        pairs.append((os.path.join(video_dir, file_name), xml_file))
+    return pairs
+
+
+def extract_videos(videos, output_root='frames', labels=labels, fmt=output_format, quality=output_quality, workers=None,
+                   segment_frames=segment_frames, incremental=incremental):
+    """Extract the annotated frames of every (video, annotation) pair into output_root/<video name>.
+    Segments of all videos share one process pool, results are merged back per video in frame order.
+    Returns {video name: number of frames written}."""
+    writer = ImageWriter(fmt, quality) if fmt != 'raw' else None
+    profiler = get_profiler()
+    tasks, owners, plans = [], [], []
+    for video_path, xml_file in videos:
+        name = os.path.basename(video_path)
+        with profiler.stage('xml_read'):
+            frame_index = build_frame_index(parse_xml(xml_file, labels))
+        output_dir = create_frames_directory(output_root, name)
+
+        manifest, keys, raw = None, {}, None
+        if fmt == 'raw':
+            # raw output is one file per video, so it is always rewritten as a whole
+            shape = (len(frame_index), *_frame_shape(video_path))
+            raw_path = os.path.join(output_dir, 'frames.u8')
+            if frame_index:
+                np.memmap(raw_path, dtype=np.uint8, mode='w+', shape=shape).flush()
+            else:
+                # numpy can't map an empty file, frames.json still records the empty shape
+                open(raw_path, 'wb').close()
+        elif incremental:
+            manifest = BuildManifest(manifest_path_for(output_dir))
+            video_digest = manifest.input_digest(video_path, content=False)
+            keys = {frame_num: manifest.make_key('extract', video_digest, frame_num, *writer.key_parts())
+                    for frame_num in frame_index}
+            frame_index = [frame_num for frame_num in frame_index
+                           if not manifest.is_fresh(keys[frame_num], frame_path_for(output_dir, frame_num, writer))]
+
+        long_video = frame_index and frame_index[-1] - frame_index[0] >= segment_frames
+        segments = plan_segments(frame_index, keyframe_positions(video_path) if long_video else [], segment_frames)
+        # measured once per video instead of in every segment's worker
+        threshold = _measure_video(video_path) if frame_index and seek_threshold is None else seek_threshold
+        slot = 0
+        for segment in segments:
+            if fmt == 'raw':
+                raw = (raw_path, shape, slot)
+                slot += len(segment)
+            tasks.append((video_path, segment, output_dir, fmt, quality, raw, threshold))
+            owners.append(len(plans))
+        plans.append({'name': name, 'output_dir': output_dir, 'manifest': manifest, 'keys': keys,
+                      'frames': frame_index, 'shape': shape if fmt == 'raw' else None, 'written': []})
+
+    total = sum(len(plan['frames']) for plan in plans)
+    profiler.reset_progress()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker) as executor:
+        # map keeps the task order, so every video's frames come back in frame order
+        for owner, (written, snapshot) in zip(owners, executor.map(_extract_segment, tasks)):
+            plans[owner]['written'].extend(written)
+            profiler.merge(snapshot, total=total)
+
+    counts = {}
+    for plan in plans:
+        manifest = plan['manifest']
+        if fmt == 'raw':
+            written = set(plan['written'])
+            with open(os.path.join(plan['output_dir'], 'frames.json'), 'w') as f:
+                # frame number of every row, -1 for rows left empty by frames past the end of the video
+                json.dump({'shape': list(plan['shape']),
+                           'frames': [frame_num if frame_num in written else -1 for frame_num in plan['frames']]}, f)
+        elif manifest is not None:
+            for frame_num in plan['written']:
+                manifest.record(plan['keys'][frame_num], frame_path_for(plan['output_dir'], frame_num, writer))
+            manifest.finish()
+        counts[plan['name']] = len(plan['written'])
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the annotated frames of one or more videos")
+    parser.add_argument("--video", nargs=2, action="append", metavar=("VIDEO", "ANNOTATIONS"),
+                        help="A video and its CVAT annotation file, can be given several times")
+    parser.add_argument("--video-dir", help="Extract every video in this folder that has annotations")
+    parser.add_argument("--annotation-dir", default='annotations', help="Where --video-dir looks for <video>.xml")
+    parser.add_argument("--output", default='frames', help="Frames go to OUTPUT/<video name>")
+    parser.add_argument("--labels", nargs="+", default=list(labels), help="Only extract frames with these labels")
+    parser.add_argument("--format", choices=['png', 'jpeg', 'webp', 'npy', 'raw'], default=output_format)
+    parser.add_argument("--quality", type=int, default=output_quality, help="JPEG/WebP quality, or PNG compression level 0-9")
+    parser.add_argument("--workers", type=int, default=None, help="Decode processes, default all cores")
+    parser.add_argument("--segment-frames", type=int, default=segment_frames)
+    args = parser.parse_args()
 
+    videos = [tuple(pair) for pair in args.video or []]
+    if args.video_dir:
+        videos.extend(discover_videos(args.video_dir, args.annotation_dir))
+    if not args.video and not args.video_dir:
+        videos = [(video_path, xml_path)]
 
-def main(video_name, video_path, xml_path):
-    frame_numbers = parse_xml(xml_path)
-    frames_dir = create_frames_directory('frames', video_name)
-    extract_frames(video_path, frame_numbers, frames_dir)
+    profiler = start_run('frame_extractor')
+    counts = extract_videos(videos, args.output, tuple(args.labels), args.format, args.quality, args.workers,
+                            args.segment_frames)
+    for name, count in counts.items():
+        print(f"{name}: {count} frames")
+    profiler.finish(report_path)
 
 
-main(video_name, video_path, xml_path)
+if __name__ == '__main__':
+    main()
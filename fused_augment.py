@@ -0,0 +1,87 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from augmentation import (read_xml, write_xml, augment_sample, stable_seed, build_tasks, task_key, task_outputs,
+                          init_worker, transform_version, get_writer)
+from build_cache import BuildManifest, manifest_path_for
+from cam_effect import OV2640Engine, effect_parameters
+from image_io import read_image
+
+# Runs augmentation.py and cam_effect.py back to back on in-memory arrays. Previously augmented copies were
+# written to augmented/<name>/images and read back by cam_effect.py, a full encode/decode/encode round-trip
+# per image. Here only the final degraded image and its annotation are written. The boxes come straight
+# from the augmentation step, the camera effect doesn't move them, same as in the two-step pipeline.
+
+# one OV2640Engine per resolution in every worker process
+_engines = {}
+
+
+def _engine(batch_size, height, width):
+    engine = _engines.get((height, width))
+    if engine is None or engine.shape[0] < batch_size:
+        engine = _engines[(height, width)] = OV2640Engine(batch_size, height, width)
+    return engine
+
+
+def _process_chunk(tasks):
+    """Augment and degrade a chunk of tasks, the camera effect runs on the whole chunk as one batch per resolution"""
+    augmented = {}
+    for task in tasks:
+        image_path, xml_path, _, prefix, iteration = task
+        seed = stable_seed(image_path, iteration)
+        image, boxes, object_ids = augment_sample(read_image(image_path), read_xml(xml_path), seed)
+        augmented.setdefault(image.shape[:2], []).append((task, image, (boxes, object_ids), seed))
+
+    writer = get_writer()
+    for (height, width), items in augmented.items():
+        engine = _engine(len(items), height, width)
+        for i, (_, image, _, _) in enumerate(items):
+            engine.input[i] = image
+        # the noise is seeded per image as well, so the output doesn't depend on how tasks are chunked
+        results = engine.process(engine.input[:len(items)], seeds=[seed for _, _, _, seed in items])
+        for (task, _, (boxes, object_ids), _), result in zip(items, results):
+            img_save_path, xml_save_path = task_outputs(task, writer)
+            writer.write(img_save_path, result)
+            write_xml(boxes, task[1], xml_save_path, os.path.basename(img_save_path), object_ids)
+    return len(tasks)
+
+
+def fused_task_key(manifest, task):
+    return manifest.make_key('fused', task_key(manifest, task), transform_version, effect_parameters())
+
+
+def augment_and_degrade(image_dir, xml_dir, output_dir, copies=3, workers=None, chunk_size=32, manifest=None):
+    """Write copies augmented + OV2640 degraded versions of every image in image_dir to output_dir/images,
+    with their annotations in output_dir/annotations"""
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'annotations'), exist_ok=True)
+
+    tasks = build_tasks(image_dir, xml_dir, output_dir, copies)
+    keys = {}
+    if manifest is not None:
+        keys = {task: fused_task_key(manifest, task) for task in tasks}
+        tasks = [task for task in tasks if not manifest.is_fresh(keys[task], *task_outputs(task))]
+
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        count = sum(executor.map(_process_chunk, chunks))
+
+    if manifest is not None:
+        for task in tasks:
+            manifest.record(keys[task], *task_outputs(task))
+    return count
+
+
+def main(workers=None, incremental=True):
+    image_dir = 'compressed/fruits.mp4/frames_128 x 128'
+    xml_dir = 'compressed/fruits.mp4/annotations_128 x 128'
+    output_dir = 'compressed_augmented_and_processed/fruits'
+
+    manifest = BuildManifest(manifest_path_for(output_dir)) if incremental else None
+    count = augment_and_degrade(image_dir, xml_dir, output_dir, copies=3, workers=workers, manifest=manifest)
+    if manifest is not None:
+        manifest.finish()
+    print(f"Augmented and processed {count} images into {output_dir}")
+
+
+if __name__ == '__main__':
+    main()
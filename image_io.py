@@ -0,0 +1,138 @@
+import io
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+from profiling import get_profiler
+
+# Image reading and writing shared by every stage, so the output format of each stage is a setting instead of
+# whatever the file extension passed to cv2.imwrite happens to be. Formats:
+#   png   lossless, quality is the zlib level 0-9 (lower is faster and bigger)
+#   jpeg  lossy, quality 0-100
+#   webp  lossy below quality 100 and lossless at 101, slower to encode than jpeg but smaller
+#   npy   uncompressed array with a small header, the fastest choice for intermediates that are read back once
+# Every write is counted per format in the profiler (encode time and bytes), so profiling reports show what
+# each format costs for a stage.
+
+extensions = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'npy': '.npy'}
+formats_by_extension = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp', '.npy': 'npy'}
+# None keeps OpenCV's own default
+default_quality = {'png': None, 'jpeg': 95, 'webp': 90, 'npy': None}
+quality_flags = {'png': cv2.IMWRITE_PNG_COMPRESSION, 'jpeg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY}
+# extensions tried by find_image, in order
+search_order = ('.png', '.jpg', '.jpeg', '.webp', '.npy')
+
+
+def format_of(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in formats_by_extension:
+        raise ValueError(f"Unknown image format for {path}, expected one of {', '.join(formats_by_extension)}")
+    return formats_by_extension[extension]
+
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in formats_by_extension
+
+
+def find_image(directory, stem):
+    """Path of the image stem.<ext> in directory for any known format, or None"""
+    for extension in search_order:
+        path = os.path.join(directory, stem + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    """Read a BGR image like cv2.imread (None if it can't be read), .npy files are loaded as they were saved"""
+    if path.lower().endswith('.npy'):
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+    return cv2.imread(path, flags)
+
+
+def _npy_bytes(image):
+    buffer = io.BytesIO()
+    np.save(buffer, image)
+    return buffer.getvalue()
+
+
+class ImageWriter:
+    """Writes images in one format and quality. With fmt None the format follows each file name's extension,
+    which is what the stages did before they had a format setting."""
+
+    def __init__(self, fmt=None, quality=None):
+        if fmt is not None and fmt not in extensions:
+            raise ValueError(f"Unknown image format {fmt}, expected one of {', '.join(extensions)}")
+        self.fmt = fmt
+        self.quality = quality
+
+    def output_name(self, name):
+        """name with the extension of this writer's format"""
+        if self.fmt is None:
+            return name
+        return os.path.splitext(name)[0] + extensions[self.fmt]
+
+    def key_parts(self):
+        """Settings that change the decoded pixels, for build_cache keys. Lossless formats change only the
+        file name, which the manifest already checks."""
+        return () if self.fmt in (None, 'png', 'npy') else (self.fmt, self.quality)
+
+    def params(self, fmt):
+        quality = self.quality if self.quality is not None and fmt == self.fmt else default_quality[fmt]
+        return [] if quality is None else [quality_flags[fmt], int(quality)]
+
+    def encode(self, image, fmt=None):
+        """Encode to bytes in memory, in this writer's format or fmt"""
+        fmt = fmt or self.fmt or 'png'
+        start = time.perf_counter()
+        if fmt == 'npy':
+            data = _npy_bytes(image)
+        else:
+            ok, buffer = cv2.imencode(extensions[fmt], image, self.params(fmt))
+            if not ok:
+                raise ValueError(f"Could not encode image as {fmt}")
+            data = buffer.tobytes()
+        get_profiler().add_encode(fmt, time.perf_counter() - start, len(data))
+        return data
+
+    def write(self, path, image):
+        """Write image to path, with the extension replaced by the writer's format. Returns the path written."""
+        path = self.output_name(path)
+        data = self.encode(image, format_of(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        get_profiler().add_bytes(written=len(data))
+        return path
+
+
+def compare_formats(images, settings):
+    """Encode every image with every (format, quality) in settings, returns one report row per setting"""
+    rows = []
+    for fmt, quality in settings:
+        writer = ImageWriter(fmt, quality)
+        start = time.perf_counter()
+        size = sum(len(writer.encode(image)) for image in images)
+        seconds = time.perf_counter() - start
+        rows.append({'format': fmt, 'quality': quality, 'ms_per_image': seconds / len(images) * 1000,
+                     'kb_per_image': size / len(images) / 1024})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare encode time and size of the image formats on sample images")
+    parser.add_argument("image_dir", help="Folder with sample images, e.g. extracted frames")
+    parser.add_argument("--limit", type=int, default=50, help="Number of images to sample")
+    args = parser.parse_args()
+
+    names = sorted(f for f in os.listdir(args.image_dir) if is_image(f))[:args.limit]
+    images = [image for image in (read_image(os.path.join(args.image_dir, name)) for name in names) if image is not None]
+    if not images:
+        parser.error(f"no readable images in {args.image_dir}")
+    settings = [('png', 0), ('png', 1), ('png', 3), ('png', 9), ('jpeg', 95), ('jpeg', 80), ('webp', 90), ('npy', None)]
+    for row in compare_formats(images, settings):
+        quality = '' if row['quality'] is None else row['quality']
+        print(f"{row['format']:<5} {quality:>4}  {row['ms_per_image']:8.2f} ms  {row['kb_per_image']:9.1f} KB per image")
@@ -0,0 +1,121 @@
+import os
+import json
+import argparse
+import numpy as np
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from image_io import ImageWriter, is_image, read_image
+from pascal_voc import PascalVocAnnotation
+
+# Packs a folder of same-size images plus their Pascal VOC files into a few flat files:
+#   <name>.images.u8   uint8 memmap of shape (N, H, W, 3), BGR like image_io.read_image
+#   <name>.boxes.npy   float32 (M, 4) xmin, ymin, xmax, ymax for all images, in image order
+#   <name>.labels.npy  int16 (M,) label id per box
+#   <name>.offsets.npy int64 (N + 1,) boxes of image i are rows offsets[i]:offsets[i + 1]
+#   <name>.json        shape, label names and image file names
+# Loading an epoch is then one sequential read of the image file instead of N file opens and PNG decodes.
+
+def _read_voc(xml_path):
+    root = ET.parse(xml_path).getroot()
+    objects = []
+    for obj in root.findall('object'):
+        bndbox = obj.find('bndbox')
+        objects.append((obj.find('name').text, [float(bndbox.find(tag).text) for tag in ('xmin', 'ymin', 'xmax', 'ymax')]))
+    return objects
+
+
+def export_dataset(image_dir, xml_dir, output_prefix, workers=8):
+    """Pack every image in image_dir that has an annotation in xml_dir into output_prefix.*"""
+    image_files = sorted(f for f in os.listdir(image_dir) if is_image(f))
+    image_files = [f for f in image_files if os.path.exists(os.path.join(xml_dir, os.path.splitext(f)[0] + '.xml'))]
+    if not image_files:
+        raise ValueError(f"No annotated images found in {image_dir}")
+
+    first = read_image(os.path.join(image_dir, image_files[0]))
+    height, width = first.shape[:2]
+    images = np.memmap(f'{output_prefix}.images.u8', dtype=np.uint8, mode='w+', shape=(len(image_files), height, width, 3))
+
+    def load(i):
+        image = read_image(os.path.join(image_dir, image_files[i]))
+        if image is None or image.shape != (height, width, 3):
+            raise ValueError(f"{image_files[i]} is not a {width}x{height} BGR image like the rest of the dataset")
+        images[i] = image
+        return _read_voc(os.path.join(xml_dir, os.path.splitext(image_files[i])[0] + '.xml'))
+
+    # decoding runs on threads, every thread writes its image straight into the memmap
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        annotations = list(executor.map(load, range(len(image_files))))
+    images.flush()
+
+    labels = sorted({name for objects in annotations for name, _ in objects})
+    label_ids = {name: i for i, name in enumerate(labels)}
+    counts = np.array([len(objects) for objects in annotations], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    boxes = np.array([box for objects in annotations for _, box in objects], dtype=np.float32).reshape(-1, 4)
+    box_labels = np.array([label_ids[name] for objects in annotations for name, _ in objects], dtype=np.int16)
+
+    np.save(f'{output_prefix}.boxes.npy', boxes)
+    np.save(f'{output_prefix}.labels.npy', box_labels)
+    np.save(f'{output_prefix}.offsets.npy', offsets)
+    with open(f'{output_prefix}.json', 'w') as f:
+        json.dump({'shape': [len(image_files), height, width, 3], 'labels': labels, 'files': image_files}, f)
+
+    print(f"Packed {len(image_files)} images and {len(boxes)} boxes into {output_prefix}")
+    return len(image_files)
+
+
+class PackedDataset:
+    """Zero-copy random access to a dataset written by export_dataset"""
+
+    def __init__(self, prefix):
+        with open(f'{prefix}.json') as f:
+            meta = json.load(f)
+        self.labels = meta['labels']
+        self.files = meta['files']
+        self.images = np.memmap(f'{prefix}.images.u8', dtype=np.uint8, mode='r', shape=tuple(meta['shape']))
+        self.boxes = np.load(f'{prefix}.boxes.npy', mmap_mode='r')
+        self.box_labels = np.load(f'{prefix}.labels.npy', mmap_mode='r')
+        self.offsets = np.load(f'{prefix}.offsets.npy')
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        """Return (image, boxes, label ids) for image i, all views into the memory-mapped files"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.images[i], self.boxes[start:end], self.box_labels[start:end]
+
+    def load_all(self):
+        """Read every image with one sequential read, e.g. for a full epoch"""
+        return np.array(self.images)
+
+    def to_voc(self, image_dir, xml_dir):
+        """Write the packed dataset back out as images and Pascal VOC files"""
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(xml_dir, exist_ok=True)
+        height, width = self.images.shape[1:3]
+        # every file is written in the format of its name, like the images it was packed from
+        writer = ImageWriter()
+        for i, file_name in enumerate(self.files):
+            image, boxes, label_ids = self[i]
+            writer.write(os.path.join(image_dir, file_name), image)
+            annotation = PascalVocAnnotation(file_name, width, height)
+            for label_id, (xmin, ymin, xmax, ymax) in zip(label_ids, boxes):
+                annotation.add_object(self.labels[label_id], xmin, ymin, xmax, ymax)
+            annotation.write(os.path.join(xml_dir, os.path.splitext(file_name)[0] + '.xml'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack a 128x128 image + Pascal VOC dataset into a memory-mapped array and box index")
+    parser.add_argument("output_prefix", help="Prefix of the packed dataset files")
+    parser.add_argument("--images", help="Folder with the images to pack")
+    parser.add_argument("--annotations", help="Folder with the matching Pascal VOC files")
+    parser.add_argument("--to-voc", nargs=2, metavar=("IMAGE_DIR", "XML_DIR"), help="Unpack output_prefix back to images and VOC files")
+    args = parser.parse_args()
+
+    if args.to_voc:
+        PackedDataset(args.output_prefix).to_voc(*args.to_voc)
+    else:
+        if not args.images or not args.annotations:
+            parser.error("--images and --annotations are required to pack a dataset")
+        export_dataset(args.images, args.annotations, args.output_prefix)
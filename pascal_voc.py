@@ -1,6 +1,7 @@
 import os
 import xml.etree.ElementTree as ET
 import xml.dom.minidom as minidom
+from xml.sax.saxutils import escape as xml_escape
 
 
 def write_pascal_voc(file_path, filename, label, width, height, xtl, ytl, xbr, ybr):
@@ -82,3 +83,85 @@ def append_object_to_pascal_voc(file_path, label, xtl, ytl, xbr, ybr):
 
     except Exception as e:
         print(f"Error updating XML: {e}")
+
+
+def _format_object(label, xtl, ytl, xbr, ybr):
+    return f'''  <object>
+    <name>{label}</name>
+    <truncated>0</truncated>
+    <occluded>0</occluded>
+    <difficult>0</difficult>
+    <bndbox>
+      <xmin>{float(xtl)}</xmin>
+      <ymin>{float(ytl)}</ymin>
+      <xmax>{float(xbr)}</xmax>
+      <ymax>{float(ybr)}</ymax>
+    </bndbox>
+  </object>
+'''
+
+
+class PascalVocAnnotation:
+    """Collects all objects of one image in memory so the annotation file is written exactly once"""
+
+    def __init__(self, filename, width, height, folder='frame'):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.folder = folder
+        self.objects = []
+
+    def add_object(self, label, xtl, ytl, xbr, ybr):
+        self.objects.append((label, xtl, ytl, xbr, ybr))
+        return self
+
+    def to_string(self, escape=True):
+        # the layout is fixed, so pretty-printing is plain string formatting instead of a minidom round-trip
+        esc = xml_escape if escape else str
+        objects = ''.join(_format_object(esc(label), xtl, ytl, xbr, ybr)
+                          for label, xtl, ytl, xbr, ybr in self.objects)
+        return f'''<annotation>
+  <folder>{esc(self.folder)}</folder>
+  <filename>{esc(self.filename)}</filename>
+  <source>
+    <database>Unknown</database>
+    <annotation>Unknown</annotation>
+    <image>Unknown</image>
+  </source>
+  <size>
+    <width>{self.width}</width>
+    <height>{self.height}</height>
+    <depth></depth>
+  </size>
+  <segmented>0</segmented>
+{objects}</annotation>'''
+
+    def write(self, file_path, escape=True):
+        with open(file_path, 'w') as file:
+            file.write(self.to_string(escape))
+
+
+class PascalVocWriter:
+    """Buffers the annotations for a whole directory and writes every file in one pass on flush()"""
+
+    def __init__(self, output_dir, escape=True):
+        self.output_dir = output_dir
+        self.escape = escape
+        self.annotations = {}
+
+    def annotation(self, xml_name, filename, width, height):
+        """Return the annotation for xml_name, creating it on first use"""
+        if xml_name not in self.annotations:
+            self.annotations[xml_name] = PascalVocAnnotation(filename, width, height)
+        return self.annotations[xml_name]
+
+    def add_object(self, xml_name, filename, width, height, label, xtl, ytl, xbr, ybr):
+        return self.annotation(xml_name, filename, width, height).add_object(label, xtl, ytl, xbr, ybr)
+
+    def flush(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for xml_name, annotation in self.annotations.items():
+            annotation.write(os.path.join(self.output_dir, xml_name), self.escape)
+        count = len(self.annotations)
+        self.annotations = {}
+        return count
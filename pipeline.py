@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from augmentation import augment_batch, init_worker
+from build_cache import BuildManifest, manifest_path_for
+from cam_effect import process_folder
+from compress_simple import compress_video, output_dirs
+from frame_extractor import extract_video
+from packed_dataset import export_dataset
+from profiling import start_run
+from remove_frames import clear_pruned_list, prune_frames
+from shard_writer import write_shards
+
+# Runs the dataset pipeline for many videos at once, instead of hand-editing the paths at the top of every script.
+# Every video goes through the selected stages in this order, each stage reading the output of the previous one:
+#   extract    frames/<video>                                     (frame_extractor.py)
+#   prune      frames/.pruned-<video>.json, near duplicates listed  (remove_frames.py)
+#   compress   compressed/<video>/frames_WxH, annotations_WxH      (compress_simple.py)
+#   augment    augmented/<video>/images, annotations              (augmentation.py)
+#   cam_effect processed/<video>/images                            (cam_effect.py)
+#   export     exports/<video>/<video>-*.tfrecord or packed arrays  (shard_writer.py, packed_dataset.py)
+# (video, stage) tasks form a DAG that runs on one process pool. A ready task of a video that is already in progress
+# is always started before the first stage of a new video, and at most max_active_videos videos are in progress,
+# so the pool works the pipeline depth first and intermediate frames don't pile up on disk.
+#
+# Example config, paths are relative to the working directory:
+# {
+#   "videos": [{"name": "fruits.mp4", "video": "videos/fruits.mp4", "annotations": "annotations/annotations_train.xml"}],
+#   "stages": ["extract", "compress", "augment", "cam_effect", "export"],
+#   "target_sizes": [[128, 128]],
+#   "copies": 3
+# }
+
+stage_order = ['extract', 'prune', 'compress', 'augment', 'cam_effect', 'export']
+default_config = {
+    'stages': ['extract', 'compress', 'augment', 'cam_effect', 'export'],
+    'labels': ['orange', 'apple', 'banana'],
+    'target_sizes': [[128, 128]],
+    'prune_metric': 'dhash',
+    'prune_threshold': 10,
+    'copies': 3,
+    'export_format': 'tfrecord',  # tfrecord, simple or packed
+    'incremental': True,
+    'frames_root': 'frames',
+    'compressed_root': 'compressed',
+    'augmented_root': 'augmented',
+    'processed_root': 'processed',
+    'export_root': 'exports',
+}
+report_path = 'reports/pipeline.json'
+
+
+def _augmented_dir(video, config):
+    return os.path.join(config['augmented_root'], video['name'])
+
+
+def _processed_dir(video, config):
+    return os.path.join(config['processed_root'], video['name'], 'images')
+
+
+def _manifest(output_dir, config):
+    return BuildManifest(manifest_path_for(output_dir)) if config['incremental'] else None
+
+
+def _finish(manifest):
+    if manifest is not None:
+        manifest.finish()
+
+
+def run_extract(video, config):
+    return extract_video(video['name'], video['video'], video['annotations'], config['frames_root'],
+                         tuple(config['labels']), config['incremental'])
+
+
+def run_prune(video, config):
+    # the extracted frames stay, so incremental extract runs keep skipping them, compress skips the listed ones
+    frames_dir = os.path.join(config['frames_root'], video['name'])
+    keep = prune_frames(frames_dir, config['prune_metric'], config['prune_threshold'], workers=1, list_only=True)
+    return int(keep.sum())
+
+
+def run_compress(video, config):
+    # the list of an earlier run's prune stage only applies while prune is among the stages
+    use_pruned_list = 'prune' in config['stages']
+    frames_dir = os.path.join(config['frames_root'], video['name'])
+    if not use_pruned_list and clear_pruned_list(frames_dir):
+        print(f"Removed the pruned frames list of {frames_dir}, prune is not among the stages")
+    return compress_video(video['name'], video['annotations'], [tuple(size) for size in config['target_sizes']],
+                          config['frames_root'], config['compressed_root'], config['labels'], config['incremental'],
+                          use_pruned_list=use_pruned_list)
+
+
+def run_augment(video, config):
+    # augmentation and the camera effect run on the first target size
+    image_dirs, annotation_dirs = output_dirs(video['name'], [tuple(config['target_sizes'][0])], config['compressed_root'])
+    save_dir = _augmented_dir(video, config)
+    manifest = _manifest(save_dir, config)
+    # the pipeline already runs one task per core, so the stage itself stays in this process
+    count = augment_batch(*image_dirs.values(), *annotation_dirs.values(), save_dir, config['copies'], workers=1,
+                          manifest=manifest)
+    _finish(manifest)
+    return count
+
+
+def run_cam_effect(video, config):
+    output_folder = _processed_dir(video, config)
+    manifest = _manifest(output_folder, config)
+    count = process_folder(os.path.join(_augmented_dir(video, config), 'images'), output_folder, manifest=manifest)
+    _finish(manifest)
+    return count
+
+
+def run_export(video, config):
+    # the camera effect doesn't move boxes, so processed images pair with the augmented annotations
+    if 'cam_effect' in config['stages']:
+        image_dir = _processed_dir(video, config)
+    else:
+        image_dir = os.path.join(_augmented_dir(video, config), 'images')
+    xml_dir = os.path.join(_augmented_dir(video, config), 'annotations')
+    output_prefix = os.path.join(config['export_root'], video['name'], os.path.splitext(video['name'])[0])
+    os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+
+    if config['export_format'] == 'packed':
+        return export_dataset(image_dir, xml_dir, output_prefix, workers=1)
+    return write_shards(image_dir, xml_dir, output_prefix, config['export_format'], workers=1)
+
+
+stage_functions = {
+    'extract': run_extract,
+    'prune': run_prune,
+    'compress': run_compress,
+    'augment': run_augment,
+    'cam_effect': run_cam_effect,
+    'export': run_export,
+}
+
+
+def _run_task(stage, video, config):
+    """Run one stage for one video in a worker process, returns its result and profiling report"""
+    profiler = start_run(f"{stage}:{video['name']}", interval=float('inf'))
+    result = stage_functions[stage](video, config)
+    return result, profiler.report()
+
+
+def build_dag(videos, config):
+    """Return {(video name, stage): dependencies}, every selected stage depends on the previous selected stage
+    of the same video. Videos don't depend on each other."""
+    stages = [stage for stage in stage_order if stage in config['stages']]
+    tasks = {}
+    for video in videos:
+        previous = None
+        for stage in stages:
+            tasks[(video['name'], stage)] = [previous] if previous else []
+            previous = (video['name'], stage)
+    return tasks
+
+
+def run_dag(videos, config, workers=None, max_active_videos=None):
+    """Run every (video, stage) task of the DAG on a process pool.
+    A video that fails skips its remaining stages, the other videos carry on."""
+    workers = workers or os.cpu_count()
+    max_active_videos = max_active_videos or workers * 2
+    tasks = build_dag(videos, config)
+    by_name = {video['name']: video for video in videos}
+    video_order = {video['name']: i for i, video in enumerate(videos)}
+    depth = {stage: i for i, stage in enumerate(stage_order)}
+
+    waiting = {task: set(dependencies) for task, dependencies in tasks.items()}
+    dependents = {task: [] for task in tasks}
+    for task, dependencies in tasks.items():
+        for dependency in dependencies:
+            dependents[dependency].append(task)
+    remaining_per_video = {name: 0 for name in by_name}
+    for name, _ in tasks:
+        remaining_per_video[name] += 1
+
+    ready = []
+    active_videos = set()
+    results, failures = {}, {}
+
+    def push(task):
+        name, stage = task
+        # later stages of started videos first, then videos in the order they were given
+        heapq.heappush(ready, (-depth[stage], video_order[name], task))
+
+    for task, dependencies in waiting.items():
+        if not dependencies:
+            push(task)
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        while ready or running:
+            deferred = []
+            while ready and len(running) < workers:
+                item = heapq.heappop(ready)
+                name, stage = item[2]
+                if name not in active_videos and len(active_videos) >= max_active_videos:
+                    # backpressure, wait for a video in progress to finish before starting another one
+                    deferred.append(item)
+                    continue
+                active_videos.add(name)
+                running[executor.submit(_run_task, stage, by_name[name], config)] = (item[2], time.perf_counter())
+            for item in deferred:
+                heapq.heappush(ready, item)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, started = running.pop(future)
+                name, stage = task
+                remaining_per_video[name] -= 1
+                try:
+                    result, report = future.result()
+                except Exception as e:
+                    failures[task] = repr(e)
+                    print(f"[{name}] {stage} failed: {e!r}")
+                    # drop the rest of this video's stages
+                    skipped = list(dependents[task])
+                    while skipped:
+                        skipped_task = skipped.pop()
+                        if skipped_task in waiting:
+                            del waiting[skipped_task]
+                            remaining_per_video[name] -= 1
+                            skipped.extend(dependents[skipped_task])
+                else:
+                    results[task] = {'result': result, 'seconds': round(time.perf_counter() - started, 3),
+                                     'report': report}
+                    print(f"[{name}] {stage} done in {results[task]['seconds']:.1f}s")
+                    for dependent in dependents[task]:
+                        waiting[dependent].discard(task)
+                        if not waiting[dependent]:
+                            push(dependent)
+                waiting.pop(task, None)
+                if remaining_per_video[name] == 0:
+                    active_videos.discard(name)
+    return results, failures
+
+
+def load_config(config_path=None, overrides=None):
+    config = dict(default_config)
+    if config_path:
+        with open(config_path) as f:
+            config.update(json.load(f))
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            config[key] = value
+
+    unknown = [stage for stage in config['stages'] if stage not in stage_functions]
+    if unknown:
+        raise ValueError(f"Unknown stage(s) {', '.join(unknown)}, expected some of {', '.join(stage_order)}")
+    for video in config.get('videos', []):
+        video.setdefault('name', os.path.basename(video['video']))
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the extract/prune/compress/augment/cam effect/export pipeline over many videos")
+    parser.add_argument("--config", help="JSON file with the videos and stage settings")
+    parser.add_argument("--video", nargs=2, action="append", metavar=("VIDEO", "ANNOTATIONS"),
+                        help="Add a video and its CVAT annotation file, can be given several times")
+    parser.add_argument("--stages", nargs="+", choices=stage_order, help="Stages to run, in pipeline order")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, default all cores")
+    parser.add_argument("--max-active-videos", type=int, default=None,
+                        help="Max videos in progress at once, default twice the number of workers")
+    parser.add_argument("--dry-run", action="store_true", help="Print the tasks and their dependencies and exit")
+    args = parser.parse_args()
+
+    config = load_config(args.config, {'stages': args.stages})
+    videos = list(config.get('videos', []))
+    for video_path, annotation_path in args.video or []:
+        videos.append({'name': os.path.basename(video_path), 'video': video_path, 'annotations': annotation_path})
+    if not videos:
+        parser.error("no videos given, use --video or a config file with a videos list")
+
+    if args.dry_run:
+        for (name, stage), dependencies in build_dag(videos, config).items():
+            after = ', '.join(f'{n}:{s}' for n, s in dependencies) or '-'
+            print(f"{name}:{stage} after {after}")
+        return
+
+    started = time.perf_counter()
+    results, failures = run_dag(videos, config, args.workers, args.max_active_videos)
+    elapsed = time.perf_counter() - started
+    print(f"Ran {len(results)} tasks for {len(videos)} videos in {elapsed:.1f}s, {len(failures)} failed")
+
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump({'elapsed_seconds': round(elapsed, 3), 'config': config,
+                   'tasks': {f'{name}:{stage}': value for (name, stage), value in results.items()},
+                   'failures': {f'{name}:{stage}': error for (name, stage), error in failures.items()}}, f, indent=2)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Shared instrumentation for the pipeline scripts. Stages are timed with `with get_profiler().stage('decode'):`,
+# frames and bytes are counted, and progress is printed at most every progress_interval seconds instead of
+# one line per frame. finish() prints a summary and can write a JSON run report.
+# Worker processes record into their own process-global profiler and send snapshot(reset=True) back to the
+# main process, which merge()s it.
+# A run can process several batches with their own total (one per test set, video or folder), so the progress
+# line counts from the last reset_progress() while the report counts every frame of the run.
+
+progress_interval = 2.0
+
+
+class Profiler:
+    def __init__(self, name='run', interval=progress_interval):
+        self.name = name
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}  # stage name -> [calls, seconds, items]
+        self.formats = {}  # image format -> [images, encode seconds, bytes], see image_io.py
+        self.frames = 0
+        self.progress = 0  # frames since reset_progress()
+        self.progress_started = self.started
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._last_progress = self.started
+
+    @contextmanager
+    def stage(self, name, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, items)
+
+    def add_time(self, name, seconds, items=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] += items
+
+    def add_encode(self, fmt, seconds, size):
+        with self.lock:
+            encoded = self.formats.setdefault(fmt, [0, 0.0, 0])
+            encoded[0] += 1
+            encoded[1] += seconds
+            encoded[2] += size
+
+    def add_bytes(self, read=0, written=0):
+        with self.lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def read_file(self, path):
+        """Count the size of a file that was just read"""
+        self.add_bytes(read=os.path.getsize(path))
+
+    def wrote_file(self, path):
+        """Count the size of a file that was just written"""
+        self.add_bytes(written=os.path.getsize(path))
+
+    def reset_progress(self):
+        """Start counting progress from zero, call before each batch whose total is passed to add_frames"""
+        with self.lock:
+            self.progress = 0
+            self.progress_started = time.perf_counter()
+
+    def add_frames(self, count=1, total=None):
+        """Count finished frames and print a progress line if the last one is older than the interval"""
+        with self.lock:
+            self.frames += count
+            self.progress += count
+            now = time.perf_counter()
+            if now - self._last_progress < self.interval:
+                return
+            self._last_progress = now
+            progress = self.progress
+            elapsed = now - self.progress_started
+        done = f"{progress}/{total}" if total else f"{progress}"
+        print(f"[{self.name}] {done} frames, {progress / elapsed:.1f} frames/s")
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            snapshot = {'stages': {name: list(values) for name, values in self.stages.items()},
+                        'formats': {fmt: list(values) for fmt, values in self.formats.items()},
+                        'frames': self.frames, 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+            if reset:
+                self.stages = {}
+                self.formats = {}
+                self.frames = self.progress = self.bytes_read = self.bytes_written = 0
+        return snapshot
+
+    def merge(self, snapshot, total=None):
+        """Add a snapshot from a worker process, frames count towards progress"""
+        with self.lock:
+            for name, (calls, seconds, items) in snapshot['stages'].items():
+                stage = self.stages.setdefault(name, [0, 0.0, 0])
+                stage[0] += calls
+                stage[1] += seconds
+                stage[2] += items
+            for fmt, (images, seconds, size) in snapshot.get('formats', {}).items():
+                encoded = self.formats.setdefault(fmt, [0, 0.0, 0])
+                encoded[0] += images
+                encoded[1] += seconds
+                encoded[2] += size
+            self.bytes_read += snapshot['bytes_read']
+            self.bytes_written += snapshot['bytes_written']
+        self.add_frames(snapshot['frames'], total)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            stage_seconds = sum(seconds for _, seconds, _ in self.stages.values())
+            stages = {name: {'calls': calls, 'seconds': round(seconds, 6), 'items': items,
+                             'ms_per_item': round(seconds / items * 1000, 4) if items else 0.0,
+                             # stages of worker threads and processes overlap, so shares are of summed stage time
+                             'share': round(seconds / stage_seconds, 4) if stage_seconds else 0.0}
+                      for name, (calls, seconds, items) in self.stages.items()}
+            formats = {fmt: {'images': images, 'seconds': round(seconds, 6), 'bytes': size,
+                             'ms_per_image': round(seconds / images * 1000, 4) if images else 0.0,
+                             'bytes_per_image': size // images if images else 0}
+                       for fmt, (images, seconds, size) in self.formats.items()}
+            return {'name': self.name, 'elapsed_seconds': round(elapsed, 6), 'frames': self.frames,
+                    'frames_per_second': round(self.frames / elapsed, 3) if elapsed else 0.0,
+                    'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, 'stages': stages, 'formats': formats}
+
+    def finish(self, report_path=None):
+        """Print the run summary and write it as JSON to report_path if given"""
+        report = self.report()
+        print(f"[{self.name}] {report['frames']} frames in {report['elapsed_seconds']:.2f}s "
+              f"({report['frames_per_second']:.1f} frames/s), read {report['bytes_read'] / 1e6:.1f} MB, "
+              f"wrote {report['bytes_written'] / 1e6:.1f} MB")
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print(f"  {name:<12} {stage['seconds']:9.3f}s  {stage['ms_per_item']:9.3f} ms/item  {stage['share'] * 100:5.1f}%")
+        for fmt, encoded in sorted(report['formats'].items()):
+            print(f"  {fmt:<12} {encoded['images']} images, {encoded['ms_per_image']:.3f} ms and "
+                  f"{encoded['bytes_per_image'] / 1024:.1f} KB per image")
+
+        if report_path:
+            report_dir = os.path.dirname(report_path)
+            if report_dir:
+                os.makedirs(report_dir, exist_ok=True)
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def start_run(name, interval=progress_interval):
+    """Replace the process-global profiler with a fresh one for a new run"""
+    global _profiler
+    _profiler = Profiler(name, interval)
+    return _profiler
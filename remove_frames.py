@@ -1,12 +1,26 @@
 import os
 import re
+import csv
+import json
+import shutil
+import argparse
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from build_cache import BuildManifest, manifest_path_for
+from image_io import is_image, read_image
+
+hash_size = 8  # 8x8 difference hash, 64 bits per frame
+ssim_size = 32  # thumbnail side used for the SSIM comparison
+
 
 def process_files(folder_path):
-    # List all files in the folder
-    files = os.listdir(folder_path)
+    # List all image files in the folder
+    files = [f for f in os.listdir(folder_path) if is_image(f)]
     #files.sort()  # Optional: Sort files if specific order is needed
     files = sorted(files, key=natural_sort_key)
 
+    deleted = []
     i = 0
     while i < len(files):
         # Keep the current file
@@ -19,15 +33,173 @@ def process_files(folder_path):
             if i < len(files):
                 file_to_delete = os.path.join(folder_path, files[i])
                 os.remove(file_to_delete)
+                deleted.append(file_to_delete)
                 print(f"Deleted: {files[i]}")
             else:
                 break
 
         # Move to the next file to keep
         i += 1
+    mark_pruned(folder_path, deleted)
+
+
+def mark_pruned(folder_path, paths):
+    """Tell the extract stage's manifest that these frames were removed on purpose, so an incremental
+    frame_extractor.py run doesn't extract them again. Folders without a manifest are left alone."""
+    manifest_path = manifest_path_for(folder_path)
+    if paths and os.path.exists(manifest_path):
+        BuildManifest(manifest_path).mark_pruned(*paths)
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower()
-            for text in re.split('(\d+)', s)]
+            for text in re.split(r'(\d+)', s)]
+
+
+def _load_thumbnail(path, size):
+    # reduced decoding gets JPEGs to 1/8 resolution without decoding the full image
+    image = read_image(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        image = read_image(path, cv2.IMREAD_GRAYSCALE)
+    elif image.ndim == 3:
+        # .npy frames come back as they were saved, whatever the flags
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def load_thumbnails(paths, size, workers=8):
+    """Decode all frames into an (N, height, width) stack of small grayscale thumbnails"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.stack(list(executor.map(lambda path: _load_thumbnail(path, size), paths)))
+
+
+def difference_hashes(thumbnails):
+    """64 bit difference hash per frame from an (N, hash_size, hash_size + 1) thumbnail stack, in one batch"""
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view('>u8').ravel()
+
+
+def hamming_distances(hashes, reference):
+    return np.unpackbits((hashes ^ reference).view(np.uint8).reshape(len(hashes), -1), axis=1).sum(axis=1)
+
+
+def ssim(a, b):
+    """Global SSIM of two thumbnails, 1.0 for identical images"""
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_a, mean_b = a.mean(), b.mean()
+    var_a, var_b = a.var(), b.var()
+    covariance = ((a - mean_a) * (b - mean_b)).mean()
+    return ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+
+
+def select_frames(paths, metric='dhash', threshold=10, workers=8):
+    """Walk the frames in order and keep every frame that differs enough from the last kept one.
+    For dhash the distance is the Hamming distance in bits, for ssim it is 1 - SSIM.
+    Returns the keep flags and the distance of every frame to the last kept frame."""
+    keep = np.zeros(len(paths), dtype=bool)
+    distances = np.zeros(len(paths), dtype=np.float64)
+    if not paths:
+        return keep, distances
+
+    if metric == 'dhash':
+        hashes = difference_hashes(load_thumbnails(paths, (hash_size + 1, hash_size), workers))
+        distance = lambda i, j: int(hamming_distances(hashes[i:i + 1], hashes[j])[0])
+    elif metric == 'ssim':
+        thumbnails = load_thumbnails(paths, (ssim_size, ssim_size), workers).astype(np.float32)
+        distance = lambda i, j: 1.0 - ssim(thumbnails[i], thumbnails[j])
+    else:
+        raise ValueError(f"Unknown metric {metric}, expected 'dhash' or 'ssim'")
+
+    last_kept = 0
+    keep[0] = True
+    for i in range(1, len(paths)):
+        distances[i] = distance(i, last_kept)
+        if distances[i] > threshold:
+            keep[i] = True
+            last_kept = i
+    return keep, distances
+
+
+def pruned_list_path_for(folder_path):
+    # next to the frames folder, like the build manifests, so it never shows up among the frames
+    folder_path = os.path.normpath(folder_path)
+    return os.path.join(os.path.dirname(folder_path), f'.pruned-{os.path.basename(folder_path)}.json')
+
+
+def read_pruned_list(folder_path):
+    """File names that a list_only prune_frames run marked as pruned in folder_path, empty without a list"""
+    path = pruned_list_path_for(folder_path)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f)['pruned'])
+
+
+def clear_pruned_list(folder_path):
+    """Remove the list of a list_only prune_frames run, returns True if there was one"""
+    path = pruned_list_path_for(folder_path)
+    if not os.path.exists(path):
+        return False
+    os.remove(path)
+    return True
+
+
+def write_report(report_path, files, keep, distances):
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'distance_to_last_kept', 'keep'])
+        for file, kept, distance in zip(files, keep, distances):
+            writer.writerow([file, distance, int(kept)])
+
+
+def prune_frames(folder_path, metric='dhash', threshold=10, dry_run=False, move_to=None, report_path=None, workers=8,
+                 list_only=False):
+    """Keep only frames that differ from the last kept frame by more than threshold.
+    Pruned frames are deleted, or moved to move_to, nothing is touched with dry_run. With list_only the frames
+    stay and their names are written to pruned_list_path_for(folder_path) instead, for compress_simple.py to skip."""
+    files = sorted((f for f in os.listdir(folder_path) if is_image(f)), key=natural_sort_key)
+    paths = [os.path.join(folder_path, f) for f in files]
+    keep, distances = select_frames(paths, metric, threshold, workers)
+
+    if report_path:
+        write_report(report_path, files, keep, distances)
+
+    pruned = [path for path, kept in zip(paths, keep) if not kept]
+    print(f"Keeping {int(keep.sum())} of {len(files)} frames, {'would prune' if dry_run else 'pruning'} {len(pruned)}")
+    if dry_run:
+        return keep
+
+    if list_only:
+        with open(pruned_list_path_for(folder_path), 'w') as f:
+            json.dump({'metric': metric, 'threshold': threshold, 'pruned': [os.path.basename(path) for path in pruned]}, f)
+        return keep
+    if move_to:
+        os.makedirs(move_to, exist_ok=True)
+        for path in pruned:
+            shutil.move(path, os.path.join(move_to, os.path.basename(path)))
+    else:
+        for path in pruned:
+            os.remove(path)
+    mark_pruned(folder_path, pruned)
+    return keep
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Remove redundant frames from an extracted frames folder")
+    parser.add_argument("folder_path", nargs="?", default='frames/fruits.mp4', help="Folder with the extracted frames")
+    parser.add_argument("--mode", choices=['fixed', 'dhash', 'ssim'], default='fixed',
+                        help="fixed keeps 1 of every 4 frames, dhash/ssim keep frames that differ from the last kept one")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="Minimum distance to the last kept frame, in bits for dhash (default 10) or 1 - SSIM for ssim (default 0.05)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be pruned")
+    parser.add_argument("--move-to", default=None, help="Move pruned frames to this folder instead of deleting them")
+    parser.add_argument("--list-only", action="store_true",
+                        help="Keep every frame and write the pruned ones to .pruned-<folder>.json, which compress_simple.py can skip")
+    parser.add_argument("--report", default=None, help="Write a CSV report with the distance and decision per frame")
+    args = parser.parse_args()
 
-process_files('frames/fruits.mp4')
\ No newline at end of file
+    if args.mode == 'fixed':
+        process_files(args.folder_path)
+    else:
+        threshold = args.threshold if args.threshold is not None else (10 if args.mode == 'dhash' else 0.05)
+        prune_frames(args.folder_path, args.mode, threshold, args.dry_run, args.move_to, args.report,
+                     list_only=args.list_only)
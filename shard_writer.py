@@ -0,0 +1,292 @@
+import os
+import json
+import random
+import struct
+import argparse
+from functools import lru_cache
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from calc_bbox_area import parse_xml_annotation_from_file
+from image_io import ImageWriter, format_of, is_image, read_image
+
+try:
+    # C implementation, still several times faster than the NumPy fallback below
+    from crc32c import crc32c as _fast_crc32c
+except ImportError:
+    _fast_crc32c = None
+
+# Streams a finished dataset (images + Pascal VOC files, e.g. the output of compress_simple.py, augmentation.py
+# or cam_effect.py) into a few large shard files for the training toolchain instead of thousands of loose files.
+# Two record formats:
+#   tfrecord - TFRecord framing around tf.train.Example protos with the object detection API feature keys,
+#              readable with tf.data.TFRecordDataset without TensorFlow being needed to write them
+#   simple   - uint32 header length, JSON header, uint32 image length, image bytes
+# Shards are planned up front from the file sizes so they can be written in parallel, and an index file
+# records where every record lives so records can be read back in any (shuffled) order.
+
+# image/format values the object detection API decodes, other formats (webp, npy) are re-encoded to png
+tfrecord_formats = ('jpeg', 'png')
+default_max_shard_bytes = 64 * 1024 * 1024
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+_CRC32C_ARRAY = np.array(_CRC32C_TABLE, dtype=np.uint32)
+_CRC_BITS = np.arange(32, dtype=np.uint32)
+# chunk length of the NumPy fallback, a power of two; shorter data goes through the byte loop
+crc_chunk_bytes = 128
+crc_numpy_min_bytes = 4096
+
+# The fallback uses that a CRC without its initial value and final xor (the "raw" CRC) is linear in the data:
+#   raw(a + b) = zeros(raw(a), len(b)) ^ raw(b)
+# where zeros() runs the CRC over len(b) zero bytes, itself a linear function of the CRC, stored as the images
+# of its 32 bits. The data is cut into equal chunks whose raw CRCs are computed side by side, one byte column
+# per NumPy step, and the chunk CRCs are then combined pairwise.
+
+
+def _apply_zeros(operator, values):
+    """Run every raw CRC in values over the zero bytes that operator (the images of the 32 CRC bits) stands for"""
+    bits = ((values[..., None] >> _CRC_BITS) & 1).astype(bool)
+    return np.bitwise_xor.reduce(np.where(bits, operator, np.uint32(0)), axis=-1)
+
+
+@lru_cache(maxsize=None)
+def _zeros_operator(power):
+    """Operator that runs a raw CRC over 2 ** power zero bytes"""
+    if power == 0:
+        basis = np.uint32(1) << _CRC_BITS
+        return _CRC32C_ARRAY[basis & 0xFF] ^ (basis >> 8)
+    half = _zeros_operator(power - 1)
+    return _apply_zeros(half, half)
+
+
+def _crc32c_numpy(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    # leading zero bytes leave a raw CRC at 0, so the front is padded to whole chunks
+    padding = -len(data) % crc_chunk_bytes
+    columns = np.concatenate([np.zeros(padding, dtype=np.uint8), data]).reshape(-1, crc_chunk_bytes).T.copy()
+    crcs = np.zeros(columns.shape[1], dtype=np.uint32)
+    for column in columns:
+        crcs = _CRC32C_ARRAY[(crcs ^ column) & 0xFF] ^ (crcs >> 8)
+
+    power = crc_chunk_bytes.bit_length() - 1
+    while len(crcs) > 1:
+        if len(crcs) % 2:
+            # a chunk of zero bytes in front, which doesn't change the result
+            crcs = np.concatenate([np.zeros(1, dtype=np.uint32), crcs])
+        crcs = _apply_zeros(_zeros_operator(power), crcs[0::2]) ^ crcs[1::2]
+        power += 1
+
+    # the initial 0xFFFFFFFF contributes its own run over len(data) zero bytes
+    initial = np.array([0xFFFFFFFF], dtype=np.uint32)
+    for power in range(len(data).bit_length()):
+        if len(data) >> power & 1:
+            initial = _apply_zeros(_zeros_operator(power), initial)
+    return int(crcs[0] ^ initial[0]) ^ 0xFFFFFFFF
+
+
+def crc32c(data):
+    if _fast_crc32c is not None:
+        return _fast_crc32c(data)
+    if len(data) >= crc_numpy_min_bytes:
+        return _crc32c_numpy(data)
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _masked_crc(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord_frame(payload):
+    length = struct.pack('<Q', len(payload))
+    return length + struct.pack('<I', _masked_crc(length)) + payload + struct.pack('<I', _masked_crc(payload))
+
+
+# Minimal protobuf encoding of tf.train.Example, enough for bytes, float and int64 lists
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(number, payload):
+    # wire type 2, length delimited
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _feature(kind, values):
+    if kind == 'bytes':
+        return _field(1, b''.join(_field(1, value) for value in values))
+    # numeric lists are packed, an empty list is an empty message of the right type
+    if kind == 'float':
+        return _field(2, _field(1, struct.pack(f'<{len(values)}f', *values)) if values else b'')
+    return _field(3, _field(1, b''.join(_varint(value & 0xFFFFFFFFFFFFFFFF) for value in values)) if values else b'')
+
+
+def encode_example(features):
+    """Encode {key: (kind, values)} as a serialized tf.train.Example, kind is 'bytes', 'float' or 'int64'"""
+    entries = b''.join(_field(1, _field(1, key.encode('utf-8')) + _field(2, _feature(kind, values)))
+                       for key, (kind, values) in sorted(features.items()))
+    return _field(1, entries)
+
+
+def _tfrecord_image(image_path):
+    """Encoded bytes of the image and their image/format value"""
+    image_format = format_of(image_path)
+    if image_format in tfrecord_formats:
+        with open(image_path, 'rb') as f:
+            return f.read(), image_format
+    image = read_image(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    return ImageWriter('png').encode(image), 'png'
+
+
+def _sample_record(image_path, xml_path, fmt):
+    annotation = parse_xml_annotation_from_file(xml_path)
+    width, height = int(annotation['size']['width']), int(annotation['size']['height'])
+    filename = os.path.basename(image_path)
+    names = [obj['name'] for obj in annotation['object']]
+    boxes = [[float(obj['bndbox'][key]) for key in ('xmin', 'ymin', 'xmax', 'ymax')] for obj in annotation['object']]
+
+    if fmt == 'simple':
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+        header = json.dumps({'filename': filename, 'width': width, 'height': height,
+                             'labels': names, 'boxes': boxes}).encode('utf-8')
+        return struct.pack('<I', len(header)) + header + struct.pack('<I', len(image_bytes)) + image_bytes
+
+    image_bytes, image_format = _tfrecord_image(image_path)
+    example = encode_example({
+        'image/encoded': ('bytes', [image_bytes]),
+        'image/filename': ('bytes', [filename.encode('utf-8')]),
+        'image/format': ('bytes', [image_format.encode('utf-8')]),
+        'image/width': ('int64', [width]),
+        'image/height': ('int64', [height]),
+        # the object detection API expects box coordinates normalized to [0, 1]
+        'image/object/bbox/xmin': ('float', [box[0] / width for box in boxes]),
+        'image/object/bbox/ymin': ('float', [box[1] / height for box in boxes]),
+        'image/object/bbox/xmax': ('float', [box[2] / width for box in boxes]),
+        'image/object/bbox/ymax': ('float', [box[3] / height for box in boxes]),
+        'image/object/class/text': ('bytes', [name.encode('utf-8') for name in names]),
+    })
+    return tfrecord_frame(example)
+
+
+def plan_shards(samples, max_shard_bytes):
+    """Split samples into consecutive shards of at most max_shard_bytes of image data each"""
+    shards, current, current_bytes = [], [], 0
+    for sample in samples:
+        size = os.path.getsize(sample[0])
+        if current and current_bytes + size > max_shard_bytes:
+            shards.append(current)
+            current, current_bytes = [], 0
+        current.append(sample)
+        current_bytes += size
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _write_shard(task):
+    shard_path, samples, fmt = task
+    entries = []
+    offset = 0
+    with open(shard_path, 'wb') as f:
+        for image_path, xml_path in samples:
+            record = _sample_record(image_path, xml_path, fmt)
+            f.write(record)
+            entries.append([os.path.basename(shard_path), offset, len(record), os.path.basename(image_path)])
+            offset += len(record)
+    return entries
+
+
+def write_shards(image_dir, xml_dir, output_prefix, fmt='tfrecord', max_shard_bytes=default_max_shard_bytes, workers=None):
+    """Write every annotated image in image_dir into shards named output_prefix-XXXXX-of-YYYYY.tfrecord (or .records),
+    plus output_prefix.index.json with (shard, offset, length, image) per record"""
+    if fmt not in ('tfrecord', 'simple'):
+        raise ValueError(f"Unknown format {fmt}, expected 'tfrecord' or 'simple'")
+
+    samples = []
+    for image_file in sorted(os.listdir(image_dir)):
+        if not is_image(image_file):
+            continue
+        xml_path = os.path.join(xml_dir, os.path.splitext(image_file)[0] + '.xml')
+        if os.path.exists(xml_path):
+            samples.append((os.path.join(image_dir, image_file), xml_path))
+
+    output_dir = os.path.dirname(output_prefix)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    shards = plan_shards(samples, max_shard_bytes)
+    extension = 'tfrecord' if fmt == 'tfrecord' else 'records'
+    tasks = [(f'{output_prefix}-{i:05d}-of-{len(shards):05d}.{extension}', shard, fmt) for i, shard in enumerate(shards)]
+
+    index = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for entries in executor.map(_write_shard, tasks):
+            index.extend(entries)
+
+    with open(f'{output_prefix}.index.json', 'w') as f:
+        json.dump({'format': fmt, 'records': index}, f)
+
+    print(f"Wrote {len(index)} records into {len(shards)} shards at {output_prefix}")
+    return len(index)
+
+
+def read_records(output_prefix, shuffle=False, seed=None):
+    """Yield the raw records of a sharded dataset, in write order or shuffled using the index"""
+    with open(f'{output_prefix}.index.json') as f:
+        index = json.load(f)
+    records = index['records']
+    if shuffle:
+        records = list(records)
+        random.Random(seed).shuffle(records)
+
+    shard_dir = os.path.dirname(output_prefix)
+    handles = {}
+    try:
+        for shard, offset, length, _ in records:
+            if shard not in handles:
+                handles[shard] = open(os.path.join(shard_dir, shard), 'rb')
+            handle = handles[shard]
+            handle.seek(offset)
+            yield handle.read(length)
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write an image + Pascal VOC dataset into sharded TFRecord or length-prefixed files")
+    parser.add_argument("image_dir", help="Folder with the images")
+    parser.add_argument("xml_dir", help="Folder with the matching Pascal VOC files")
+    parser.add_argument("output_prefix", help="Path prefix of the shard and index files")
+    parser.add_argument("--format", choices=['tfrecord', 'simple'], default='tfrecord')
+    parser.add_argument("--max-shard-mb", type=float, default=default_max_shard_bytes / (1024 * 1024))
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    write_shards(args.image_dir, args.xml_dir, args.output_prefix, args.format,
+                 int(args.max_shard_mb * 1024 * 1024), args.workers)
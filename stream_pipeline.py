@@ -0,0 +1,81 @@
+import cv2
+import os
+from crop_resize import crop_boxes, fit_shortest_axis
+from cvat_reader import load_index
+from frame_extractor import build_frame_index, iter_frames
+from image_io import ImageWriter
+from pascal_voc import PascalVocAnnotation
+
+# Single pass replacement for frame_extractor.py -> remove_frames.py -> compress_simple.py.
+# Frames are decoded straight from the video, subsampled and resized in memory, and only the
+# final size images and their Pascal VOC files are written to disk.
+
+target_image_width = 128
+target_image_height = 128
+keep_every = 4  # same policy as remove_frames.py, keep 1 out of every 4 annotated frames
+labels = ('orange', 'apple', 'banana')
+# png, jpeg, webp or npy, see image_io.py
+output_format = 'png'
+output_quality = None
+
+video_name = 'fruits.mp4'
+video_path = 'videos/fruits.mp4'
+annotation_path = 'annotations/annotations_train.xml'
+
+
+def parse_boxes(xml_file, labels=labels):
+    """Return {frame_number: [(label, xtl, ytl, xbr, ybr), ...]} for all tracks with one of the given labels"""
+    return dict(load_index(xml_file).items(labels))
+
+
+def keep_every_nth(frame_index, n):
+    # applied to the sorted index before decoding, so dropped frames are never decoded at all
+    return frame_index[::n]
+
+
+def resize_frames(frames, frame_boxes, target_width, target_height):
+    for frame_num, frame in frames:
+        cropped_image, resize_ratio, start_x, start_y = fit_shortest_axis(frame, target_width, target_height)
+        labels, coords = crop_boxes([box[0] for box in frame_boxes[frame_num]], [box[1:] for box in frame_boxes[frame_num]],
+                                    resize_ratio, start_x, start_y, target_width, target_height)
+        yield frame_num, cropped_image, [(label, *box) for label, box in zip(labels, coords)]
+
+
+def write_frames(samples, frames_dir, annotations_dir, target_width, target_height, writer=None):
+    writer = writer or ImageWriter(output_format, output_quality)
+    count = 0
+    for frame_num, image, boxes in samples:
+        image_name = os.path.basename(writer.write(os.path.join(frames_dir, f'frame_{frame_num}.png'), image))
+
+        annotation = PascalVocAnnotation(image_name, target_width, target_height)
+        for box in boxes:
+            annotation.add_object(*box)
+        annotation.write(os.path.join(annotations_dir, f'frame_{frame_num}.xml'))
+        count += 1
+    return count
+
+
+def run_pipeline(video_name, video_path, annotation_path, target_width=target_image_width,
+                 target_height=target_image_height, keep_every=keep_every, labels=labels):
+    frames_dir = f'compressed/{video_name}/frames_{target_width} x {target_height}'
+    annotations_dir = f'compressed/{video_name}/annotations_{target_width} x {target_height}'
+    os.makedirs(frames_dir, exist_ok=True)
+    os.makedirs(annotations_dir, exist_ok=True)
+
+    frame_boxes = parse_boxes(annotation_path, labels)
+    frame_index = keep_every_nth(build_frame_index(frame_boxes.keys()), keep_every)
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        frames = iter_frames(cap, frame_index)
+        samples = resize_frames(frames, frame_boxes, target_width, target_height)
+        count = write_frames(samples, frames_dir, annotations_dir, target_width, target_height)
+    finally:
+        cap.release()
+
+    print(f"Wrote {count} frames to {frames_dir}")
+    return count
+
+
+if __name__ == '__main__':
+    run_pipeline(video_name, video_path, annotation_path)